@@ -0,0 +1,275 @@
+import json
+import os
+import struct
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Mapping, Optional
+
+import click
+
+from sd_copy.native_metadata import (
+    EXIF_HEADER,
+    JPEG_SOI,
+    QUICKTIME_EPOCH,
+    RAF_JPEG_OFFSET,
+    RAF_MAGIC,
+    TAG_DATE_TIME_ORIGINAL,
+    TAG_EXIF_IFD,
+    TAG_EXIF_IMAGE_HEIGHT,
+    TAG_EXIF_IMAGE_WIDTH,
+    TAG_IMAGE_HEIGHT,
+    TAG_IMAGE_WIDTH,
+    TAG_MODEL,
+    TAG_SHUTTER_SPEED_VALUE,
+    get_metadata_from_native_reader,
+)
+
+DEFAULT_START = datetime(2021, 7, 8, 12, 0, 0)
+DEFAULT_SHOT_INTERVAL = 10  # seconds between consecutive shots, so that targets keep the order of their sources
+DEFAULT_IMAGE_SIZE = 256 * 1024
+DEFAULT_VIDEO_SIZE = 2 * 1024 * 1024
+RAF_JPEG_START = 100
+SHUTTER_SPEED_APEX = 7.965784  # 1/250
+VIDEO_TIMESCALE, VIDEO_FRAME_DURATION, VIDEO_N_FRAMES = 30000, 1001, 300  # 10 s at 29.97 fps
+DJI_VIDEO_DATE_TIMEDELTA = timedelta(hours=1)  # the Osmo Action records video dates one hour behind
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+TiffValue = str | int | float
+
+
+def pack_tiff_value(value: TiffValue) -> tuple[int, int, bytes]:
+    # Strings as ASCII, floats as SRATIONAL and integers as LONG
+    if isinstance(value, str):
+        data = value.encode() + b"\x00"
+        return 2, len(data), data
+    if isinstance(value, float):
+        return 10, 1, struct.pack("<ii", round(value * 1_000_000), 1_000_000)
+    return 4, 1, struct.pack("<I", value)
+
+
+def get_tiff(ifd0: Mapping[int, TiffValue], exif_ifd: Mapping[int, TiffValue]) -> bytes:
+    """Little-endian TIFF with IFD0 at offset 8, followed by the EXIF IFD and the values that don't fit an entry"""
+    exif_ifd_offset = 8 + 2 + 12 * (len(ifd0) + 1) + 4
+    data_offset = exif_ifd_offset + 2 + 12 * len(exif_ifd) + 4
+    data = bytearray()
+
+    def pack_ifd(entries: Mapping[int, TiffValue]) -> bytes:
+        packed = struct.pack("<H", len(entries))
+        for tag, value in sorted(entries.items()):
+            field_type, count, value_bytes = pack_tiff_value(value)
+            if len(value_bytes) <= 4:
+                packed += struct.pack("<HHI", tag, field_type, count) + value_bytes.ljust(4, b"\x00")
+            else:
+                packed += struct.pack("<HHII", tag, field_type, count, data_offset + len(data))
+                data.extend(value_bytes)
+        return packed + struct.pack("<I", 0)
+
+    packed_ifds = pack_ifd({**ifd0, TAG_EXIF_IFD: exif_ifd_offset}) + pack_ifd(exif_ifd)
+    return b"II*\x00" + struct.pack("<I", 8) + packed_ifds + bytes(data)
+
+
+def get_camera_tiff(model: str, date: datetime, width: int, height: int) -> bytes:
+    return get_tiff(
+        ifd0={TAG_MODEL: model, TAG_IMAGE_WIDTH: width, TAG_IMAGE_HEIGHT: height},
+        exif_ifd={
+            TAG_DATE_TIME_ORIGINAL: f"{date:%Y:%m:%d %H:%M:%S}",
+            TAG_SHUTTER_SPEED_VALUE: SHUTTER_SPEED_APEX,
+            TAG_EXIF_IMAGE_WIDTH: width,
+            TAG_EXIF_IMAGE_HEIGHT: height,
+        },
+    )
+
+
+def get_jpeg(tiff: bytes) -> bytes:
+    app1 = EXIF_HEADER + tiff
+    return JPEG_SOI + b"\xff\xe1" + struct.pack(">H", len(app1) + 2) + app1 + b"\xff\xda\x00\x02"
+
+
+def get_raf(jpeg: bytes) -> bytes:
+    header = RAF_MAGIC + bytes(RAF_JPEG_OFFSET - len(RAF_MAGIC))
+    header += struct.pack(">II", RAF_JPEG_START, len(jpeg))
+    return header.ljust(RAF_JPEG_START, b"\x00") + jpeg
+
+
+def get_box(box_type: bytes, payload: bytes) -> bytes:
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+
+def get_quicktime(brand: bytes, date: datetime, height: int, handler_name: str = "", udta: bytes = b"") -> bytes:
+    """QuickTime file with a single video track, ending in an `mdat` box that extends to the end of the file"""
+    creation_time = int((date - QUICKTIME_EPOCH).total_seconds())
+    tkhd = bytes(76) + struct.pack(">II", (height * 16 // 9) << 16, height << 16)
+    mdhd = struct.pack(
+        ">IIIIII",
+        0,
+        creation_time,
+        creation_time,
+        VIDEO_TIMESCALE,
+        VIDEO_N_FRAMES * VIDEO_FRAME_DURATION,
+        0,
+    )
+    hdlr = struct.pack(">II4s", 0, 0, b"vide") + bytes(12) + handler_name.encode("latin-1") + b"\x00"
+    stts = struct.pack(">IIII", 0, 1, VIDEO_N_FRAMES, VIDEO_FRAME_DURATION)
+    minf = get_box(b"minf", get_box(b"stbl", get_box(b"stts", stts)))
+    mdia = get_box(b"mdia", get_box(b"mdhd", mdhd) + get_box(b"hdlr", hdlr) + minf)
+    moov = get_box(b"moov", get_box(b"trak", get_box(b"tkhd", tkhd) + mdia) + (get_box(b"udta", udta) if udta else b""))
+    return get_box(b"ftyp", brand + bytes(4)) + moov + struct.pack(">I4s", 0, b"mdat")
+
+
+def write_media_file(path: Path, header: bytes, size: int, date: datetime, random_payload: bool):
+    """Write `header` padded to `size` bytes. Without `random_payload`, the padding is left sparse, which is quick to
+    generate but may be copied faster than real media."""
+    with path.open("wb") as f:
+        f.write(header)
+        if random_payload:
+            for offset in range(len(header), size, WRITE_BUFFER_SIZE):
+                f.write(os.urandom(min(WRITE_BUFFER_SIZE, size - offset)))
+        else:
+            f.truncate(max(size, len(header)))
+    os.utime(path, (date.timestamp(), date.timestamp()))
+
+
+def write_x_t3_shot(
+    folder: Path,
+    number: int,
+    date: datetime,
+    image_size: int,
+    video_size: int,
+    random_payload: bool,
+) -> tuple[Path, ...]:
+    # Alternates between JPG+RAF pairs and MOV videos with EXIF embedded in udta/MVTG
+    stem = folder / f"DSCF{number:04d}"
+    if number % 2:
+        jpeg = get_jpeg(get_camera_tiff(model="X-T3", date=date, width=6240, height=4160))
+        write_media_file(stem.with_suffix(".JPG"), jpeg, image_size, date, random_payload)
+        write_media_file(stem.with_suffix(".RAF"), get_raf(jpeg), image_size * 4, date, random_payload)
+        return stem.with_suffix(".JPG"), stem.with_suffix(".RAF")
+    mvtg = get_box(b"MVTG", get_camera_tiff(model="X-T3", date=date, width=3840, height=2160))
+    mov = get_quicktime(brand=b"qt  ", date=date, height=2160, udta=mvtg)
+    write_media_file(stem.with_suffix(".MOV"), mov, video_size, date, random_payload)
+    return (stem.with_suffix(".MOV"),)
+
+
+def write_dji_shot(
+    folder: Path,
+    number: int,
+    date: datetime,
+    image_size: int,
+    video_size: int,
+    random_payload: bool,
+) -> tuple[Path, ...]:
+    # Cycles through MOV videos with AAC audio alongside, MP4 videos and JPG+DNG pairs
+    stem = folder / f"DJI_{number:04d}"
+    if number % 3 == 0:
+        tiff = get_camera_tiff(model="DJI Osmo Action", date=date, width=4000, height=3000)
+        write_media_file(stem.with_suffix(".JPG"), get_jpeg(tiff), image_size, date, random_payload)
+        write_media_file(stem.with_suffix(".DNG"), tiff, image_size * 6, date, random_payload)
+        return stem.with_suffix(".JPG"), stem.with_suffix(".DNG")
+    suffix, brand = (".MOV", b"qt  ") if number % 3 == 1 else (".MP4", b"isom")
+    video = get_quicktime(brand=brand, date=date - DJI_VIDEO_DATE_TIMEDELTA, height=1080, handler_name="\x10DJI.Meta")
+    write_media_file(stem.with_suffix(suffix), video, video_size, date, random_payload)
+    if suffix == ".MOV":
+        write_media_file(stem.with_suffix(".AAC"), b"\xff\xf1", video_size // 20, date, random_payload)
+        return stem.with_suffix(suffix), stem.with_suffix(".AAC")
+    return (stem.with_suffix(suffix),)
+
+
+def generate_card(
+    path: Path,
+    n_shots: int,
+    image_size: int = DEFAULT_IMAGE_SIZE,
+    video_size: int = DEFAULT_VIDEO_SIZE,
+    start: datetime = DEFAULT_START,
+    random_payload: bool = False,
+) -> dict[str, dict]:
+    """Write a flat card folder with `n_shots` shots, one every DEFAULT_SHOT_INTERVAL seconds. The first half is taken
+    with the DJI Osmo Action and the second half with the X-T3, so that DJI_* files sort before DSCF* files in both
+    source and target. Returns the metadata of every file that carries its own,
+    as `exiftool -j -G` would report it, keyed on the file path."""
+    n_dji_shots = n_shots // 2
+    path.mkdir(parents=True, exist_ok=True)
+    media_files = []
+    for index in range(n_shots):
+        date = start + timedelta(seconds=index * DEFAULT_SHOT_INTERVAL)
+        write_shot, number = (
+            (write_dji_shot, index + 1) if index < n_dji_shots else (write_x_t3_shot, index - n_dji_shots + 1)
+        )
+        media_files.extend(write_shot(path, number, date, image_size, video_size, random_payload))
+    return get_manifest(media_files)
+
+
+def generate_timelapse_card(
+    path: Path,
+    n_frames: int,
+    image_size: int = DEFAULT_IMAGE_SIZE,
+    dt: int = 5,
+    start: datetime = DEFAULT_START,
+    random_payload: bool = False,
+) -> dict[str, dict]:
+    """Write a X-T3 timelapse of `n_frames` JPG+RAF pairs taken every `dt` seconds"""
+    path.mkdir(parents=True, exist_ok=True)
+    media_files = []
+    for index in range(n_frames):
+        date = start + timedelta(seconds=index * dt)
+        jpeg = get_jpeg(get_camera_tiff(model="X-T3", date=date, width=6240, height=4160))
+        stem = path / f"DSCF{index + 1:04d}"
+        write_media_file(stem.with_suffix(".JPG"), jpeg, image_size, date, random_payload)
+        write_media_file(stem.with_suffix(".RAF"), get_raf(jpeg), image_size * 4, date, random_payload)
+        media_files.extend((stem.with_suffix(".JPG"), stem.with_suffix(".RAF")))
+    return get_manifest(media_files)
+
+
+def get_manifest(media_files: tuple[Path, ...] | list[Path]) -> dict[str, dict]:
+    # AAC files have no metadata of their own, sd-copy reads that of the matching video instead
+    return {
+        str(media_file): get_metadata_from_native_reader(media_file)
+        for media_file in media_files
+        if media_file.suffix != ".AAC"
+    }
+
+
+def write_manifest(manifest: Mapping[str, dict], path: Path):
+    path.write_text(json.dumps(manifest))
+
+
+@click.command()
+@click.argument("path", type=click.Path(file_okay=False, path_type=Path))
+@click.option("--shots", default=100, type=click.IntRange(min=0), help="Number of shots, each one to two files")
+@click.option("--timelapse-frames", default=0, type=click.IntRange(min=0), help="Write a timelapse card instead")
+@click.option("--image-size", default=DEFAULT_IMAGE_SIZE, type=click.IntRange(min=0), help="JPG size in bytes")
+@click.option("--video-size", default=DEFAULT_VIDEO_SIZE, type=click.IntRange(min=0), help="Video size in bytes")
+@click.option("--random-payload", default=False, is_flag=True, help="Fill files with random data instead of holes")
+@click.option("--manifest", default=None, type=click.Path(dir_okay=False, path_type=Path), help="Write metadata here")
+def main(
+    path: Path,
+    shots: int,
+    timelapse_frames: int,
+    image_size: int,
+    video_size: int,
+    random_payload: bool,
+    manifest: Optional[Path],
+):
+    """Write a synthetic SD card to PATH, with minimal but valid EXIF and QuickTime headers. Sizes of RAF and DNG
+    files are a multiple of the JPG size."""
+    if timelapse_frames:
+        card_manifest = generate_timelapse_card(
+            path=path,
+            n_frames=timelapse_frames,
+            image_size=image_size,
+            random_payload=random_payload,
+        )
+    else:
+        card_manifest = generate_card(
+            path=path,
+            n_shots=shots,
+            image_size=image_size,
+            video_size=video_size,
+            random_payload=random_payload,
+        )
+    if manifest:
+        write_manifest(card_manifest, manifest)
+    click.secho(f"Wrote {len(card_manifest)} files with metadata to {path}", fg="green")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""Memory and build time of a sorting plan, i.e. of the DCIMTransfer objects of all files of a source, as for
+archive re-sorts of millions of files. Transfers are built from metadata of a synthetic card, decoded from JSON for
+every file like exiftool output, so that no strings are shared between transfers that aren't shared in a real run."""
+
+import json
+import time
+import tracemalloc
+from itertools import cycle, islice
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Sequence
+
+import click
+
+from benchmarks.generate_dcim import generate_card
+from sd_copy.dcim_transfer import DCIMTransfer, get_dcim_transfer_object
+
+FILES_PER_FOLDER = 1000
+
+
+def build_plan(metadata: Sequence[tuple[Path, str]], n_transfers: int) -> Sequence[DCIMTransfer]:
+    return tuple(
+        get_dcim_transfer_object(
+            media_file=Path("/archive") / f"{i // FILES_PER_FOLDER:04d}" / f"{media_file.stem}{i}{media_file.suffix}",
+            destination=Path("/library"),
+            time_offset=0,
+            exif_data=json.loads(exif_json),
+        )
+        for i, (media_file, exif_json) in enumerate(islice(cycle(metadata), n_transfers))
+    )
+
+
+@click.command()
+@click.option("--transfers", default=100_000, type=click.IntRange(min=1), help="Number of transfers in the plan")
+def main(transfers: int):
+    """Print the memory held per transfer of a sorting plan, and the time to build the plan"""
+    with TemporaryDirectory() as card_dir:
+        manifest = generate_card(path=Path(card_dir), n_shots=20, image_size=0, video_size=0)
+    metadata = tuple((Path(media_file), json.dumps(exif_data)) for media_file, exif_data in manifest.items())
+
+    start = time.perf_counter()
+    build_plan(metadata, n_transfers=transfers)
+    build_seconds = time.perf_counter() - start
+
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    plan = build_plan(metadata, n_transfers=transfers)
+    plan_bytes = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+
+    click.secho(f"{'Transfers':<24}{len(plan):>12}")
+    click.secho(f"{'Bytes per transfer':<24}{plan_bytes / len(plan):>12.0f}")
+    click.secho(f"{'Build time [us]':<24}{build_seconds / len(plan) * 1e6:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
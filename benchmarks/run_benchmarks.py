@@ -0,0 +1,268 @@
+import json
+import logging
+import os
+import platform
+import shutil
+import stat
+import statistics
+import sys
+import time
+from contextlib import contextmanager, nullcontext, redirect_stdout
+from dataclasses import asdict, dataclass
+from enum import StrEnum, auto
+from functools import partial
+from io import StringIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Callable, Iterator
+
+import click
+from click.testing import CliRunner
+
+from benchmarks.generate_dcim import generate_card, generate_timelapse_card, write_manifest
+from benchmarks.stub_exiftool import MANIFEST_ENVIRONMENT_VARIABLE
+from sd_copy.check import check_dcim_transfers
+from sd_copy.dcim_transfer import DEFAULT_BATCH_SIZE, MetadataBackend, get_dcim_transfers, get_media_files
+from sd_copy.files import get_files_not_sorted, get_rename_operations
+from sd_copy.main import main as sd_copy_main
+from sd_copy.sampling import get_sampled_dcim_transfers
+from sd_copy.timelapse import patch_dcim_transfers_for_timelapse
+
+BASELINE_PATH = Path(__file__).parent / "baseline.json"
+RESULTS_PATH = Path("benchmark_results.json")
+STUB_EXIFTOOL_PATH = Path(__file__).parent / "stub_exiftool.py"
+SAMPLE_INTERVAL = 25
+DEFAULT_TOLERANCE = 0.25  # relative slowdown of the minimum time that is reported as a regression
+
+
+class ExiftoolVariant(StrEnum):
+    stub = auto()  # answers from the generator's manifest, to measure orchestration overhead only
+    system = auto()  # the exiftool installed on this machine, to measure extraction as well
+
+
+@dataclass
+class BenchmarkResult:
+    repeats: int
+    min_seconds: float
+    median_seconds: float
+
+
+def time_function(function: Callable[[], object], repeats: int) -> BenchmarkResult:
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return BenchmarkResult(repeats=repeats, min_seconds=min(durations), median_seconds=statistics.median(durations))
+
+
+@contextmanager
+def working_directory(path: Path) -> Iterator[None]:
+    # The sorting check writes its report to the working directory
+    previous_working_directory = Path.cwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous_working_directory)
+
+
+@contextmanager
+def stub_exiftool_on_path(manifest_path: Path) -> Iterator[None]:
+    """Put an `exiftool` executable running the stub first on PATH, where sd-copy looks for exiftool"""
+    with TemporaryDirectory() as bin_dir:
+        executable = Path(bin_dir) / "exiftool"
+        executable.write_text(f'#!/bin/sh\nexec "{sys.executable}" "{STUB_EXIFTOOL_PATH}" "$@"\n')
+        os.chmod(executable, executable.stat().st_mode | stat.S_IEXEC)
+        environment = {
+            "PATH": f"{bin_dir}{os.pathsep}{os.environ['PATH']}",
+            MANIFEST_ENVIRONMENT_VARIABLE: str(manifest_path),
+        }
+        previous_environment = {name: os.environ.get(name) for name in environment}
+        os.environ.update(environment)
+        try:
+            yield
+        finally:
+            for name, value in previous_environment.items():
+                if value is None:
+                    os.environ.pop(name)
+                else:
+                    os.environ[name] = value
+
+
+def get_renamed_folders(n_folders: int) -> tuple[tuple[Path, ...], tuple[Path, ...]]:
+    # Every other folder of the synced library still has the name it had before being renamed in the source library
+    source_folders = tuple(
+        Path("src") / f"{2000 + i // 336}-{1 + i // 28 % 12:02d}-{1 + i % 28:02d} Trip {i}" for i in range(n_folders)
+    )
+    target_folders = tuple(
+        Path("dst") / (folder.name.split(" ")[0] if i % 2 else folder.name) for i, folder in enumerate(source_folders)
+    )
+    return source_folders, target_folders
+
+
+def run_benchmarks(
+    work_path: Path,
+    shots: int,
+    timelapse_frames: int,
+    image_size: int,
+    video_size: int,
+    folders: int,
+    jobs: int,
+    repeats: int,
+) -> dict[str, BenchmarkResult]:
+    card_path, timelapse_path, destination_path = work_path / "card", work_path / "timelapse", work_path / "library"
+    manifest = generate_card(path=card_path, n_shots=shots, image_size=image_size, video_size=video_size)
+    manifest |= generate_timelapse_card(path=timelapse_path, n_frames=timelapse_frames, image_size=image_size)
+    write_manifest(manifest, work_path / "manifest.json")
+    get_transfers = {
+        backend: lambda backend=backend, source_path=card_path: get_dcim_transfers(
+            source_path=source_path,
+            destination_path=destination_path,
+            time_offset=0,
+            jobs=jobs,
+            backend=backend,
+        )
+        for backend in MetadataBackend
+    }
+    dcim_transfers = get_transfers[MetadataBackend.native]()
+    timelapse_transfers = get_transfers[MetadataBackend.native](source_path=timelapse_path)
+    source_folders, target_folders = get_renamed_folders(n_folders=folders)
+
+    def sort():
+        shutil.rmtree(destination_path, ignore_errors=True)
+        destination_path.mkdir()
+        arguments = ("sort", str(card_path), str(destination_path), "--no-cache", "--jobs", str(jobs))
+        CliRunner().invoke(sd_copy_main, arguments, catch_exceptions=False)
+
+    benchmarks = {
+        "get_dcim_transfers[exiftool]": get_transfers[MetadataBackend.exiftool],
+        "get_dcim_transfers[native]": get_transfers[MetadataBackend.native],
+        "get_dcim_transfers[timelapse]": partial(
+            get_transfers[MetadataBackend.exiftool],
+            source_path=timelapse_path,
+        ),
+        "get_sampled_dcim_transfers[timelapse]": lambda: get_sampled_dcim_transfers(
+            source_path=timelapse_path,
+            destination_path=destination_path,
+            time_offset=0,
+            sample_interval=SAMPLE_INTERVAL,
+            batch_size=DEFAULT_BATCH_SIZE,
+            jobs=jobs,
+        ),
+        "check_dcim_transfers": lambda: check_dcim_transfers(dcim_transfers=dcim_transfers, timelapse=False),
+        "get_files_not_sorted": lambda: get_files_not_sorted(
+            files_to_check=get_media_files(source_path=card_path),
+            sorted_files=tuple(dcim_transfer.target_path for dcim_transfer in dcim_transfers),
+        ),
+        "get_rename_operations": lambda: get_rename_operations(
+            source_folders=source_folders,
+            target_folders=target_folders,
+        ),
+        "patch_dcim_transfers_for_timelapse": lambda: patch_dcim_transfers_for_timelapse(
+            dcim_transfers=timelapse_transfers,
+            dry_run=True,
+        ),
+        "sort": sort,
+    }
+    results = {}
+    for name, function in benchmarks.items():
+        with redirect_stdout(StringIO()):
+            results[name] = time_function(function, repeats=repeats)
+        click.secho(f"{name:<40}{results[name].min_seconds * 1000:>12.1f} ms")
+    return results
+
+
+def get_report(results: dict[str, BenchmarkResult], parameters: dict, exiftool: ExiftoolVariant) -> dict:
+    return {
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "exiftool": exiftool,
+        },
+        "parameters": parameters,
+        "benchmarks": {name: asdict(result) for name, result in results.items()},
+    }
+
+
+def compare_to_baseline(report: dict, baseline: dict, tolerance: float) -> bool:
+    """Print the minimum time of each benchmark relative to the baseline. Returns whether any benchmark got slower by
+    more than `tolerance`."""
+    if (report["parameters"], report["environment"]) != (baseline["parameters"], baseline["environment"]):
+        click.secho("[Note] ", fg="blue", nl=False)
+        click.secho("Parameters or environment differ from the baseline, results may not be comparable")
+    click.secho(f"{'Benchmark':<40}{'Baseline [ms]':>16}{'Current [ms]':>16}{'Ratio':>8}")
+    regressed = False
+    for name, result in report["benchmarks"].items():
+        if not (baseline_result := baseline["benchmarks"].get(name)):
+            click.secho(f"{name:<40}{'-':>16}{result['min_seconds'] * 1000:>16.1f}{'-':>8}")
+            continue
+        ratio = result["min_seconds"] / baseline_result["min_seconds"]
+        regressed |= (is_regression := ratio > 1 + tolerance)
+        click.secho(
+            f"{name:<40}{baseline_result['min_seconds'] * 1000:>16.1f}{result['min_seconds'] * 1000:>16.1f}"
+            f"{ratio:>8.2f}",
+            fg="red" if is_regression else None,
+        )
+    return regressed
+
+
+@click.command()
+@click.option("--shots", default=200, type=click.IntRange(min=2), help="Shots on the synthetic card")
+@click.option("--timelapse-frames", default=300, type=click.IntRange(min=2), help="Frames on the timelapse card")
+@click.option("--image-size", default=64 * 1024, type=click.IntRange(min=0), help="JPG size in bytes")
+@click.option("--video-size", default=512 * 1024, type=click.IntRange(min=0), help="Video size in bytes")
+@click.option("--folders", default=500, type=click.IntRange(min=1), help="Library folders for get_rename_operations")
+@click.option("--jobs", "-j", default=4, type=click.IntRange(min=1))
+@click.option("--repeats", default=5, type=click.IntRange(min=1))
+@click.option("--exiftool", default=ExiftoolVariant.stub, type=click.Choice(tuple(ExiftoolVariant)))
+@click.option("--output", default=RESULTS_PATH, type=click.Path(dir_okay=False, path_type=Path))
+@click.option("--baseline", default=BASELINE_PATH, type=click.Path(dir_okay=False, path_type=Path))
+@click.option("--save-baseline", default=False, is_flag=True, help="Store the results as the new baseline")
+@click.option("--tolerance", default=DEFAULT_TOLERANCE, type=click.FloatRange(min=0))
+def main(
+    shots: int,
+    timelapse_frames: int,
+    image_size: int,
+    video_size: int,
+    folders: int,
+    jobs: int,
+    repeats: int,
+    exiftool: ExiftoolVariant,
+    output: Path,
+    baseline: Path,
+    save_baseline: bool,
+    tolerance: float,
+):
+    """Time sd-copy on synthetic cards and compare against the stored baseline. Exits with an error if a benchmark
+    got slower than the baseline by more than the tolerance."""
+    # Keep the per-file log messages of `sort` out of the timings and the output
+    logging.basicConfig(level=logging.WARNING, handlers=(logging.NullHandler(),))
+    parameters = {
+        "shots": shots,
+        "timelapse_frames": timelapse_frames,
+        "image_size": image_size,
+        "video_size": video_size,
+        "folders": folders,
+        "jobs": jobs,
+        "repeats": repeats,
+    }
+    output = output.absolute()
+    with TemporaryDirectory() as work_dir, working_directory(Path(work_dir)):
+        # The manifest is only written once the cards are generated, before exiftool is first started
+        manifest_path = Path(work_dir) / "manifest.json"
+        with stub_exiftool_on_path(manifest_path) if exiftool == ExiftoolVariant.stub else nullcontext():
+            results = run_benchmarks(work_path=Path(work_dir), **parameters)
+
+    report = get_report(results, parameters=parameters, exiftool=exiftool)
+    output.write_text(json.dumps(report, indent=2))
+    if save_baseline:
+        baseline.write_text(json.dumps(report, indent=2))
+        click.secho(f"Baseline written to {baseline}", fg="green")
+    elif baseline.exists() and compare_to_baseline(report, json.loads(baseline.read_text()), tolerance=tolerance):
+        raise click.ClickException(f"Benchmarks regressed by more than {tolerance:.0%} against {baseline}")
+
+
+if __name__ == "__main__":
+    main()
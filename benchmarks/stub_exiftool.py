@@ -0,0 +1,45 @@
+"""Stand-in for `exiftool -stay_open True -@ -` that answers requests from the metadata manifest written by
+generate_dcim.py, without reading the media files. Timing sd-copy against the stub measures the orchestration
+overhead of metadata extraction, i.e. batching, the process pool and parsing of the JSON output, separately from the
+time exiftool itself takes."""
+
+import json
+import os
+import sys
+
+MANIFEST_ENVIRONMENT_VARIABLE = "SD_COPY_STUB_EXIFTOOL_MANIFEST"
+STUB_EXIFTOOL_VERSION = "0.00-stub"
+
+
+def get_files(args: list[str]) -> list[str]:
+    return [
+        arg for i, arg in enumerate(args) if not arg.startswith("-") and args[i - 1] not in ("-echo4", "-stay_open")
+    ]
+
+
+def main():
+    with open(os.environ[MANIFEST_ENVIRONMENT_VARIABLE]) as f:
+        manifest = json.load(f)
+
+    args = []
+    for line in sys.stdin:
+        arg = line.rstrip("\n")
+        if arg == "False" and args[-1:] == ["-stay_open"]:
+            break
+        if not arg.startswith("-execute"):
+            args.append(arg)
+            continue
+        if "-ver" in args:
+            print(STUB_EXIFTOOL_VERSION)
+        elif found := [file for file in get_files(args) if os.path.abspath(file) in manifest]:
+            print(json.dumps([manifest[os.path.abspath(file)] | {"SourceFile": file} for file in found]))
+        for file in get_files(args):
+            if os.path.abspath(file) not in manifest:
+                print(f"Error: File not found - {file}", file=sys.stderr)
+        print(args[args.index("-echo4") + 1], file=sys.stderr, flush=True)
+        print("{ready" + arg[len("-execute") :] + "}", flush=True)
+        args = []
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import astuple, dataclass
+from pathlib import Path
+from typing import Mapping, Optional, Sequence
+
+CACHE_DIR = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "sd-copy"
+METADATA_CACHE_PATH = CACHE_DIR / "metadata.sqlite"
+METADATA_CACHE_MAX_ENTRIES = 200_000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS metadata (
+    device INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    extractor TEXT NOT NULL,
+    metadata TEXT NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (device, inode, size, mtime_ns, extractor)
+);
+CREATE INDEX IF NOT EXISTS metadata_last_used ON metadata (last_used);
+"""
+
+
+@dataclass(frozen=True)
+class FileIdentity:
+    device: int
+    inode: int
+    size: int
+    mtime_ns: int
+
+
+def get_file_identity(path: Path) -> FileIdentity:
+    stat = path.stat()
+    return FileIdentity(device=stat.st_dev, inode=stat.st_ino, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+
+
+class MetadataCache:
+    """Persistent cache of extracted metadata. Entries are keyed on file identity (device, inode, size and
+    modification time) and on the extractor, e.g. `exiftool-12.76`, so that entries are invalidated when either the
+    file or the extracting tool changes. Least recently used entries are evicted beyond `max_entries`. The extractor
+    may be omitted when the cache is only opened for maintenance."""
+
+    def __init__(
+        self,
+        extractor: Optional[str] = None,
+        path: Path = METADATA_CACHE_PATH,
+        max_entries: int = METADATA_CACHE_MAX_ENTRIES,
+    ):
+        self.extractor = extractor
+        self.max_entries = max_entries
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(SCHEMA)
+
+    def get_many(self, paths: Sequence[Path]) -> dict[Path, dict]:
+        """Cached metadata of those of `paths` that are cached. Their use is recorded in a single transaction, which
+        is committed right away, so that other processes sharing the cache aren't blocked from writing to it."""
+        keys = {path: (*astuple(get_file_identity(path)), self.extractor) for path in paths}
+        metadata = {}
+        with self._lock:
+            for path, key in keys.items():
+                row = self._connection.execute(
+                    "SELECT metadata FROM metadata "
+                    "WHERE device = ? AND inode = ? AND size = ? AND mtime_ns = ? AND extractor = ?",
+                    key,
+                ).fetchone()
+                if row:
+                    metadata[path] = json.loads(row[0])
+            last_used = time.time()
+            self._connection.executemany(
+                "UPDATE metadata SET last_used = ? "
+                "WHERE device = ? AND inode = ? AND size = ? AND mtime_ns = ? AND extractor = ?",
+                ((last_used, *keys[path]) for path in metadata),
+            )
+            self._connection.commit()
+        return metadata
+
+    def get(self, path: Path) -> Optional[dict]:
+        return self.get_many((path,)).get(path)
+
+    def put_many(self, metadata: Mapping[Path, dict]):
+        rows = tuple(
+            (*astuple(get_file_identity(path)), self.extractor, json.dumps(data), time.time())
+            for path, data in metadata.items()
+        )
+        with self._lock:
+            self._connection.executemany("INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self._connection.commit()
+
+    def put(self, path: Path, metadata: dict):
+        self.put_many({path: metadata})
+
+    def prune(self, max_entries: Optional[int] = None) -> int:
+        with self._lock:
+            cursor = self._connection.execute(
+                "DELETE FROM metadata WHERE rowid NOT IN (SELECT rowid FROM metadata ORDER BY last_used DESC LIMIT ?)",
+                (self.max_entries if max_entries is None else max_entries,),
+            )
+            self._connection.commit()
+        return cursor.rowcount
+
+    def close(self):
+        self.prune()
+        self._connection.close()
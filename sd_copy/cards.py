@@ -0,0 +1,253 @@
+import logging
+from dataclasses import dataclass, replace
+from functools import partial
+from pathlib import Path
+from typing import Callable, Collection, Optional, Sequence
+
+import click
+
+from sd_copy.cache import MetadataCache
+from sd_copy.check import SORTING_REPORT_PATH, check_dcim_transfers
+from sd_copy.copy_engine import copy_dcim_transfers
+from sd_copy.dcim_transfer import DCIMTransfer, MetadataBackend, get_dcim_transfers
+from sd_copy.devices import get_default_jobs
+from sd_copy.hashing import HashAlgorithm, get_file_checksum
+from sd_copy.journal import TransferJournal, get_pending_dcim_transfers
+from sd_copy.library import LibraryIndex, deduplicate_dcim_transfers
+from sd_copy.sampling import get_sampled_dcim_transfers
+from sd_copy.timelapse import ProxySettings, patch_dcim_transfers_for_timelapse, patch_dcim_transfers_for_timelapses
+from sd_copy.utils import (
+    CopyError,
+    ExiftoolError,
+    NonSingleValueError,
+    TimestampConsistencyError,
+    UnexpectedDataError,
+    parallel_map,
+)
+
+# Errors that fail a single card, while the other cards are still sorted
+CARD_ERRORS = (UnexpectedDataError, TimestampConsistencyError, NonSingleValueError, ExiftoolError, CopyError, OSError)
+
+
+@dataclass(frozen=True)
+class CardResult:
+    source_path: Path
+    dcim_transfers: Sequence[DCIMTransfer] = ()
+    n_copied: int = 0
+    n_duplicates: int = 0  # files already in the library, or identical to a file on another card
+    collisions: Sequence[DCIMTransfer] = ()
+    error: Optional[str] = None
+
+
+def get_card_sorting_report_path(card_number: int) -> Path:
+    return SORTING_REPORT_PATH.with_stem(f"{SORTING_REPORT_PATH.stem}_card{card_number}")
+
+
+def get_error_message(error: Exception) -> str:
+    return f"{type(error).__name__}: {error}"
+
+
+def plan_cards(
+    source_paths: Sequence[Path],
+    plan: Callable[[Path, Path], Sequence[DCIMTransfer]],
+) -> Sequence[CardResult]:
+    """Plan the transfers of all cards concurrently, calling `plan` with the source path and the path for the
+    sorting report of each card. A card whose planning fails is not copied, without affecting the other cards."""
+
+    def plan_card(numbered_source_path: tuple[int, Path]) -> CardResult:
+        card_number, source_path = numbered_source_path
+        try:
+            return CardResult(
+                source_path=source_path,
+                dcim_transfers=plan(source_path, get_card_sorting_report_path(card_number)),
+            )
+        except CARD_ERRORS as e:
+            logging.error(f"Could not plan transfers of {source_path}: {e}")
+            return CardResult(source_path=source_path, error=get_error_message(e))
+
+    return tuple(parallel_map(plan_card, enumerate(source_paths, start=1), jobs=len(source_paths)))
+
+
+def plan_dcim_transfers(
+    src: Path,
+    dst: Path,
+    time_offset: int,
+    timelapse: bool,
+    dry_run: bool,
+    batch_size: int,
+    cache: Optional[MetadataCache],
+    jobs: Optional[int],
+    metadata_backend: MetadataBackend,
+    journal: Optional[TransferJournal] = None,
+    report_path: Path = SORTING_REPORT_PATH,
+    proxy_settings: ProxySettings = ProxySettings(),
+    split_timelapses: bool = False,
+    sample_interval: Optional[int] = None,
+) -> Sequence[DCIMTransfer]:
+    """Transfers of a single card that pass the sorting check. Transfers the `journal` records as complete are left
+    out, when resuming. With `split_timelapses`, the card may hold several timelapses besides other files. With a
+    `sample_interval`, metadata of timelapse images is only extracted for samples."""
+    extract = (
+        partial(get_sampled_dcim_transfers, sample_interval=sample_interval) if sample_interval else get_dcim_transfers
+    )
+    dcim_transfers = extract(
+        source_path=src,
+        destination_path=dst,
+        time_offset=time_offset,
+        batch_size=batch_size,
+        cache=cache,
+        jobs=jobs or get_default_jobs(src),
+        backend=metadata_backend,
+    )
+
+    if split_timelapses:
+        dcim_transfers = patch_dcim_transfers_for_timelapses(
+            dcim_transfers=dcim_transfers,
+            dry_run=dry_run,
+            proxy_settings=proxy_settings,
+        )
+    elif timelapse:
+        dcim_transfers = patch_dcim_transfers_for_timelapse(
+            dcim_transfers=dcim_transfers,
+            dry_run=dry_run,
+            proxy_settings=proxy_settings,
+        )
+
+    check_dcim_transfers(
+        dcim_transfers=dcim_transfers,
+        timelapse=timelapse or split_timelapses,
+        report_path=report_path,
+    )
+
+    if journal:
+        dcim_transfers = get_pending_dcim_transfers(dcim_transfers=dcim_transfers, journal=journal)
+    return dcim_transfers
+
+
+def have_same_content(dcim_transfers: Sequence[DCIMTransfer], algorithm: HashAlgorithm) -> bool:
+    if len({dcim_transfer.source_path.stat().st_size for dcim_transfer in dcim_transfers}) > 1:
+        return False
+    return len({get_file_checksum(dcim_transfer.source_path, algorithm) for dcim_transfer in dcim_transfers}) == 1
+
+
+def resolve_cross_card_targets(card_results: Sequence[CardResult], algorithm: HashAlgorithm) -> Sequence[CardResult]:
+    """Transfers of different cards with the same target are copied only once if their sources have the same content,
+    e.g. for a card and a backup of it. Otherwise, none of them is copied, and they are reported as collisions of
+    their cards."""
+    transfers_by_target: dict[Path, list[tuple[int, DCIMTransfer]]] = {}
+    for card_index, card_result in enumerate(card_results):
+        for dcim_transfer in card_result.dcim_transfers:
+            transfers_by_target.setdefault(dcim_transfer.target_path, []).append((card_index, dcim_transfer))
+
+    removed_transfers, duplicates, collisions = set(), {}, {}
+    for target_path, indexed_transfers in transfers_by_target.items():
+        if len({card_index for card_index, _ in indexed_transfers}) < 2:
+            continue
+        dcim_transfers = tuple(dcim_transfer for _, dcim_transfer in indexed_transfers)
+        if have_same_content(dcim_transfers, algorithm=algorithm):
+            logging.info(f"Copying {target_path} from {dcim_transfers[0].source_path} only, identical on other cards")
+            for card_index, dcim_transfer in indexed_transfers[1:]:
+                duplicates[card_index] = duplicates.get(card_index, 0) + 1
+                removed_transfers.add(id(dcim_transfer))
+            continue
+        logging.warning(
+            f"Not copying {target_path}, different files on several cards have this target: "
+            + ", ".join(str(dcim_transfer.source_path) for dcim_transfer in dcim_transfers),
+        )
+        for card_index, dcim_transfer in indexed_transfers:
+            collisions.setdefault(card_index, []).append(dcim_transfer)
+            removed_transfers.add(id(dcim_transfer))
+
+    return tuple(
+        replace(
+            card_result,
+            dcim_transfers=tuple(
+                dcim_transfer
+                for dcim_transfer in card_result.dcim_transfers
+                if id(dcim_transfer) not in removed_transfers
+            ),
+            n_duplicates=card_result.n_duplicates + duplicates.get(card_index, 0),
+            collisions=(*card_result.collisions, *collisions.get(card_index, ())),
+        )
+        for card_index, card_result in enumerate(card_results)
+    )
+
+
+def copy_cards(
+    card_results: Sequence[CardResult],
+    skip_checksum: bool,
+    skip_verify: bool,
+    delete: bool,
+    algorithm: HashAlgorithm,
+    jobs: int,
+    journal: TransferJournal,
+    library: LibraryIndex,
+    resumed_target_paths: Collection[str] = (),
+) -> Sequence[CardResult]:
+    """Cards are copied concurrently, each with up to `jobs` transfers in flight, so that every slot of a multi-card
+    reader is kept busy. A CopyError only stops the transfers of its own card."""
+
+    def copy_card(card_result: CardResult) -> CardResult:
+        if card_result.error:
+            return card_result
+        try:
+            dcim_transfers, collisions = deduplicate_dcim_transfers(
+                dcim_transfers=card_result.dcim_transfers,
+                library=library,
+                algorithm=algorithm,
+                resumed_target_paths=resumed_target_paths,
+            )
+            journal.plan(dcim_transfers=dcim_transfers)
+            copied_dcim_transfers = copy_dcim_transfers(
+                dcim_transfers=dcim_transfers,
+                skip_checksum=skip_checksum,
+                skip_verify=skip_verify,
+                delete=delete,
+                algorithm=algorithm,
+                jobs=jobs,
+                journal=journal,
+                library=library,
+            )
+        except CARD_ERRORS as e:
+            logging.error(f"Could not copy {card_result.source_path}: {e}")
+            return replace(card_result, error=get_error_message(e))
+        n_duplicates = len(card_result.dcim_transfers) - len(dcim_transfers) - len(collisions)
+        return replace(
+            card_result,
+            n_copied=len(copied_dcim_transfers),
+            n_duplicates=card_result.n_duplicates + n_duplicates,
+            collisions=(*card_result.collisions, *collisions),
+        )
+
+    return tuple(parallel_map(copy_card, card_results, jobs=len(card_results)))
+
+
+def print_card_results(card_results: Sequence[CardResult], dry_run: bool):
+    for card_result in card_results:
+        click.secho(f"{card_result.source_path}: ", nl=False)
+        if card_result.error:
+            click.secho(f"Failed, {card_result.error}", fg="red")
+            continue
+        click.secho(
+            f"{len(card_result.dcim_transfers)} files planned" if dry_run else f"{card_result.n_copied} files copied",
+            fg="green",
+            nl=False,
+        )
+        if card_result.n_duplicates:
+            click.secho(f", {card_result.n_duplicates} skipped as already in the library or on another card", nl=False)
+        if card_result.collisions:
+            click.secho(f", {len(card_result.collisions)} not copied as their targets collide", fg="red", nl=False)
+        click.secho("")
+
+
+def check_card_results(card_results: Sequence[CardResult]):
+    if failed_card_results := tuple(card_result for card_result in card_results if card_result.error):
+        raise CopyError(
+            f"{len(failed_card_results)} of {len(card_results)} cards failed: "
+            + ", ".join(str(card_result.source_path) for card_result in failed_card_results),
+        )
+    if collisions := tuple(dcim_transfer for card_result in card_results for dcim_transfer in card_result.collisions):
+        raise CopyError(
+            f"{len(collisions)} files not copied, as other files with the same target exist: "
+            + ", ".join(str(dcim_transfer.source_path) for dcim_transfer in collisions),
+        )
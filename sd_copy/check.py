@@ -1,12 +1,16 @@
-import itertools
 import json
+import textwrap
 from operator import attrgetter
 from pathlib import Path
-from typing import Callable, Optional, Sequence
+from typing import Callable, Optional, Sequence, TextIO
 
 from sd_copy.dcim_transfer import DCIMTransfer, Extension
+from sd_copy.stats import Stage, stage
 from sd_copy.utils import TimestampConsistencyError
 
+IMAGE_EXTENSIONS = (Extension.jpg, Extension.raf, Extension.dng)
+SORTING_REPORT_PATH = Path("sorting_violations.json")
+
 
 def sort_dcim_transfers(
     dcim_transfers: Sequence[DCIMTransfer],
@@ -21,36 +25,77 @@ def sort_dcim_transfers(
     )
 
 
-def write_json_to_file(dcim_transfers: Sequence[DCIMTransfer], file_name: str):
-    Path(f"{file_name}.json").write_text(
-        json.dumps(
-            tuple(
-                {
-                    "file": str(dcim_transfer.source_path),
-                    "target": dcim_transfer.target_path.name,
-                    "rectified_timestamp": str(dcim_transfer.rectified_modify_date),
-                }
-                for dcim_transfer in dcim_transfers
-            ),
-            indent=2,
-        ),
-    )
+def get_report_entry(dcim_transfer: DCIMTransfer) -> dict:
+    return {
+        "file": str(dcim_transfer.source_path),
+        "target": dcim_transfer.target_path.name,
+        "rectified_timestamp": str(dcim_transfer.rectified_modify_date),
+    }
+
+
+class SortingReport:
+    """JSON report of out-of-order pairs, written as violations are found. The file is only created for the first
+    violation."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.n_violations = 0
+        self._file: Optional[TextIO] = None
 
+    def add(self, previous: DCIMTransfer, current: DCIMTransfer):
+        if self._file is None:
+            self._file = self.path.open(mode="w")
+            self._file.write("[\n")
+        else:
+            self._file.write(",\n")
+        entry = {"previous": get_report_entry(previous), "current": get_report_entry(current)}
+        self._file.write(textwrap.indent(json.dumps(entry, indent=2), prefix="  "))
+        self.n_violations += 1
 
-def check_target_sorting_matches_source(dcim_transfers: Sequence[DCIMTransfer], exclude: Optional[Sequence[Extension]]):
-    sorted_by_source = sort_dcim_transfers(dcim_transfers, sort_key=attrgetter("source_path"), exclude=exclude)
-    sorted_by_target = sort_dcim_transfers(dcim_transfers, sort_key=attrgetter("target_path"), exclude=exclude)
+    def close(self):
+        if self._file is not None:
+            self._file.write("\n]\n")
+            self._file.close()
 
-    if sorted_by_source != sorted_by_target:
-        write_json_to_file(sorted_by_target, "sorted_by_target")
-        write_json_to_file(sorted_by_source, "sorted_by_source")
-        raise TimestampConsistencyError(
-            "Unexpected changes in sorting between source and target, likely due to incorrect timestamp. "
-            "Output written to 'sorted_by_source.json' and 'sorted_by_target.json'",
-        )
 
+class SortingCheck:
+    """Check that targets maintain the sorting of their sources, for transfers added in order of their source path.
+    Each image extension is checked as a group together with all other files, and the last target of each group is
+    kept, so that a single pass finds every adjacent pair of transfers whose targets are out of order."""
 
-def check_dcim_transfers(dcim_transfers: Sequence[DCIMTransfer], timelapse: bool):
+    def __init__(self, timelapse: bool, report_path: Path = SORTING_REPORT_PATH):
+        self.excluded_extensions = (Extension.mp4, Extension.mov) if timelapse else ()
+        self.report = SortingReport(path=report_path)
+        self._last_transfers: dict[Extension, DCIMTransfer] = {}
+
+    def add(self, dcim_transfer: DCIMTransfer):
+        with stage(Stage.check, file=dcim_transfer.source_path):
+            extension = dcim_transfer.metadata.extension
+            if extension in self.excluded_extensions:
+                return
+            groups = (extension,) if extension in IMAGE_EXTENSIONS else IMAGE_EXTENSIONS
+            reported = set()
+            for group in groups:
+                previous = self._last_transfers.get(group)
+                if previous and dcim_transfer.target_path < previous.target_path and id(previous) not in reported:
+                    self.report.add(previous=previous, current=dcim_transfer)
+                    reported.add(id(previous))
+                self._last_transfers[group] = dcim_transfer
+
+    def close(self):
+        self.report.close()
+        if self.report.n_violations:
+            raise TimestampConsistencyError(
+                f"Unexpected changes in sorting between source and target for {self.report.n_violations} pairs of "
+                f"files, likely due to incorrect timestamp. Output written to '{self.report.path}'",
+            )
+
+
+def check_dcim_transfers(
+    dcim_transfers: Sequence[DCIMTransfer],
+    timelapse: bool,
+    report_path: Path = SORTING_REPORT_PATH,
+):
     """Assert that copied files maintain the sorting of the source files. Either raw or compressed images need to
     be excluded, as cameras can create them at the same time using the same filename. Depending on metadata included
     in the target filename, this can lead to changes in the sorting:
@@ -67,8 +112,7 @@ def check_dcim_transfers(dcim_transfers: Sequence[DCIMTransfer], timelapse: bool
 
     In case the sorting does not match the source, this may point to camera recording errors, or issues
     with this program!"""
-    for image_extenions in itertools.combinations((Extension.jpg, Extension.raf, Extension.dng), 2):
-        check_target_sorting_matches_source(
-            dcim_transfers=dcim_transfers,
-            exclude=(*image_extenions, *((Extension.mp4, Extension.mov) if timelapse else ())),
-        )
+    sorting_check = SortingCheck(timelapse=timelapse, report_path=report_path)
+    for dcim_transfer in sort_dcim_transfers(dcim_transfers, sort_key=attrgetter("source_path")):
+        sorting_check.add(dcim_transfer)
+    sorting_check.close()
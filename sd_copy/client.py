@@ -0,0 +1,81 @@
+import json
+import os
+import socket
+import struct
+import sys
+import tempfile
+from pathlib import Path
+from typing import Optional, Sequence
+
+# Only the standard library is imported here, so that commands sent to a running daemon start quickly
+SOCKET_FILE_NAME = "sd-copy.sock"
+# The temporary directory is shared with other users, so the socket is put in a directory only the user can access
+SOCKET_PATH = Path(
+    os.environ.get("SD_COPY_SOCKET")
+    or (
+        Path(os.environ["XDG_RUNTIME_DIR"]) / SOCKET_FILE_NAME
+        if os.environ.get("XDG_RUNTIME_DIR")
+        else Path(tempfile.gettempdir()) / f"sd-copy-{os.getuid()}" / SOCKET_FILE_NAME
+    ),
+)
+IN_PROCESS_COMMANDS = ("serve",)
+PEER_CREDENTIALS = struct.Struct("3i")  # pid, uid and gid, as returned for SO_PEERCRED
+
+
+def get_peer_uid(connection: socket.socket) -> Optional[int]:
+    """User id of the process at the other end of a Unix domain socket, if the platform reports it"""
+    if not hasattr(socket, "SO_PEERCRED"):
+        return None
+    _, uid, _ = PEER_CREDENTIALS.unpack(
+        connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, PEER_CREDENTIALS.size),
+    )
+    return uid
+
+
+def is_own_process(connection: socket.socket) -> bool:
+    return get_peer_uid(connection) in (None, os.getuid())
+
+
+def run_on_daemon(args: Sequence[str], socket_path: Path = SOCKET_PATH) -> Optional[int]:
+    """Run a command on the daemon listening on `socket_path`, and print its output as it arrives. Returns the exit
+    code of the command, or None if no daemon of this user is running."""
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(str(socket_path))
+    except (FileNotFoundError, ConnectionRefusedError):
+        connection.close()
+        return None
+    if not is_own_process(connection):
+        connection.close()
+        print(f"Warning: Not using {socket_path}, which is served by another user", file=sys.stderr)
+        return None
+
+    outputs = {"stdout": sys.stdout, "stderr": sys.stderr}
+    with connection, connection.makefile(mode="rwb") as stream:
+        request = {"args": list(args), "cwd": os.getcwd(), "color": sys.stdout.isatty()}
+        stream.write(json.dumps(request).encode() + b"\n")
+        stream.flush()
+        for line in stream:
+            message = json.loads(line)
+            if "exit_code" in message:
+                return message["exit_code"]
+            outputs[message["stream"]].write(message["data"])
+            outputs[message["stream"]].flush()
+    print("Error: Connection to the sd-copy daemon was lost", file=sys.stderr)
+    return 1
+
+
+def main():
+    """Entry point of the `sd-copy` command. Commands run on the daemon started with `sd-copy serve` if there is one,
+    with its exiftool workers already running, and in this process otherwise."""
+    args = sys.argv[1:]
+    if not set(args[:1]) & set(IN_PROCESS_COMMANDS) and (exit_code := run_on_daemon(args)) is not None:
+        sys.exit(exit_code)
+
+    from sd_copy.main import main as sd_copy_main
+
+    sd_copy_main()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+import threading
+from typing import Iterable, Iterator, Optional, Sequence, Sized
+
+import click
+
+from sd_copy.check import SortingCheck
+from sd_copy.dcim_transfer import DCIMTransfer
+from sd_copy.devices import order_by_device, scheduler
+from sd_copy.files import (
+    copy_media_to_target,
+    copy_media_to_target_with_checksum,
+    remove_source_file,
+    update_file_modify_date,
+)
+from sd_copy.hashing import HashAlgorithm, get_file_checksum
+from sd_copy.journal import TransferJournal, TransferState, is_transfer_complete
+from sd_copy.library import LibraryIndex, TargetState, get_target_state
+from sd_copy.stats import Stage, stage
+from sd_copy.utils import CopyError, parallel_map
+
+DEFAULT_COPY_JOBS = 2  # one transfer can read from the card while another one is written or hashed
+
+_output_lock = threading.Lock()
+
+
+def copy_dcim_transfer(
+    dcim_transfer: DCIMTransfer,
+    skip_checksum: bool,
+    skip_verify: bool,
+    delete: bool,
+    algorithm: HashAlgorithm,
+    progress: str,
+    journal: Optional[TransferJournal] = None,
+    library: Optional[LibraryIndex] = None,
+) -> DCIMTransfer:
+    """By default, the source checksum is computed while copying, and the target is read once more for verification.
+    With `skip_verify`, the target is not read again, and with `skip_checksum` no checksums are computed at all. The
+    copy holds both the source and the target device, while verification only holds the target device."""
+    with (
+        scheduler.acquire(dcim_transfer.source_path, dcim_transfer.target_path),
+        stage(Stage.copy, n_bytes=dcim_transfer.source_path.stat().st_size, file=dcim_transfer.source_path),
+    ):
+        if skip_checksum:
+            copy_method = copy_media_to_target(
+                source_path=dcim_transfer.source_path,
+                target_path=dcim_transfer.target_path,
+            )
+        else:
+            source_checksum, copy_method = copy_media_to_target_with_checksum(
+                source_path=dcim_transfer.source_path,
+                target_path=dcim_transfer.target_path,
+                algorithm=algorithm,
+            )
+    update_file_modify_date(
+        file_path=dcim_transfer.target_path,
+        rectified_modify_date=dcim_transfer.rectified_modify_date,
+    )
+    if journal:
+        journal.record(
+            dcim_transfer,
+            state=TransferState.copied,
+            checksum=None if skip_checksum else source_checksum,
+            algorithm=None if skip_checksum else algorithm,
+        )
+    verify = not skip_checksum and not skip_verify
+    if verify and source_checksum != get_file_checksum(file=dcim_transfer.target_path, algorithm=algorithm):
+        raise CopyError(f"Target checksum does not match source checksum for {dcim_transfer.source_path.name}")
+    if journal and verify:
+        journal.record(dcim_transfer, state=TransferState.verified, checksum=source_checksum, algorithm=algorithm)
+    if library:
+        library.add(
+            dcim_transfer.target_path,
+            checksum=None if skip_checksum else source_checksum,
+            algorithm=None if skip_checksum else algorithm,
+        )
+    if delete:
+        remove_source_file(source_path=dcim_transfer.source_path)
+
+    # Print complete lines only, so that output of concurrent transfers doesn't interleave
+    with _output_lock:
+        click.secho(f"{progress} Copying {dcim_transfer.source_path} to {dcim_transfer.target_path} ... ", nl=False)
+        click.secho("OK", fg="green", nl=False)
+        click.secho(f" ({copy_method})", nl=False)
+        click.secho("  Checksum ... ", nl=False)
+        click.secho("OK" if verify else "Skipped", fg="green")
+    return dcim_transfer
+
+
+def copy_dcim_transfers(
+    dcim_transfers: Iterable[DCIMTransfer],
+    skip_checksum: bool,
+    skip_verify: bool,
+    delete: bool,
+    algorithm: HashAlgorithm,
+    jobs: int,
+    journal: Optional[TransferJournal] = None,
+    library: Optional[LibraryIndex] = None,
+) -> Sequence[DCIMTransfer]:
+    """Copy with up to `jobs` transfers in flight. On a CopyError, transfers that have not yet started are cancelled
+    and running transfers are completed before the error is raised. Progress is recorded in the `journal` and copied
+    targets are added to the `library` index, if given. Transfers may be streamed, in which case copying starts with
+    the first transfer yielded. Otherwise, transfers are ordered for sequential reads from each source device."""
+    if isinstance(dcim_transfers, Sized):
+        dcim_transfers = order_by_device(dcim_transfers, get_path=lambda dcim_transfer: dcim_transfer.source_path)
+    n_transfers = len(dcim_transfers) if isinstance(dcim_transfers, Sized) else "?"
+    return tuple(
+        parallel_map(
+            lambda indexed_transfer: copy_dcim_transfer(
+                dcim_transfer=indexed_transfer[1],
+                skip_checksum=skip_checksum,
+                skip_verify=skip_verify,
+                delete=delete,
+                algorithm=algorithm,
+                progress=f"[{indexed_transfer[0]}/{n_transfers}]",
+                journal=journal,
+                library=library,
+            ),
+            enumerate(dcim_transfers, start=1),
+            jobs=jobs,
+        ),
+    )
+
+
+def stream_dcim_transfers(
+    dcim_transfers: Iterable[DCIMTransfer],
+    skip_checksum: bool,
+    skip_verify: bool,
+    delete: bool,
+    algorithm: HashAlgorithm,
+    jobs: int,
+    journal: TransferJournal,
+    library: LibraryIndex,
+    resume: bool,
+) -> Sequence[DCIMTransfer]:
+    """Copy transfers as they are yielded, e.g. while metadata of later files is still being extracted. Transfers need
+    to be yielded in order of their source path. The sorting check runs incrementally alongside, and acts as a gate
+    once all transfers are copied: source files are only deleted if it passes. Returns transfers not copied because
+    their target exists with different content."""
+    sorting_check = SortingCheck(timelapse=False)
+    journal_entries = journal.load() if resume else {}
+    resumed_target_paths = {entry.target_path for entry in journal_entries.values()}
+    journal.start(dcim_transfers=(), resume=resume)
+    collisions = []
+
+    def iter_dcim_transfers_to_copy() -> Iterator[DCIMTransfer]:
+        for dcim_transfer in dcim_transfers:
+            sorting_check.add(dcim_transfer)
+            journal_entry = journal_entries.get(str(dcim_transfer.source_path))
+            if resume and is_transfer_complete(dcim_transfer, entry=journal_entry):
+                continue
+            target_state = get_target_state(dcim_transfer, library, algorithm, resumed_target_paths)
+            if target_state == TargetState.collision:
+                collisions.append(dcim_transfer)
+            if target_state == TargetState.new:
+                journal.record(dcim_transfer, state=TransferState.planned)
+                yield dcim_transfer
+
+    copied_dcim_transfers = copy_dcim_transfers(
+        dcim_transfers=iter_dcim_transfers_to_copy(),
+        skip_checksum=skip_checksum,
+        skip_verify=skip_verify,
+        delete=False,
+        algorithm=algorithm,
+        jobs=jobs,
+        journal=journal,
+        library=library,
+    )
+    sorting_check.close()
+    if delete:
+        for dcim_transfer in copied_dcim_transfers:
+            remove_source_file(source_path=dcim_transfer.source_path)
+    return tuple(collisions)
@@ -0,0 +1,219 @@
+import io
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import stat
+import threading
+import traceback
+from contextlib import contextmanager, redirect_stderr, redirect_stdout
+from pathlib import Path
+from typing import Callable, Hashable, Iterator, Optional, Sequence, T
+
+import click
+
+from sd_copy.client import IN_PROCESS_COMMANDS, is_own_process
+from sd_copy.stats import stats, tracer
+
+# Metadata caches and library indexes kept open between commands while serving, keyed by their database file, with the
+# identity of that file when they were opened. None if not serving.
+_open_databases: Optional[dict[tuple, tuple[object, Optional[tuple[int, int]]]]] = None
+
+
+class ClientStream(io.RawIOBase):
+    """Output of a command, sent to the client as JSON lines tagged with the name of the stream"""
+
+    def __init__(self, connection: socket.socket, name: str, lock: threading.Lock):
+        super().__init__()
+        self.connection = connection
+        self.name = name
+        self._lock = lock
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: bytes) -> int:
+        message = {"stream": self.name, "data": bytes(data).decode(errors="replace")}
+        with self._lock:
+            self.connection.sendall(json.dumps(message).encode() + b"\n")
+        return len(data)
+
+
+def get_client_stream(connection: socket.socket, name: str, lock: threading.Lock) -> io.TextIOWrapper:
+    return io.TextIOWrapper(ClientStream(connection, name=name, lock=lock), write_through=True, line_buffering=True)
+
+
+@contextmanager
+def working_directory(path: Path) -> Iterator[None]:
+    previous_working_directory = Path.cwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous_working_directory)
+
+
+def get_file_id(path: Path) -> Optional[tuple[int, int]]:
+    try:
+        file_stat = path.stat()
+    except FileNotFoundError:
+        return None
+    return file_stat.st_dev, file_stat.st_ino
+
+
+@contextmanager
+def open_database(open_: Callable[[], T], path: Path, *key: Hashable) -> Iterator[T]:
+    """Database opened by `open_`, stored at `path`, which is closed on exit. While serving, it is kept open for later
+    commands with the same `path` and `key` instead, unless the file at `path` was replaced, e.g. as DST was recreated,
+    or a command using it failed."""
+    if _open_databases is None:
+        database = open_()
+        try:
+            yield database
+        finally:
+            database.close()
+        return
+
+    database_key = (path.absolute(), *key)
+    database, file_id = _open_databases.pop(database_key, (None, None))
+    if database is not None and get_file_id(path) != file_id:
+        database.close()
+        database = None
+    if database is None:
+        database = open_()
+        file_id = get_file_id(path)
+    try:
+        yield database
+    except BaseException:
+        # Rolls back any transaction the command left open
+        database.close()
+        raise
+    _open_databases[database_key] = (database, file_id)
+
+
+def close_databases():
+    global _open_databases
+    for database, _ in (_open_databases or {}).values():
+        database.close()
+    _open_databases = None
+
+
+def reset_logging():
+    # Commands configure logging via basicConfig, which is a no-op if the root logger already has handlers, e.g. ones
+    # writing to the stderr of a previous client
+    root_logger = logging.getLogger()
+    for handler in root_logger.handlers[:]:
+        root_logger.removeHandler(handler)
+        handler.close()
+    root_logger.setLevel(logging.WARNING)
+
+
+def run_command(command: click.Command, args: Sequence[str], color: bool) -> int:
+    """Run `command` as the `sd-copy` executable would, printing errors to stderr. Returns the exit code."""
+    if args[:1] and args[0] in IN_PROCESS_COMMANDS:
+        click.secho(f"Error: {args[0]} can't be run on the daemon", err=True)
+        return 2
+    try:
+        command.main(args=list(args), prog_name="sd-copy", standalone_mode=False, color=color)
+    except click.exceptions.Exit as e:
+        return e.exit_code
+    except click.ClickException as e:
+        e.show()
+        return e.exit_code
+    except click.Abort:
+        click.secho("Aborted!", err=True)
+        return 1
+    except Exception:
+        traceback.print_exc()
+        return 1
+    finally:
+        stats.enabled = False
+        tracer.enabled = False
+    return 0
+
+
+class CommandHandler(socketserver.StreamRequestHandler):
+    """Runs the command of a single client. Commands run one at a time, since the working directory, the standard
+    streams and logging are shared by the whole process."""
+
+    server: "CommandServer"
+
+    def handle(self):
+        if not is_own_process(self.connection):
+            logging.warning("Refused a client of another user")
+            return
+        request = json.loads(self.rfile.readline())
+        output_lock = threading.Lock()
+        stdout = get_client_stream(self.connection, name="stdout", lock=output_lock)
+        stderr = get_client_stream(self.connection, name="stderr", lock=output_lock)
+        with self.server.command_lock:
+            reset_logging()
+            try:
+                with working_directory(Path(request["cwd"])), redirect_stdout(stdout), redirect_stderr(stderr):
+                    exit_code = run_command(self.server.command, args=request["args"], color=request["color"])
+            except OSError as e:
+                # The client went away, or its working directory doesn't exist here
+                logging.warning(f"Could not run {request['args']}: {e}")
+                return
+            finally:
+                reset_logging()
+        self.wfile.write(json.dumps({"exit_code": exit_code}).encode() + b"\n")
+
+
+class CommandServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: Path, command: click.Command):
+        self.command = command
+        self.command_lock = threading.Lock()
+        super().__init__(str(socket_path), CommandHandler)
+        # Clients run commands with the permissions of the daemon
+        os.chmod(socket_path, 0o600)
+
+
+def is_daemon_running(socket_path: Path) -> bool:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        try:
+            connection.connect(str(socket_path))
+        except (FileNotFoundError, ConnectionRefusedError):
+            return False
+    return True
+
+
+def is_private_directory(directory: Path) -> bool:
+    """Whether other users can't add or replace files in `directory`. Shared directories such as /tmp qualify if they
+    are owned by root and sticky, so that only the owner of a file can remove it."""
+    directory_stat = directory.stat()
+    return directory_stat.st_uid in (os.getuid(), 0) and (
+        not directory_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH) or bool(directory_stat.st_mode & stat.S_ISVTX)
+    )
+
+
+def raise_keyboard_interrupt(*_):
+    raise KeyboardInterrupt
+
+
+def serve_commands(command: click.Command, socket_path: Path):
+    """Run commands sent by clients to `socket_path` in this process, until interrupted. The exiftool workers started
+    by a command keep running for the following ones, and metadata caches and library indexes are kept open."""
+    global _open_databases
+    if is_daemon_running(socket_path):
+        raise click.ClickException(f"An sd-copy daemon is already listening on {socket_path}")
+    socket_path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+    if not is_private_directory(socket_path.parent):
+        raise click.ClickException(f"Not listening in {socket_path.parent}, which other users can write to")
+    socket_path.unlink(missing_ok=True)  # left behind by a daemon that was killed
+    # Stopped by a service manager the same way as by Ctrl+C, removing the socket and closing exiftool workers
+    signal.signal(signal.SIGTERM, raise_keyboard_interrupt)
+    _open_databases = {}
+    with CommandServer(socket_path, command=command) as server:
+        click.secho(f"Listening on {socket_path}", fg="green", err=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            socket_path.unlink(missing_ok=True)
+            close_databases()
@@ -1,17 +1,26 @@
-import json
+import itertools
 import logging
+import math
 import os.path
-import shlex
-import subprocess
-from dataclasses import dataclass, fields
-from datetime import datetime, timedelta
-from enum import StrEnum
+import sys
+from dataclasses import dataclass
+from datetime import datetime, timedelta, tzinfo
+from enum import StrEnum, auto
+from functools import cache, partial
 from pathlib import Path
-from typing import Any, Optional, Sequence, Union
+from typing import Iterator, Optional, Sequence, Union
 
+from more_itertools import chunked
+
+from sd_copy.cache import MetadataCache
 from sd_copy.cameras import Camera, dji_osmo_action_photo_camera, dji_osmo_action_video_camera, fujifilm_x_t3
+from sd_copy.exiftool import get_exiftool_pool, get_exiftool_version
 from sd_copy.files import is_media_file
-from sd_copy.utils import UnexpectedDataError, get_datetime_from_str, get_single_value
+from sd_copy.native_metadata import NATIVE_READER_VERSION, get_metadata_from_native_reader
+from sd_copy.stats import Stage, stage
+from sd_copy.utils import ExiftoolError, UnexpectedDataError, get_datetime_from_str, get_single_value, parallel_map
+
+DEFAULT_BATCH_SIZE = 50  # number of files handed to exiftool per request
 
 
 class Extension(StrEnum):
@@ -23,7 +32,14 @@ class Extension(StrEnum):
     aac = ".aac"
 
 
-@dataclass
+class MetadataBackend(StrEnum):
+    exiftool = auto()
+    native = auto()  # reads headers directly, falls back to exiftool for files it can't handle
+
+
+# Plans of large archives hold millions of media and transfers, which are therefore slotted, and share values such as
+# MIME types, resolutions and timezones between files
+@dataclass(slots=True)
 class BaseMedium:
     file_modify_date: datetime
     camera: Camera
@@ -31,25 +47,22 @@ class BaseMedium:
     extension: Extension
     mime_type: str
 
-    def asdict_shallow(self) -> dict[str, Any]:
-        return {field.name: getattr(self, field.name) for field in fields(self)}
-
 
-@dataclass
+@dataclass(slots=True)
 class Image(BaseMedium):
     exif_date: datetime
     resolution: str
     shutter_speed: str
 
 
-@dataclass
+@dataclass(slots=True)
 class Video(BaseMedium):
     exif_date: datetime
     resolution: str
     fps: str
 
 
-@dataclass
+@dataclass(slots=True)
 class DCIMTransfer:
     source_path: Path
     metadata: Union[Image, Video]
@@ -61,11 +74,21 @@ def get_camera(exif_data: dict) -> Camera:
     camera_identifier = exif_data.get("EXIF:Model") or exif_data.get("QuickTime:HandlerDescription")
     if not camera_identifier:
         raise UnexpectedDataError("EXIF data does not match X-T3 or Osmo Action known outputs")
-    return {
+    cameras = {
         "X-T3": fujifilm_x_t3,
         "\u0010DJI.Meta": dji_osmo_action_video_camera,  # used in case of videos
         "DJI Osmo Action": dji_osmo_action_photo_camera,  # used in case of images
-    }[camera_identifier]
+    }
+    if camera_identifier not in cameras:
+        raise UnexpectedDataError(f"Camera '{camera_identifier}' not yet supported")
+    return cameras[camera_identifier]
+
+
+def get_extension(media_file: Path) -> Extension:
+    try:
+        return Extension(media_file.suffix.lower())
+    except ValueError:
+        raise UnexpectedDataError(f"'{media_file.suffix}' extension of {media_file.name} not yet handled") from None
 
 
 def get_matching_video_file_path(media_file) -> Path:
@@ -79,66 +102,183 @@ def get_matching_video_file_path(media_file) -> Path:
     return Path(matching_video_file)
 
 
+# Paths are passed to exiftool as absolute paths, since its workers keep running in the working directory they were
+# started in, e.g. that of an earlier command on the daemon
 def get_metadata_from_exiftool(media_file: Path) -> dict[str, str | int | float]:
-    return get_single_value(
-        json.loads(
-            subprocess.run(
-                shlex.split(f"exiftool -j -G '{media_file}'"),
-                capture_output=True,
-                check=True,
-                text=True,
-            ).stdout,
+    with stage(Stage.exiftool, file=media_file):
+        return get_single_value(get_exiftool_pool().execute_json(str(media_file.absolute())))
+
+
+def get_metadata_from_exiftool_batch(media_files: Sequence[Path]) -> dict[Path, dict[str, str | int | float]]:
+    try:
+        with stage(Stage.exiftool):
+            results = get_exiftool_pool().execute_json(*(str(media_file.absolute()) for media_file in media_files))
+    except ExiftoolError:
+        results = ()
+    metadata_by_source = {result["SourceFile"]: result for result in results}
+    # Files missing from the batch output are extracted individually, so that errors are raised for the file at fault
+    return {
+        media_file: (
+            metadata_by_source.get(str(media_file.absolute())) or get_metadata_from_exiftool(media_file=media_file)
+        )
+        for media_file in media_files
+    }
+
+
+def get_metadata_from_native_reader_batch(media_files: Sequence[Path]) -> dict[Path, dict[str, str | int | float]]:
+    native_metadata = {}
+    for media_file in media_files:
+        try:
+            metadata = get_metadata_from_native_reader(media_file=media_file)
+            check_exif_fields(exif_data=metadata)
+        except (KeyError, ValueError, UnexpectedDataError) as e:
+            logging.debug(f"Falling back to exiftool for {media_file.name}: {e!r}")
+        else:
+            native_metadata[media_file] = metadata
+
+    if fallback_files := tuple(media_file for media_file in media_files if media_file not in native_metadata):
+        return native_metadata | get_metadata_from_exiftool_batch(media_files=fallback_files)
+    return native_metadata
+
+
+def get_metadata_from_backend_batch(media_files: Sequence[Path], backend: MetadataBackend) -> dict[Path, dict]:
+    return {
+        MetadataBackend.exiftool: get_metadata_from_exiftool_batch,
+        MetadataBackend.native: get_metadata_from_native_reader_batch,
+    }[backend](media_files=media_files)
+
+
+def get_exif_source_file(media_file: Path) -> Path:
+    return media_file if not media_file.suffix == ".AAC" else get_matching_video_file_path(media_file)
+
+
+def get_metadata_cache(backend: MetadataBackend = MetadataBackend.exiftool) -> MetadataCache:
+    return MetadataCache(
+        extractor=(
+            f"exiftool-{get_exiftool_version()}"
+            if backend == MetadataBackend.exiftool
+            else f"native-{NATIVE_READER_VERSION}"
         ),
     )
 
 
-def get_metadata(media_file: Path) -> dict:
-    return get_metadata_from_exiftool(
-        media_file=media_file if not media_file.suffix == ".AAC" else get_matching_video_file_path(media_file),
-    )
+def get_metadata(
+    media_file: Path,
+    cache: Optional[MetadataCache] = None,
+    backend: MetadataBackend = MetadataBackend.exiftool,
+) -> dict:
+    exif_source_file = get_exif_source_file(media_file)
+    if cache and (metadata := cache.get(exif_source_file)):
+        return metadata
+    if backend == MetadataBackend.exiftool:
+        metadata = get_metadata_from_exiftool(media_file=exif_source_file)
+    else:
+        metadata = get_metadata_from_backend_batch(media_files=(exif_source_file,), backend=backend)[exif_source_file]
+    if cache:
+        cache.put(exif_source_file, metadata)
+    return metadata
+
+
+def get_metadata_batch(
+    media_files: Sequence[Path],
+    cache: Optional[MetadataCache] = None,
+    backend: MetadataBackend = MetadataBackend.exiftool,
+) -> dict[Path, dict]:
+    exif_source_files = {media_file: get_exif_source_file(media_file) for media_file in media_files}
+    unique_exif_source_files = tuple(dict.fromkeys(exif_source_files.values()))
+
+    cached_metadata = cache.get_many(unique_exif_source_files) if cache else {}
+    if uncached_files := tuple(file for file in unique_exif_source_files if file not in cached_metadata):
+        extracted_metadata = get_metadata_from_backend_batch(media_files=uncached_files, backend=backend)
+        if cache:
+            cache.put_many(extracted_metadata)
+    else:
+        extracted_metadata = {}
+
+    metadata = cached_metadata | extracted_metadata
+    return {media_file: metadata[exif_source_file] for media_file, exif_source_file in exif_source_files.items()}
+
+
+@cache
+def get_timezone(utc_offset: str) -> tzinfo:
+    return datetime.strptime(utc_offset, "%z").tzinfo
+
+
+def get_file_modify_date(file_modify_date: str) -> datetime:
+    """Parse a date like `2021:07:08 17:36:28+02:00`, sharing one timezone object between all dates of the same UTC
+    offset"""
+    date = datetime.strptime(file_modify_date[:19], "%Y:%m:%d %H:%M:%S")
+    return date.replace(tzinfo=get_timezone(file_modify_date[19:]))
 
 
 def get_sanitized_file_name(path: Path) -> str:
     return path.stem.replace("_", "", 1).replace("_", "-")
 
 
-def get_image_or_video(media_file: Path) -> Union[Image, Video]:
-    exif_data = get_metadata(media_file=media_file)
+# EXIF fields read by get_image_or_video per MIME type, besides File:FileModifyDate and the date field of the camera
+MEDIUM_EXIF_FIELDS = {
+    "video/quicktime": ("QuickTime:ImageHeight", "QuickTime:VideoFrameRate"),
+    "video/mp4": ("QuickTime:ImageHeight", "QuickTime:VideoFrameRate"),
+    "image/jpeg": ("EXIF:ExifImageWidth", "EXIF:ExifImageHeight", "EXIF:ShutterSpeedValue"),
+    "image/x-fujifilm-raf": ("EXIF:ExifImageWidth", "EXIF:ExifImageHeight", "EXIF:ShutterSpeedValue"),
+    "image/x-adobe-dng": ("EXIF:ImageWidth", "EXIF:ImageHeight", "EXIF:ShutterSpeedValue"),
+}
 
-    base_medium = BaseMedium(
-        file_modify_date=datetime.strptime(exif_data["File:FileModifyDate"], "%Y:%m:%d %H:%M:%S%z"),
-        camera=get_camera(exif_data),
-        file_name=get_sanitized_file_name(path=media_file),
-        extension=Extension(media_file.suffix.lower()),
-        mime_type=exif_data["File:MIMEType"],
-    )
 
-    if base_medium.mime_type in ("video/quicktime", "video/mp4"):
-        metadata = Video(
-            **base_medium.asdict_shallow(),
-            exif_date=get_datetime_from_str(exif_data[base_medium.camera.exif_date_field]),
-            resolution=f"{exif_data['QuickTime:ImageHeight']}p",
-            fps=f"{round(exif_data['QuickTime:VideoFrameRate'], 2)}fps",
-        )
-    elif base_medium.mime_type in ("image/jpeg", "image/x-fujifilm-raf"):
-        metadata = Image(
-            **base_medium.asdict_shallow(),
-            exif_date=get_datetime_from_str(exif_data[base_medium.camera.exif_date_field]),
-            resolution=f"{exif_data['EXIF:ExifImageWidth']}x{exif_data['EXIF:ExifImageHeight']}",
-            shutter_speed=str(exif_data["EXIF:ShutterSpeedValue"]).replace("/", "-"),
-        )
-    elif base_medium.mime_type in ("image/x-adobe-dng",):
-        metadata = Image(
-            **base_medium.asdict_shallow(),
-            exif_date=get_datetime_from_str(exif_data[base_medium.camera.exif_date_field]),
-            resolution=f"{exif_data['EXIF:ImageWidth']}x{exif_data['EXIF:ImageHeight']}",
-            shutter_speed=str(exif_data["EXIF:ShutterSpeedValue"]).replace("/", "-"),
-        )
-    else:
-        raise UnexpectedDataError(
-            f"'{base_medium.mime_type}' MIMEType of {media_file.name} not yet handled",
+def check_exif_fields(exif_data: dict):
+    """Check that `exif_data` holds all fields required by get_image_or_video, without building the medium"""
+    mime_type = exif_data.get("File:MIMEType")
+    if mime_type not in MEDIUM_EXIF_FIELDS:
+        raise UnexpectedDataError(f"'{mime_type}' MIMEType not yet handled")
+    required_fields = ("File:FileModifyDate", get_camera(exif_data).exif_date_field, *MEDIUM_EXIF_FIELDS[mime_type])
+    if missing_fields := tuple(field for field in required_fields if field not in exif_data):
+        raise UnexpectedDataError(f"Missing EXIF fields {', '.join(missing_fields)}")
+
+
+def get_image_or_video(
+    media_file: Path,
+    exif_data: Optional[dict] = None,
+    cache: Optional[MetadataCache] = None,
+    backend: MetadataBackend = MetadataBackend.exiftool,
+) -> Union[Image, Video]:
+    exif_data = exif_data or get_metadata(media_file=media_file, cache=cache, backend=backend)
+
+    with stage(Stage.image_or_video, file=media_file):
+        mime_type = sys.intern(exif_data["File:MIMEType"])
+        base_medium_fields = (
+            get_file_modify_date(exif_data["File:FileModifyDate"]),
+            camera := get_camera(exif_data),
+            get_sanitized_file_name(path=media_file),
+            get_extension(media_file),
+            mime_type,
         )
 
+        if mime_type in ("video/quicktime", "video/mp4"):
+            metadata = Video(
+                *base_medium_fields,
+                exif_date=get_datetime_from_str(exif_data[camera.exif_date_field]),
+                resolution=sys.intern(f"{exif_data['QuickTime:ImageHeight']}p"),
+                fps=sys.intern(f"{round(exif_data['QuickTime:VideoFrameRate'], 2)}fps"),
+            )
+        elif mime_type in ("image/jpeg", "image/x-fujifilm-raf"):
+            metadata = Image(
+                *base_medium_fields,
+                exif_date=get_datetime_from_str(exif_data[camera.exif_date_field]),
+                resolution=sys.intern(f"{exif_data['EXIF:ExifImageWidth']}x{exif_data['EXIF:ExifImageHeight']}"),
+                shutter_speed=sys.intern(str(exif_data["EXIF:ShutterSpeedValue"]).replace("/", "-")),
+            )
+        elif mime_type in ("image/x-adobe-dng",):
+            metadata = Image(
+                *base_medium_fields,
+                exif_date=get_datetime_from_str(exif_data[camera.exif_date_field]),
+                resolution=sys.intern(f"{exif_data['EXIF:ImageWidth']}x{exif_data['EXIF:ImageHeight']}"),
+                shutter_speed=sys.intern(str(exif_data["EXIF:ShutterSpeedValue"]).replace("/", "-")),
+            )
+        else:
+            raise UnexpectedDataError(
+                f"'{mime_type}' MIMEType of {media_file.name} not yet handled",
+            )
+
     return metadata
 
 
@@ -162,28 +302,25 @@ def get_target_path(
     def get_image_file_name_additions(image: Image) -> Sequence[str]:
         return (image.resolution,)
 
-    return (
-        destination
-        / datetime.strftime(rectified_date, "%Y-%m-%d")
-        / Path(
-            "_".join(
-                (
-                    get_timestamp_str(date=rectified_date),
-                    metadata.camera.name,
-                    metadata.file_name if not timelapse_n else f"{metadata.file_name}-{timelapse_n:04d}",
-                    *(
-                        {
-                            "image/jpeg": get_image_file_name_additions,
-                            "image/x-fujifilm-raf": get_image_file_name_additions,
-                            "image/x-adobe-dng": get_image_file_name_additions,
-                            "video/quicktime": get_video_file_name_additions,
-                            "video/mp4": get_video_file_name_additions,
-                        }[metadata.mime_type](metadata)
-                    ),
+    return destination.joinpath(
+        sys.intern(datetime.strftime(rectified_date, "%Y-%m-%d")),
+        "_".join(
+            (
+                get_timestamp_str(date=rectified_date),
+                metadata.camera.name,
+                metadata.file_name if not timelapse_n else f"{metadata.file_name}-{timelapse_n:04d}",
+                *(
+                    {
+                        "image/jpeg": get_image_file_name_additions,
+                        "image/x-fujifilm-raf": get_image_file_name_additions,
+                        "image/x-adobe-dng": get_image_file_name_additions,
+                        "video/quicktime": get_video_file_name_additions,
+                        "video/mp4": get_video_file_name_additions,
+                    }[metadata.mime_type](metadata)
                 ),
-            )
-            + metadata.extension.value,
+            ),
         )
+        + metadata.extension.value,
     )
 
 
@@ -191,9 +328,12 @@ def get_dcim_transfer_object(
     media_file: Path,
     destination: Path,
     time_offset: int,
+    exif_data: Optional[dict] = None,
+    cache: Optional[MetadataCache] = None,
+    backend: MetadataBackend = MetadataBackend.exiftool,
 ) -> DCIMTransfer:
     logging.info(f"Getting DCIM object for {media_file}")
-    metadata = get_image_or_video(media_file=media_file)
+    metadata = get_image_or_video(media_file=media_file, exif_data=exif_data, cache=cache, backend=backend)
     rectified_modify_date = get_rectified_modify_date(metadata=metadata, time_offset=time_offset)
     return DCIMTransfer(
         source_path=media_file,
@@ -207,17 +347,92 @@ def get_dcim_transfer_object(
     )
 
 
-def get_dcim_transfers(
-    source_path: Path,
+def get_media_files(source_path: Path) -> Sequence[Path]:
+    with stage(Stage.scan):
+        return tuple(sorted(file for file in source_path.rglob("*") if is_media_file(file)))
+
+
+def get_dcim_transfers_for_batch(
+    media_files: Sequence[Path],
     destination_path: Path,
     time_offset: int,
+    cache: Optional[MetadataCache] = None,
+    backend: MetadataBackend = MetadataBackend.exiftool,
 ) -> Sequence[DCIMTransfer]:
     return tuple(
         get_dcim_transfer_object(
             media_file=file,
             destination=destination_path,
             time_offset=time_offset,
+            exif_data=exif_data,
+            cache=cache,
+            backend=backend,
         )
-        for file in source_path.rglob("*")
-        if is_media_file(file)
+        for file, exif_data in (
+            get_metadata_batch(media_files=media_files, cache=cache, backend=backend)
+            if len(media_files) > 1
+            else {file: None for file in media_files}
+        ).items()
+    )
+
+
+def get_effective_batch_size(n_files: int, batch_size: int, jobs: int) -> int:
+    # Smaller batches for small cards, so that every job receives work
+    return max(1, min(batch_size, math.ceil(n_files / jobs)))
+
+
+def iter_dcim_transfers(
+    source_path: Path,
+    destination_path: Path,
+    time_offset: int,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    cache: Optional[MetadataCache] = None,
+    jobs: int = 1,
+    backend: MetadataBackend = MetadataBackend.exiftool,
+    media_files: Optional[Sequence[Path]] = None,
+) -> Iterator[DCIMTransfer]:
+    """Metadata is extracted for `batch_size` files per exiftool request. With a batch size of 1, every file is
+    extracted with a separate request. Metadata found in `cache` is not extracted again. Batches are processed by
+    `jobs` exiftool workers in parallel. Transfers are yielded in order of their source path as soon as their batch
+    is resolved, so that they can be processed while later batches are still extracted. With the native backend,
+    exiftool is only started for files the native reader can't handle. If `media_files` are given, only these files of
+    the source path are read."""
+    media_files = get_media_files(source_path=source_path) if media_files is None else media_files
+    get_exiftool_pool(size=jobs)
+    yield from itertools.chain.from_iterable(
+        parallel_map(
+            partial(
+                get_dcim_transfers_for_batch,
+                destination_path=destination_path,
+                time_offset=time_offset,
+                cache=cache,
+                backend=backend,
+            ),
+            chunked(media_files, get_effective_batch_size(len(media_files), batch_size=batch_size, jobs=jobs)),
+            jobs=jobs,
+        ),
+    )
+
+
+def get_dcim_transfers(
+    source_path: Path,
+    destination_path: Path,
+    time_offset: int,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    cache: Optional[MetadataCache] = None,
+    jobs: int = 1,
+    backend: MetadataBackend = MetadataBackend.exiftool,
+    media_files: Optional[Sequence[Path]] = None,
+) -> Sequence[DCIMTransfer]:
+    return tuple(
+        iter_dcim_transfers(
+            source_path=source_path,
+            destination_path=destination_path,
+            time_offset=time_offset,
+            batch_size=batch_size,
+            cache=cache,
+            jobs=jobs,
+            backend=backend,
+            media_files=media_files,
+        ),
     )
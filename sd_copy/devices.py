@@ -0,0 +1,134 @@
+import itertools
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, Optional, Sequence, TypeVar
+
+T = TypeVar("T")
+
+MAX_DEFAULT_JOBS = 8
+ROTATIONAL_DEVICE_JOBS = 2  # a little concurrency lets the disk reorder requests, more leads to seek thrashing
+REMOVABLE_DEVICE_JOBS = 1  # SD cards read fastest sequentially, while other transfers write and hash their targets
+
+
+def get_sysfs_block_device(device: int) -> Path:
+    return Path(f"/sys/dev/block/{os.major(device)}:{os.minor(device)}")
+
+
+def get_device(path: Path) -> int:
+    """Device holding `path`, or holding its closest existing parent, e.g. for a target that is not yet copied"""
+    while not path.exists() and path.parent != path:
+        path = path.parent
+    return path.stat().st_dev
+
+
+def get_block_device_attribute(device: int, attribute: str) -> Optional[str]:
+    """Attribute of a block device from Linux sysfs, e.g. `queue/rotational`. Partitions do not have all attributes
+    of their parent device, so the parent device is checked as well. Returns None where sysfs is not available, for
+    example on macOS or for network filesystems."""
+    block_device = get_sysfs_block_device(device)
+    if not block_device.exists():
+        return None
+    for attribute_path in (block_device / attribute, block_device.resolve().parent / attribute):
+        if attribute_path.exists():
+            return attribute_path.read_text().strip()
+    return None
+
+
+def is_rotational_device(path: Path) -> Optional[bool]:
+    """Use Linux sysfs to determine if the device holding `path` is a spinning disk"""
+    rotational = get_block_device_attribute(path.stat().st_dev, "queue/rotational")
+    return None if rotational is None else rotational == "1"
+
+
+def is_removable_device(device: int) -> bool:
+    """SD cards show up as MMC devices in built-in readers, and as removable SCSI disks in USB readers"""
+    return (
+        get_sysfs_block_device(device).resolve().name.startswith("mmcblk")
+        or get_block_device_attribute(device, "removable") == "1"
+    )
+
+
+def get_device_jobs(device: int) -> Optional[int]:
+    """Concurrent transfers that a device handles well. USB card readers often report as rotational, so removable
+    devices are checked first. Returns None for flash and unknown devices, which are not limited."""
+    if is_removable_device(device):
+        return REMOVABLE_DEVICE_JOBS
+    if get_block_device_attribute(device, "queue/rotational") == "1":
+        return ROTATIONAL_DEVICE_JOBS
+    return None
+
+
+def get_default_jobs(path: Path) -> int:
+    if is_rotational_device(path):
+        return ROTATIONAL_DEVICE_JOBS
+    return min(os.cpu_count() or 1, MAX_DEFAULT_JOBS)
+
+
+class DeviceScheduler:
+    """Limits the transfers and checksums running at the same time per device, so that parallel copies of many files
+    do not make SD cards and spinning disks seek between them. Limits are detected per device, or set for all devices
+    with `set_device_jobs`. A thread may acquire devices it already holds again, e.g. to hash the source within a
+    copy. Devices are acquired in a fixed order, so that threads holding several devices cannot deadlock."""
+
+    def __init__(self):
+        self.device_jobs: Optional[int] = None
+        self._semaphores: dict[int, Optional[threading.BoundedSemaphore]] = {}
+        self._lock = threading.Lock()
+        self._held = threading.local()
+
+    def set_device_jobs(self, device_jobs: Optional[int]):
+        with self._lock:
+            self.device_jobs = device_jobs
+            self._semaphores.clear()
+
+    def get_semaphore(self, device: int) -> Optional[threading.BoundedSemaphore]:
+        with self._lock:
+            if device not in self._semaphores:
+                jobs = self.device_jobs or get_device_jobs(device)
+                self._semaphores[device] = threading.BoundedSemaphore(jobs) if jobs else None
+            return self._semaphores[device]
+
+    def get_held_devices(self) -> set[int]:
+        if not hasattr(self._held, "devices"):
+            self._held.devices = set()
+        return self._held.devices
+
+    @contextmanager
+    def acquire(self, *paths: Path) -> Iterator[None]:
+        held_devices = self.get_held_devices()
+        devices = sorted({get_device(path) for path in paths} - held_devices)
+        acquired = []
+        try:
+            for device in devices:
+                if semaphore := self.get_semaphore(device):
+                    semaphore.acquire()
+                    acquired.append(semaphore)
+                held_devices.add(device)
+            yield
+        finally:
+            for semaphore in reversed(acquired):
+                semaphore.release()
+            held_devices.difference_update(devices)
+
+
+scheduler = DeviceScheduler()
+
+
+def order_by_device(items: Iterable[T], get_path: Callable[[T], Path]) -> Sequence[T]:
+    """Order items for sequential access per device. Files on spinning disks are ordered by inode, which follows their
+    placement on disk for most Linux filesystems, while other devices keep the given order, e.g. of file names on an
+    SD card. Items of different devices are interleaved, so that a device that is busy does not hold up the others."""
+    items_by_device: dict[int, list[T]] = {}
+    for item in items:
+        items_by_device.setdefault(get_device(get_path(item)), []).append(item)
+    for device, device_items in items_by_device.items():
+        if get_block_device_attribute(device, "queue/rotational") == "1":
+            device_items.sort(key=lambda item: get_path(item).stat().st_ino)
+    return tuple(
+        item
+        for interleaved_items in itertools.zip_longest(*items_by_device.values())
+        for item in interleaved_items
+        if item is not None
+    )
@@ -0,0 +1,176 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import selectors
+import subprocess
+import threading
+import time
+from typing import Optional, Sequence
+
+from sd_copy.stats import span
+from sd_copy.utils import ExiftoolError
+
+EXIFTOOL_EXECUTABLE = "exiftool"
+EXIFTOOL_TIMEOUT = 60  # seconds until a single request is considered hanging
+READ_SIZE = 65536
+
+
+class ExiftoolCrashedError(ExiftoolError):
+    pass
+
+
+class ExiftoolProcess:
+    """Long-running exiftool process in `-stay_open` mode, reading its arguments from stdin (`-@ -`). Each request is
+    terminated with `-executeN`, after which exiftool prints `{readyN}` to stdout. An additional `-echo4` sentinel marks
+    the end of the request's stderr output, so that errors can be attributed to the request that caused them."""
+
+    def __init__(self, executable: str = EXIFTOOL_EXECUTABLE, timeout: float = EXIFTOOL_TIMEOUT):
+        self.executable = executable
+        self.timeout = timeout
+        self._process: Optional[subprocess.Popen] = None
+        self._request_counter = 0
+
+    @property
+    def running(self) -> bool:
+        return self._process is not None and self._process.poll() is None
+
+    def start(self):
+        logging.debug(f"Starting exiftool worker '{self.executable}'")
+        self._process = subprocess.Popen(
+            (self.executable, "-stay_open", "True", "-@", "-"),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+
+    def terminate(self):
+        if self._process is None:
+            return
+        if self.running:
+            try:
+                self._process.stdin.write(b"-stay_open\nFalse\n")
+                self._process.stdin.flush()
+                self._process.wait(timeout=5)
+            except (OSError, subprocess.TimeoutExpired):
+                pass
+        self.kill()
+
+    def kill(self):
+        if self._process is None:
+            return
+        if self.running:
+            self._process.kill()
+        self._process.wait()
+        for stream in (self._process.stdin, self._process.stdout, self._process.stderr):
+            stream.close()
+        self._process = None
+
+    def _read_until_ready(self, stdout_sentinel: bytes, stderr_sentinel: bytes) -> tuple[bytes, bytes]:
+        buffers = {self._process.stdout.fileno(): b"", self._process.stderr.fileno(): b""}
+        sentinels = {self._process.stdout.fileno(): stdout_sentinel, self._process.stderr.fileno(): stderr_sentinel}
+        deadline = time.monotonic() + self.timeout
+
+        with selectors.DefaultSelector() as selector:
+            for fd in buffers:
+                selector.register(fd, selectors.EVENT_READ)
+            while not all(buffers[fd].endswith(sentinels[fd]) for fd in buffers):
+                if (remaining := deadline - time.monotonic()) <= 0:
+                    self.kill()
+                    raise ExiftoolError(f"Exiftool did not respond within {self.timeout}s")
+                for key, _ in selector.select(timeout=remaining):
+                    if not (chunk := os.read(key.fd, READ_SIZE)):
+                        self.kill()
+                        raise ExiftoolCrashedError(f"Exiftool exited unexpectedly: {buffers[key.fd].decode()}")
+                    buffers[key.fd] += chunk
+
+        stdout, stderr = buffers.values()
+        return stdout[: -len(stdout_sentinel)], stderr[: -len(stderr_sentinel)]
+
+    def execute(self, *args: str) -> tuple[str, str]:
+        if not self.running:
+            self.start()
+
+        self._request_counter += 1
+        ready = f"{{ready{self._request_counter}}}"
+        request = "\n".join((*args, "-echo4", ready, f"-execute{self._request_counter}")) + "\n"
+
+        with span("exiftool", category="subprocess", pid=self._process.pid, request=self._request_counter):
+            try:
+                self._process.stdin.write(request.encode())
+                self._process.stdin.flush()
+            except BrokenPipeError as e:
+                self.kill()
+                raise ExiftoolCrashedError("Exiftool exited unexpectedly") from e
+
+            stdout, stderr = self._read_until_ready(
+                stdout_sentinel=f"{ready}\n".encode(),
+                stderr_sentinel=f"{ready}\n".encode(),
+            )
+        return stdout.decode(), stderr.decode()
+
+
+class ExiftoolPool:
+    """Thread-safe pool of exiftool worker processes. Workers are started on first use and restarted on crash."""
+
+    def __init__(self, size: int = 1, executable: str = EXIFTOOL_EXECUTABLE, timeout: float = EXIFTOOL_TIMEOUT):
+        self.executable = executable
+        self.timeout = timeout
+        self._workers: list[ExiftoolProcess] = []
+        self._idle: queue.SimpleQueue[ExiftoolProcess] = queue.SimpleQueue()
+        self.resize(size)
+
+    @property
+    def size(self) -> int:
+        return len(self._workers)
+
+    def resize(self, size: int):
+        """Grow the pool to `size` workers. Pools are never shrunk, as workers might be busy."""
+        for _ in range(size - self.size):
+            worker = ExiftoolProcess(executable=self.executable, timeout=self.timeout)
+            self._workers.append(worker)
+            self._idle.put(worker)
+
+    def execute(self, *args: str) -> tuple[str, str]:
+        worker = self._idle.get()
+        try:
+            try:
+                return worker.execute(*args)
+            except ExiftoolCrashedError:
+                logging.warning("Exiftool worker crashed, restarting and retrying once")
+                return worker.execute(*args)
+        finally:
+            self._idle.put(worker)
+
+    def execute_json(self, *args: str) -> Sequence[dict]:
+        stdout, stderr = self.execute("-j", "-G", *args)
+        if not stdout.strip():
+            raise ExiftoolError(stderr.strip() or f"No exiftool output for {args}")
+        if stderr.strip():
+            logging.debug(f"Exiftool: {stderr.strip()}")
+        return json.loads(stdout)
+
+    def close(self):
+        for worker in self._workers:
+            worker.terminate()
+
+
+_pool: Optional[ExiftoolPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_exiftool_pool(size: int = 1) -> ExiftoolPool:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ExiftoolPool(size=size)
+            atexit.register(_pool.close)
+        elif _pool.size < size:
+            _pool.resize(size)
+        return _pool
+
+
+def get_exiftool_version() -> str:
+    stdout, _ = get_exiftool_pool().execute("-ver")
+    return stdout.strip()
@@ -1,13 +1,35 @@
+import errno
+import fcntl
+import itertools
 import logging
 import os
 import re
 import shutil
 from dataclasses import dataclass
 from datetime import datetime
+from enum import StrEnum, auto
 from pathlib import Path
 from typing import Optional, Sequence
 
-from sd_copy.utils import UnexpectedDataError, get_optional_single_value
+from sd_copy.hashing import DEFAULT_HASH_ALGORITHM, HashAlgorithm, TreeChecksum, get_file_checksum
+from sd_copy.matching import get_unmatched_stems
+from sd_copy.stats import Stage, stage
+from sd_copy.utils import UnexpectedDataError, get_optional_single_value, parallel_map
+
+COPY_BUFFER_SIZE = 1024 * 1024
+FICLONE = 0x40049409  # _IOW(0x94, 9, int) from linux/fs.h
+
+# Errors that indicate a copy method is not supported for a pair of files, rather than a failing copy
+UNSUPPORTED_COPY_ERRNOS = frozenset(
+    (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOTTY, errno.ETXTBSY),
+)
+
+
+class CopyMethod(StrEnum):
+    reflink = auto()
+    copy_file_range = auto()
+    sendfile = auto()
+    buffered = auto()
 
 
 @dataclass
@@ -26,18 +48,123 @@ def is_media_file(file: Path) -> bool:
 
 
 def update_file_modify_date(file_path: Path, rectified_modify_date: datetime):
-    os.utime(path=file_path, times=(rectified_modify_date.timestamp(), rectified_modify_date.timestamp()))
-
-
-def copy_media_to_target(source_path: Path, target_path: Path):
+    with stage(Stage.utime, file=file_path):
+        os.utime(path=file_path, times=(rectified_modify_date.timestamp(), rectified_modify_date.timestamp()))
+
+
+def copy_with_reflink(source_fd: int, target_fd: int, size: int):
+    fcntl.ioctl(target_fd, FICLONE, source_fd)
+
+
+def copy_with_copy_file_range(source_fd: int, target_fd: int, size: int):
+    offset = 0
+    while offset < size and (n_bytes := os.copy_file_range(source_fd, target_fd, size - offset, offset, offset)):
+        offset += n_bytes
+    if offset < size:  # some filesystems report success but copy nothing, fall back in that case
+        raise OSError(errno.ENOTSUP, "copy_file_range stopped before the end of the file")
+
+
+def copy_with_sendfile(source_fd: int, target_fd: int, size: int):
+    offset = 0
+    while offset < size and (n_bytes := os.sendfile(target_fd, source_fd, offset, size - offset)):
+        offset += n_bytes
+    if offset < size:
+        raise OSError(errno.ENOTSUP, "sendfile stopped before the end of the file")
+
+
+def copy_with_buffer(source_fd: int, target_fd: int, size: int):
+    buffer = memoryview(bytearray(COPY_BUFFER_SIZE))
+    with open(source_fd, mode="rb", buffering=0, closefd=False) as source:
+        while n_bytes := source.readinto(buffer):
+            # A write may be short, e.g. to network or FUSE filesystems
+            data = buffer[:n_bytes]
+            while data:
+                data = data[os.write(target_fd, data) :]
+
+
+COPY_METHODS = (
+    (CopyMethod.reflink, copy_with_reflink),
+    *(((CopyMethod.copy_file_range, copy_with_copy_file_range),) if hasattr(os, "copy_file_range") else ()),
+    *(((CopyMethod.sendfile, copy_with_sendfile),) if hasattr(os, "sendfile") else ()),
+    (CopyMethod.buffered, copy_with_buffer),
+)
+
+
+def copy_file_data(source_path: Path, target_path: Path) -> CopyMethod:
+    """Copy the content of `source_path` to `target_path`, trying the copy methods from cheapest to most expensive:
+    a reflink shares the data blocks on copy-on-write filesystems, copy_file_range and sendfile copy in the kernel,
+    and the buffered copy passes the data through userspace. Returns the method that was used."""
+    with source_path.open(mode="rb") as source, target_path.open(mode="wb") as target:
+        size = os.fstat(source.fileno()).st_size
+        for copy_method, copy in COPY_METHODS:
+            try:
+                copy(source.fileno(), target.fileno(), size)
+                return copy_method
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_COPY_ERRNOS or copy_method == CopyMethod.buffered:
+                    raise
+                logging.debug(f"Copy method {copy_method} not supported for {source_path.name}: {e}")
+                os.ftruncate(target.fileno(), 0)
+                os.lseek(source.fileno(), 0, os.SEEK_SET)
+                os.lseek(target.fileno(), 0, os.SEEK_SET)
+
+
+def copy_media_to_target(source_path: Path, target_path: Path) -> CopyMethod:
     target_path.parent.mkdir(parents=True, exist_ok=True)
-    shutil.copy2(src=source_path, dst=target_path)  # copy2 also copies metadata (such as modified date)
+    copy_method = copy_file_data(source_path=source_path, target_path=target_path)
+    shutil.copystat(src=source_path, dst=target_path)  # also copies metadata (such as modified date), like copy2
+    return copy_method
+
+
+def copy_media_to_target_with_checksum(
+    source_path: Path,
+    target_path: Path,
+    algorithm: HashAlgorithm = DEFAULT_HASH_ALGORITHM,
+) -> tuple[str, CopyMethod]:
+    """Copy like `copy_media_to_target` and return the source checksum along with the copy method. Across devices, the
+    checksum is computed from the same buffers that are written to the target, so that the source is only read once.
+    On the same device, such as when re-sorting within a library, the kernel copy methods are cheaper than a buffered
+    copy, and the source is hashed separately."""
+    target_path.parent.mkdir(parents=True, exist_ok=True)
+    if source_path.stat().st_dev == target_path.parent.stat().st_dev:
+        copy_method = copy_media_to_target(source_path=source_path, target_path=target_path)
+        return get_file_checksum(file=source_path, algorithm=algorithm), copy_method
+
+    checksum = TreeChecksum(algorithm=algorithm)
+    buffer = memoryview(bytearray(COPY_BUFFER_SIZE))
+    with source_path.open(mode="rb") as source, target_path.open(mode="wb") as target:
+        while n_bytes := source.readinto(buffer):
+            checksum.update(buffer[:n_bytes])
+            target.write(buffer[:n_bytes])
+    shutil.copystat(src=source_path, dst=target_path)
+    return checksum.hexdigest(), CopyMethod.buffered
 
 
 def remove_source_file(source_path: Path):
     pass
 
 
+def get_files(path: Path) -> Sequence[Path]:
+    files = []
+    for root, dirnames, names in os.walk(path):
+        dirnames.sort()  # walked in order, as listed by the file system otherwise
+        files.extend(Path(root) / name for name in sorted(names))
+    return tuple(files)
+
+
+def get_files_parallel(path: Path, jobs: int) -> Sequence[Path]:
+    """Walk the top-level folders of `path` in parallel, which hides latency on network storage"""
+    return tuple(
+        itertools.chain.from_iterable(
+            parallel_map(
+                lambda entry: get_files(entry) if entry.is_dir() else (entry,),
+                sorted(path.iterdir()),
+                jobs=jobs,
+            ),
+        ),
+    )
+
+
 def get_top_level_folders(path: Path) -> Sequence[Path]:
     return tuple(path for path in path.glob("*") if path.is_dir())
 
@@ -63,8 +190,10 @@ def get_rename_operations(source_folders: Sequence[Path], target_folders: Sequen
 
 
 def get_files_not_sorted(files_to_check: Sequence[Path], sorted_files: Sequence[Path]) -> Sequence[str]:
-    return tuple(
-        str(file)
-        for file in files_to_check
-        if is_media_file(file) and not any(file.stem in sorted_file.stem for sorted_file in sorted_files)
+    """Files whose stem is not contained in the stem of any sorted file"""
+    media_files = tuple(file for file in files_to_check if is_media_file(file))
+    unmatched_stems = get_unmatched_stems(
+        stems={file.stem for file in media_files},
+        sorted_stems={sorted_file.stem for sorted_file in sorted_files},
     )
+    return tuple(str(file) for file in media_files if file.stem in unmatched_stems)
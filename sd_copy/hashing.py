@@ -0,0 +1,110 @@
+import hashlib
+import os
+from enum import StrEnum, auto
+from pathlib import Path
+from typing import Optional
+
+from sd_copy.devices import scheduler
+from sd_copy.stats import Stage, stage
+from sd_copy.utils import MissingDependencyError, parallel_map
+
+HASH_BUFFER_SIZE = 8 * 1024 * 1024
+TREE_HASH_SEGMENT_SIZE = 64 * 1024 * 1024
+DEFAULT_HASH_JOBS = min(os.cpu_count() or 1, 4)
+
+
+class HashAlgorithm(StrEnum):
+    md5 = auto()
+    sha256 = auto()
+    blake2b = auto()
+    xxh3 = auto()  # requires the optional `xxhash` package
+
+
+DEFAULT_HASH_ALGORITHM = HashAlgorithm.blake2b
+
+
+def get_hasher(algorithm: HashAlgorithm):
+    if algorithm == HashAlgorithm.xxh3:
+        try:
+            import xxhash
+        except ImportError as e:
+            raise MissingDependencyError("The xxh3 hash requires the xxhash package, please install") from e
+        return xxhash.xxh3_128()
+    return hashlib.new(algorithm)
+
+
+class TreeChecksum:
+    """Incremental tree hash. Data is split into segments of `segment_size` bytes, and the checksum is the hash over
+    the concatenated segment digests. Data of a single segment is hashed directly, so that the checksum of small files
+    equals the plain hash. The tree structure allows `get_file_checksum` to hash segments of large files in parallel,
+    while producing the same checksum as a single pass over the data, such as while copying. Without a segment size,
+    all data is hashed directly."""
+
+    def __init__(self, algorithm: HashAlgorithm, segment_size: Optional[int] = TREE_HASH_SEGMENT_SIZE):
+        self.algorithm = algorithm
+        self.segment_size = segment_size
+        self._segment_digests: list[bytes] = []
+        self._segment = get_hasher(algorithm)
+        self._segment_bytes = 0
+
+    def update(self, data: bytes | memoryview):
+        data = memoryview(data)
+        while self.segment_size and self._segment_bytes + len(data) >= self.segment_size:
+            n_bytes = self.segment_size - self._segment_bytes
+            self._segment.update(data[:n_bytes])
+            self._segment_digests.append(self._segment.digest())
+            self._segment, self._segment_bytes, data = get_hasher(self.algorithm), 0, data[n_bytes:]
+        self._segment.update(data)
+        self._segment_bytes += len(data)
+
+    def add_segment_digest(self, digest: bytes):
+        self._segment_digests.append(digest)
+
+    def hexdigest(self) -> str:
+        segment_digests = (*self._segment_digests, *((self._segment.digest(),) if self._segment_bytes else ()))
+        if len(segment_digests) == 0:
+            return self._segment.hexdigest()
+        if len(segment_digests) == 1:
+            return segment_digests[0].hex()
+        root = get_hasher(self.algorithm)
+        for segment_digest in segment_digests:
+            root.update(segment_digest)
+        return root.hexdigest()
+
+
+def hash_file_range(fd: int, offset: int, length: int, algorithm: HashAlgorithm, buffer_size: int) -> bytes:
+    hasher = get_hasher(algorithm)
+    buffer = memoryview(bytearray(min(buffer_size, max(length, 1))))
+    end = offset + length
+    while offset < end and (n_bytes := os.preadv(fd, [buffer[: min(buffer_size, end - offset)]], offset)):
+        hasher.update(buffer[:n_bytes])
+        offset += n_bytes
+    return hasher.digest()
+
+
+def get_file_checksum(
+    file: Path,
+    algorithm: HashAlgorithm = DEFAULT_HASH_ALGORITHM,
+    segment_size: Optional[int] = TREE_HASH_SEGMENT_SIZE,
+    buffer_size: int = HASH_BUFFER_SIZE,
+    jobs: int = DEFAULT_HASH_JOBS,
+) -> str:
+    """Checksum of `file`, matching `TreeChecksum` for the same algorithm and segment size. Segments of large files
+    are hashed on `jobs` threads in parallel; hashlib releases the GIL while hashing. Only as many files are hashed
+    at the same time as the device scheduler allows for the device holding `file`."""
+    checksum = TreeChecksum(algorithm=algorithm, segment_size=segment_size)
+    size = file.stat().st_size
+    segment_length = segment_size or max(size, 1)
+    segment_offsets = range(0, size, segment_length)
+    fd = os.open(file, os.O_RDONLY)
+    try:
+        with scheduler.acquire(file), stage(Stage.checksum, n_bytes=size, file=file):
+            for segment_digest in parallel_map(
+                lambda offset: hash_file_range(fd, offset, min(segment_length, size - offset), algorithm, buffer_size),
+                segment_offsets,
+                jobs=max(1, min(jobs, len(segment_offsets))),
+            ):
+                checksum.add_segment_digest(segment_digest)
+    finally:
+        os.close(fd)
+    return checksum.hexdigest()
@@ -0,0 +1,138 @@
+import json
+import logging
+import os
+import threading
+from dataclasses import asdict, dataclass
+from enum import StrEnum, auto
+from pathlib import Path
+from typing import Mapping, Optional, Sequence
+
+from sd_copy.dcim_transfer import DCIMTransfer
+from sd_copy.hashing import HashAlgorithm, get_file_checksum
+
+JOURNAL_FILE_NAME = ".sd-copy-journal.jsonl"
+
+
+class TransferState(StrEnum):
+    planned = auto()
+    copied = auto()
+    verified = auto()
+
+
+@dataclass(frozen=True)
+class JournalEntry:
+    state: TransferState
+    source_path: str
+    target_path: str
+    rectified_modify_date: str
+    size: int
+    checksum: Optional[str] = None
+    algorithm: Optional[HashAlgorithm] = None
+
+
+def get_journal_entry(
+    dcim_transfer: DCIMTransfer,
+    state: TransferState,
+    checksum: Optional[str] = None,
+    algorithm: Optional[HashAlgorithm] = None,
+) -> JournalEntry:
+    return JournalEntry(
+        state=state,
+        source_path=str(dcim_transfer.source_path),
+        target_path=str(dcim_transfer.target_path),
+        rectified_modify_date=dcim_transfer.rectified_modify_date.isoformat(),
+        size=dcim_transfer.source_path.stat().st_size,
+        checksum=checksum,
+        algorithm=algorithm,
+    )
+
+
+class TransferJournal:
+    """Write-ahead log of a sort, stored as JSON lines in the destination. All transfers are recorded as planned before
+    copying starts, and each transfer is recorded again once copied and once verified. Every record is flushed to disk
+    before the next step, so that after an interruption the last record of a transfer tells how far it got."""
+
+    def __init__(self, destination_path: Path):
+        self.path = destination_path / JOURNAL_FILE_NAME
+        self._lock = threading.Lock()
+
+    def load(self) -> Mapping[str, JournalEntry]:
+        """Latest entry per source path. A torn last line, written while the previous run was interrupted, is
+        ignored."""
+        entries = {}
+        if not self.path.exists():
+            return entries
+        for line in self.path.read_text().splitlines():
+            try:
+                entry = JournalEntry(**json.loads(line))
+            except (json.JSONDecodeError, TypeError):
+                logging.debug(f"Ignoring incomplete journal record {line!r}")
+                continue
+            entries[entry.source_path] = entry
+        return entries
+
+    def start(self, dcim_transfers: Sequence[DCIMTransfer], resume: bool):
+        """Record all transfers as planned, appending to the existing journal when resuming"""
+        self._write(
+            tuple(get_journal_entry(dcim_transfer, state=TransferState.planned) for dcim_transfer in dcim_transfers),
+            mode="a" if resume else "w",
+        )
+
+    def plan(self, dcim_transfers: Sequence[DCIMTransfer]):
+        """Record further transfers as planned, e.g. for a card whose transfers are planned after copying started"""
+        self._write(
+            tuple(get_journal_entry(dcim_transfer, state=TransferState.planned) for dcim_transfer in dcim_transfers),
+            mode="a",
+        )
+
+    def record(
+        self,
+        dcim_transfer: DCIMTransfer,
+        state: TransferState,
+        checksum: Optional[str] = None,
+        algorithm: Optional[HashAlgorithm] = None,
+    ):
+        self._write((get_journal_entry(dcim_transfer, state=state, checksum=checksum, algorithm=algorithm),), mode="a")
+
+    def remove(self):
+        self.path.unlink(missing_ok=True)
+
+    def _write(self, entries: Sequence[JournalEntry], mode: str):
+        with self._lock, self.path.open(mode=mode) as journal:
+            journal.writelines(f"{json.dumps(asdict(entry))}\n" for entry in entries)
+            journal.flush()
+            os.fsync(journal.fileno())
+
+
+def is_transfer_complete(dcim_transfer: DCIMTransfer, entry: Optional[JournalEntry]) -> bool:
+    """A transfer is complete if the journal recorded it as copied or verified for the same target and date, and the
+    target still has the size of the source. Targets of copied but unverified transfers are verified against the
+    recorded source checksum. Targets of planned transfers may be partial and are always copied again."""
+    if entry is None or entry.state == TransferState.planned:
+        return False
+    if (entry.target_path, entry.rectified_modify_date) != (
+        str(dcim_transfer.target_path),
+        dcim_transfer.rectified_modify_date.isoformat(),
+    ):
+        return False
+    if not dcim_transfer.target_path.exists() or dcim_transfer.target_path.stat().st_size != entry.size:
+        return False
+    if entry.state == TransferState.verified or entry.checksum is None:
+        return True
+    return get_file_checksum(file=dcim_transfer.target_path, algorithm=entry.algorithm) == entry.checksum
+
+
+def get_pending_dcim_transfers(
+    dcim_transfers: Sequence[DCIMTransfer],
+    journal: TransferJournal,
+) -> Sequence[DCIMTransfer]:
+    entries = journal.load()
+    pending_dcim_transfers = tuple(
+        dcim_transfer
+        for dcim_transfer in dcim_transfers
+        if not is_transfer_complete(dcim_transfer, entry=entries.get(str(dcim_transfer.source_path)))
+    )
+    logging.info(
+        f"Resuming from journal, skipping {len(dcim_transfers) - len(pending_dcim_transfers)} completed transfers",
+    )
+    return pending_dcim_transfers
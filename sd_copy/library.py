@@ -0,0 +1,253 @@
+import logging
+import os
+import sqlite3
+import threading
+from dataclasses import dataclass
+from enum import StrEnum, auto
+from pathlib import Path
+from typing import Collection, Optional, Sequence
+
+from more_itertools import bucket
+
+from sd_copy.dcim_transfer import DCIMTransfer
+from sd_copy.hashing import HashAlgorithm, get_file_checksum
+from sd_copy.stats import Stage, stage
+from sd_copy.utils import CopyError, parallel_map
+
+LIBRARY_INDEX_FILE_NAME = ".sd-copy-library.sqlite"
+LIBRARY_SCHEMA_VERSION = 2
+SD_COPY_FILE_PREFIX = ".sd-copy-"  # index and journal files in the library, which are not part of it
+
+LIBRARY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    checksum TEXT,
+    algorithm TEXT
+);
+CREATE INDEX IF NOT EXISTS files_directory ON files (directory);
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL
+);
+"""
+
+# Keep the checksum of a rescanned file, unless it was modified
+UPSERT_SCANNED_FILE = """
+INSERT INTO files (path, directory, size, mtime_ns) VALUES (?, ?, ?, ?)
+ON CONFLICT (path) DO UPDATE SET
+    checksum = CASE WHEN size = excluded.size AND mtime_ns = excluded.mtime_ns THEN checksum END,
+    algorithm = CASE WHEN size = excluded.size AND mtime_ns = excluded.mtime_ns THEN algorithm END,
+    size = excluded.size,
+    mtime_ns = excluded.mtime_ns
+"""
+
+
+@dataclass(frozen=True)
+class DirectoryListing:
+    path: str
+    mtime_ns: int
+    files: Sequence[tuple[str, int, int]]  # name, size and modification time
+    subdirectories: Sequence[str]
+
+
+def get_directory_mtime_ns(directory: Path) -> Optional[int]:
+    try:
+        return directory.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def get_directory_listing(destination_path: Path, directory: str) -> DirectoryListing:
+    # The modification time is taken before listing, so that changes during the listing are picked up next time
+    mtime_ns = (destination_path / directory).stat().st_mtime_ns
+    files, subdirectories = [], []
+    with stage(Stage.scan, file=destination_path / directory), os.scandir(destination_path / directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(os.path.normpath(os.path.join(directory, entry.name)))
+            elif entry.is_file() and not entry.name.startswith(SD_COPY_FILE_PREFIX):
+                stat = entry.stat()
+                files.append((entry.name, stat.st_size, stat.st_mtime_ns))
+    return DirectoryListing(path=directory, mtime_ns=mtime_ns, files=tuple(files), subdirectories=tuple(subdirectories))
+
+
+class LibraryIndex:
+    """Index of the destination library, stored alongside it. Files are keyed on their path relative to the library.
+    Checksums are added when `sort` writes a target, or computed on demand for files already in the library, and are
+    reused as long as size and modification time of the file are unchanged.
+
+    The modification time of each directory is recorded as well. On `update`, only directories whose modification
+    time changed, i.e. where files were added, removed or renamed, are listed again. This includes the library root,
+    where the index itself is written."""
+
+    def __init__(self, destination_path: Path):
+        self.destination_path = destination_path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(destination_path / LIBRARY_INDEX_FILE_NAME, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        if self._connection.execute("PRAGMA user_version").fetchone()[0] != LIBRARY_SCHEMA_VERSION:
+            # The index only holds data that can be recomputed from the library, so it is rebuilt on schema changes
+            self._connection.executescript("DROP TABLE IF EXISTS files; DROP TABLE IF EXISTS directories;")
+            self._connection.execute(f"PRAGMA user_version = {LIBRARY_SCHEMA_VERSION}")
+        self._connection.executescript(LIBRARY_SCHEMA)
+
+    def _get_key(self, path: Path) -> str:
+        return str(path.relative_to(self.destination_path))
+
+    def add(self, path: Path, checksum: Optional[str] = None, algorithm: Optional[HashAlgorithm] = None):
+        stat = path.stat()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                (self._get_key(path), self._get_key(path.parent), stat.st_size, stat.st_mtime_ns, checksum, algorithm),
+            )
+            self._connection.commit()
+
+    def update(self, jobs: int = 1):
+        """Bring the index up to date with the library. The modification times of all known directories are checked
+        on `jobs` threads in parallel, and changed or new directories are listed again."""
+        with self._lock:
+            known_mtimes = dict(self._connection.execute("SELECT path, mtime_ns FROM directories").fetchall())
+        current_mtimes = dict(
+            zip(
+                known_mtimes,
+                parallel_map(
+                    lambda directory: get_directory_mtime_ns(self.destination_path / directory),
+                    known_mtimes,
+                    jobs=jobs,
+                ),
+            ),
+        )
+        removed_directories = tuple(directory for directory, mtime_ns in current_mtimes.items() if mtime_ns is None)
+        changed_directories = tuple(
+            directory
+            for directory, mtime_ns in current_mtimes.items()
+            if mtime_ns is not None and mtime_ns != known_mtimes[directory]
+        )
+        directories_to_list = changed_directories if "." in known_mtimes else (*changed_directories, ".")
+        with self._lock:
+            for directory in removed_directories:
+                self._connection.execute("DELETE FROM directories WHERE path = ?", (directory,))
+                self._connection.execute("DELETE FROM files WHERE directory = ?", (directory,))
+            while directories_to_list:
+                listings = tuple(
+                    parallel_map(
+                        lambda directory: get_directory_listing(self.destination_path, directory),
+                        directories_to_list,
+                        jobs=jobs,
+                    ),
+                )
+                for listing in listings:
+                    self._write_directory_listing(listing)
+                directories_to_list = tuple(
+                    subdirectory
+                    for listing in listings
+                    for subdirectory in listing.subdirectories
+                    if subdirectory not in known_mtimes
+                )
+            # Files added by `sort` to a directory that was never listed, and that has been removed since
+            self._connection.execute("DELETE FROM files WHERE directory NOT IN (SELECT path FROM directories)")
+            self._connection.commit()
+
+    def _write_directory_listing(self, listing: DirectoryListing):
+        self._connection.execute("INSERT OR REPLACE INTO directories VALUES (?, ?)", (listing.path, listing.mtime_ns))
+        paths = {
+            os.path.normpath(os.path.join(listing.path, name)): (size, mtime_ns)
+            for name, size, mtime_ns in listing.files
+        }
+        self._connection.executemany(
+            UPSERT_SCANNED_FILE,
+            ((path, listing.path, size, mtime_ns) for path, (size, mtime_ns) in paths.items()),
+        )
+        indexed_paths = self._connection.execute("SELECT path FROM files WHERE directory = ?", (listing.path,))
+        self._connection.executemany(
+            "DELETE FROM files WHERE path = ?",
+            tuple((path,) for (path,) in indexed_paths.fetchall() if path not in paths),
+        )
+
+    def get_files(self) -> Sequence[Path]:
+        with self._lock:
+            rows = self._connection.execute("SELECT path FROM files ORDER BY path").fetchall()
+        return tuple(self.destination_path / path for (path,) in rows)
+
+    def get_checksum(self, path: Path, algorithm: HashAlgorithm) -> str:
+        stat = path.stat()
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT checksum FROM files WHERE path = ? AND size = ? AND mtime_ns = ? AND algorithm = ?",
+                (self._get_key(path), stat.st_size, stat.st_mtime_ns, algorithm),
+            ).fetchone()
+        if row and row[0]:
+            return row[0]
+        checksum = get_file_checksum(file=path, algorithm=algorithm)
+        self.add(path, checksum=checksum, algorithm=algorithm)
+        return checksum
+
+    def close(self):
+        self._connection.close()
+
+
+def is_duplicate(dcim_transfer: DCIMTransfer, library: LibraryIndex, algorithm: HashAlgorithm) -> bool:
+    """Whether the existing target has the same content as the source. Sizes are compared first, so that the source
+    is only hashed if the target could be a duplicate."""
+    if dcim_transfer.target_path.stat().st_size != dcim_transfer.source_path.stat().st_size:
+        return False
+    return library.get_checksum(path=dcim_transfer.target_path, algorithm=algorithm) == get_file_checksum(
+        file=dcim_transfer.source_path,
+        algorithm=algorithm,
+    )
+
+
+class TargetState(StrEnum):
+    new = auto()
+    duplicate = auto()
+    collision = auto()
+
+
+def get_target_state(
+    dcim_transfer: DCIMTransfer,
+    library: LibraryIndex,
+    algorithm: HashAlgorithm,
+    resumed_target_paths: Collection[str] = (),
+) -> TargetState:
+    """Targets in `resumed_target_paths` were written by an interrupted run and may be partial, so they are treated as
+    new and overwritten"""
+    if not dcim_transfer.target_path.exists() or str(dcim_transfer.target_path) in resumed_target_paths:
+        return TargetState.new
+    if is_duplicate(dcim_transfer, library=library, algorithm=algorithm):
+        logging.debug(f"Skipping {dcim_transfer.source_path}, identical to {dcim_transfer.target_path}")
+        return TargetState.duplicate
+    logging.warning(
+        f"Not copying {dcim_transfer.source_path}, {dcim_transfer.target_path} exists with different content",
+    )
+    return TargetState.collision
+
+
+def deduplicate_dcim_transfers(
+    dcim_transfers: Sequence[DCIMTransfer],
+    library: LibraryIndex,
+    algorithm: HashAlgorithm,
+    resumed_target_paths: Collection[str] = (),
+) -> tuple[Sequence[DCIMTransfer], Sequence[DCIMTransfer]]:
+    """Split transfers into those to copy and those whose target exists in the library with different content.
+    Transfers whose target already exists with the same content are skipped."""
+    partitioned_transfers = bucket(
+        dcim_transfers,
+        key=lambda dcim_transfer: get_target_state(dcim_transfer, library, algorithm, resumed_target_paths),
+    )
+    new_dcim_transfers, duplicates, collisions = (tuple(partitioned_transfers[state]) for state in TargetState)
+    if duplicates:
+        logging.info(f"Skipping {len(duplicates)} files that already exist in the library")
+    return new_dcim_transfers, collisions
+
+
+def check_collisions(collisions: Sequence[DCIMTransfer]):
+    if collisions:
+        raise CopyError(
+            f"{len(collisions)} files not copied, as targets with different content exist: "
+            + ", ".join(str(dcim_transfer.target_path) for dcim_transfer in collisions),
+        )
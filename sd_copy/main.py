@@ -1,31 +1,121 @@
+import cProfile
 import json
 import logging
+import os
+import sqlite3
+from contextlib import AbstractContextManager, nullcontext
+from functools import partial
 from pathlib import Path
+from typing import Optional, Sequence
 
 import click
 
-from sd_copy.check import check_dcim_transfers
-from sd_copy.dcim_transfer import get_dcim_transfers, get_metadata_from_exiftool, is_media_file
-from sd_copy.files import (
-    copy_media_to_target,
-    get_files_not_sorted,
-    get_rename_operations,
-    get_top_level_folders,
-    remove_source_file,
-    update_file_modify_date,
+from sd_copy.cache import METADATA_CACHE_MAX_ENTRIES, METADATA_CACHE_PATH, MetadataCache
+from sd_copy.cards import (
+    check_card_results,
+    copy_cards,
+    plan_cards,
+    plan_dcim_transfers,
+    print_card_results,
+    resolve_cross_card_targets,
 )
-from sd_copy.timelapse import patch_dcim_transfers_for_timelapse
-from sd_copy.utils import CopyError, check_if_exiftool_installed, get_checksum
+from sd_copy.client import SOCKET_PATH
+from sd_copy.copy_engine import DEFAULT_COPY_JOBS, copy_dcim_transfers, stream_dcim_transfers
+from sd_copy.daemon import open_database, serve_commands
+from sd_copy.dcim_transfer import (
+    DEFAULT_BATCH_SIZE,
+    MetadataBackend,
+    get_metadata_cache,
+    get_metadata_from_exiftool,
+    is_media_file,
+    iter_dcim_transfers,
+)
+from sd_copy.devices import get_default_jobs, scheduler
+from sd_copy.files import get_files_not_sorted, get_files_parallel, get_rename_operations, get_top_level_folders
+from sd_copy.hashing import DEFAULT_HASH_ALGORITHM, HashAlgorithm
+from sd_copy.journal import TransferJournal
+from sd_copy.library import LIBRARY_INDEX_FILE_NAME, LibraryIndex, check_collisions, deduplicate_dcim_transfers
+from sd_copy.stats import PROFILE_PATH, stats, tracer
+from sd_copy.timelapse import ProxySettings, prune_proxy_cache
+from sd_copy.utils import check_if_exiftool_installed, get_single_value
 
 TIME_OFFSET_HELP = (
     "Timedelta in seconds to add to the modification date. Determine for example via "
     "`(datetime.strptime(desired_date, format) - datetime.strptime(recorded_date, format)).total_seconds()`."
 )
+BATCH_SIZE_HELP = "Number of files passed to a single exiftool request. Use 1 to extract metadata file by file."
+COPY_JOBS_HELP = (
+    "Number of files copied concurrently from each SRC. A CopyError stops all outstanding transfers of the same SRC."
+)
+DEVICE_JOBS_HELP = (
+    "Number of files copied or hashed concurrently per disk or card. Defaults to 1 for SD cards, 2 for rotational "
+    "disks and no limit otherwise."
+)
+JOBS_HELP = "Number of parallel jobs. Defaults to the number of CPUs, or fewer for rotational disks."
+STREAM_HELP = (
+    "Start copying while metadata of later files is still being read. Sources are only deleted once the sorting "
+    "check over all files passed. Not supported with --timelapse."
+)
+NO_CACHE_HELP = "Do not read or write the persistent metadata and timelapse proxy caches"
+SPLIT_TIMELAPSES_HELP = (
+    "Detect several timelapses on SRC by breaks in their interval, camera or shutter speed, and sort other files as "
+    "usual. Videos are not assigned to timelapses in this mode."
+)
+SAMPLE_INTERVAL_HELP = (
+    "With --timelapse or --split-timelapses, only read metadata of every SAMPLE_INTERVAL-th image and derive that of "
+    "the others from their modification times. Metadata of all files is read if the samples are not consistent."
+)
+PROXY_HEIGHT_HELP = "Height of timelapse proxy videos in pixels"
+PROXY_THREADS_HELP = "Number of threads used to encode timelapse proxies. Defaults to the choice of ffmpeg."
+STATS_HELP = "Print time and throughput per stage"
+STATS_JSON_HELP = "Also write stage statistics to this file as JSON"
+PROMETHEUS_TEXTFILE_HELP = "Also write stage statistics to this file in the Prometheus text format"
+RESUME_HELP = "Skip files that an interrupted run already copied, according to the transfer journal in DST."
+PROFILE_HELP = f"Profile the main thread with cProfile and write the stats to {PROFILE_PATH}, e.g. for snakeviz"
+SOCKET_HELP = "Unix domain socket to listen on. Clients use the SD_COPY_SOCKET environment variable if set."
+TRACE_HELP = (
+    "Write a trace of all stages per file, and of requests to exiftool and ffmpeg, in the Chrome trace event format. "
+    "Open it in chrome://tracing or https://ui.perfetto.dev."
+)
 
 
 @click.group()
-def main():
-    pass
+@click.option("--profile", default=False, is_flag=True, help=PROFILE_HELP)
+@click.option("--trace", default=None, type=click.Path(dir_okay=False, path_type=Path), help=TRACE_HELP)
+def main(profile: bool, trace: Optional[Path]):
+    # Profile and trace are written once the command finished, also if it failed
+    if profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        click.get_current_context().call_on_close(partial(write_profile, profiler=profiler))
+    if trace:
+        tracer.enable()
+        click.get_current_context().call_on_close(partial(tracer.write, path=trace))
+
+
+def write_profile(profiler: cProfile.Profile):
+    profiler.disable()
+    profiler.dump_stats(PROFILE_PATH)
+
+
+def open_metadata_cache(metadata_backend: MetadataBackend, no_cache: bool) -> AbstractContextManager:
+    if no_cache:
+        return nullcontext()
+    return open_database(partial(get_metadata_cache, backend=metadata_backend), METADATA_CACHE_PATH, metadata_backend)
+
+
+def open_library_index(dst: Path) -> AbstractContextManager[LibraryIndex]:
+    # DST is part of the key as given, since paths in the index are resolved against it
+    return open_database(partial(LibraryIndex, destination_path=dst), dst / LIBRARY_INDEX_FILE_NAME, str(dst))
+
+
+def report_stats(print_stats: bool, stats_json: Optional[Path], prometheus_textfile: Optional[Path]):
+    if print_stats:
+        click.secho(stats.get_summary())
+    if stats_json:
+        stats.write_json(stats_json)
+    if prometheus_textfile:
+        stats.write_prometheus_textfile(prometheus_textfile)
 
 
 @main.command("info")
@@ -34,6 +124,37 @@ def get_metadata_info(media_file: Path):
     click.secho(json.dumps(get_metadata_from_exiftool(media_file=media_file), indent=2))
 
 
+@main.group("cache")
+def metadata_cache():
+    """Manage the persistent metadata cache"""
+
+
+@metadata_cache.command("prune")
+@click.option("--max-entries", default=METADATA_CACHE_MAX_ENTRIES, type=click.IntRange(min=0))
+@click.option(
+    "--max-proxy-size",
+    default=ProxySettings.cache_max_size // 2**30,
+    type=click.FloatRange(min=0),
+    help="Maximum size of cached timelapse proxies in GiB",
+)
+def prune_metadata_cache(max_entries: int, max_proxy_size: float):
+    """Evict least recently used entries from the metadata cache, keeping at most MAX_ENTRIES, and least recently used
+    timelapse proxies beyond MAX_PROXY_SIZE"""
+    cache = MetadataCache(max_entries=max_entries)
+    click.secho(f"Removed {cache.prune()} entries from metadata cache")
+    cache.close()
+    removed_proxies = prune_proxy_cache(cache_dir=ProxySettings.cache_dir, max_size=int(max_proxy_size * 2**30))
+    click.secho(f"Removed {removed_proxies} cached timelapse proxies")
+
+
+@main.command("serve")
+@click.option("--socket", "socket_path", default=SOCKET_PATH, type=click.Path(path_type=Path), help=SOCKET_HELP)
+def serve(socket_path: Path):
+    """Run commands of `sd-copy` clients in this process, so that exiftool workers started by one command are reused
+    by the next. Clients run their commands in-process if no daemon is listening."""
+    serve_commands(command=main, socket_path=socket_path)
+
+
 @main.command("rename-before-sync")
 @click.argument("src", type=click.Path(exists=True, path_type=Path))
 @click.argument("dst", type=click.Path(exists=True, path_type=Path))
@@ -54,13 +175,30 @@ def rename_before_sync(src: Path, dst: Path, no_dry_run: bool):
 @main.command("check-sorted")
 @click.argument("src", type=click.Path(exists=True, path_type=Path))
 @click.argument("dst", type=click.Path(exists=True, path_type=Path))
-def check_sorted_dcim(src: Path, dst: Path):
+@click.option("--jobs", "-j", default=None, type=click.IntRange(min=1), help=JOBS_HELP)
+@click.option("--no-index", default=False, is_flag=True, help="Walk DST instead of reading the library index")
+def check_sorted_dcim(src: Path, dst: Path, jobs: Optional[int], no_index: bool):
     """Use original filename to check if a file has been sorted. For example, a file DCSF1234.MOV is sorted to
-    a new filename 20240101-1200_x-t3_DCSF1234_[...].mov, which contains the 'DCSF1234' part."""
+    a new filename 20240101-1200_x-t3_DCSF1234_[...].mov, which contains the 'DCSF1234' part. Files in DST are read
+    from the library index, where only folders that changed since the last check are listed again."""
     click.secho("Note: Timelapse photos are not supported as they do not contain the original filename", fg="blue")
+    sorted_files = None
+    if not no_index:
+        try:
+            if not os.access(dst, os.W_OK):
+                raise PermissionError(f"Permission denied: '{dst}'")
+            with open_library_index(dst) as library:
+                library.update(jobs=jobs or get_default_jobs(dst))
+                sorted_files = tuple(file for file in library.get_files() if not file.stem.startswith("._"))
+        except (PermissionError, sqlite3.OperationalError) as e:
+            # e.g. DST is a read-only backup
+            logging.warning(f"Could not update the library index in DST, walking DST instead: {e}")
     click.secho("Checking files ... ", nl=False)
 
-    sorted_files = tuple(file for file in dst.rglob("*") if is_media_file(file))
+    if sorted_files is None:
+        sorted_files = tuple(
+            file for file in get_files_parallel(path=dst, jobs=jobs or get_default_jobs(dst)) if is_media_file(file)
+        )
 
     if unsorted_files := get_files_not_sorted(files_to_check=tuple(src.rglob("*")), sorted_files=sorted_files):
         click.secho("Unsorted files found!", fg="red")
@@ -70,58 +208,297 @@ def check_sorted_dcim(src: Path, dst: Path):
 
 
 @main.command("sort")
-@click.argument("src", type=click.Path(exists=True, path_type=Path))
+@click.argument("src", nargs=-1, required=True, type=click.Path(exists=True, path_type=Path))
 @click.argument("dst", type=click.Path(exists=True, path_type=Path))
 @click.option("--time-offset", "-td", default=0, type=int, help=TIME_OFFSET_HELP)
 @click.option("--timelapse", default=False, is_flag=True)
+@click.option("--split-timelapses", default=False, is_flag=True, help=SPLIT_TIMELAPSES_HELP)
+@click.option("--sample-interval", default=None, type=click.IntRange(min=2), help=SAMPLE_INTERVAL_HELP)
+@click.option("--proxy-height", default=ProxySettings.height, type=click.IntRange(min=2), help=PROXY_HEIGHT_HELP)
+@click.option("--proxy-threads", default=0, type=click.IntRange(min=0), help=PROXY_THREADS_HELP)
 @click.option("--skip-checksum", default=False, is_flag=True)
+@click.option(
+    "--hash",
+    "hash_algorithm",
+    default=DEFAULT_HASH_ALGORITHM,
+    type=click.Choice(tuple(HashAlgorithm)),
+    help="Checksum algorithm. xxh3 requires the xxhash package.",
+)
+@click.option("--skip-verify", default=False, is_flag=True, help="Do not read copied files again to verify checksums")
 @click.option("--dry-run", "-n", default=False, is_flag=True)
 @click.option("--delete", "-d", default=False, is_flag=True)
 @click.option("--debug", "-v", default=False, is_flag=True)
+@click.option("--batch-size", default=DEFAULT_BATCH_SIZE, type=click.IntRange(min=1), help=BATCH_SIZE_HELP)
+@click.option("--no-cache", default=False, is_flag=True, help=NO_CACHE_HELP)
+@click.option("--jobs", "-j", default=None, type=click.IntRange(min=1), help=JOBS_HELP)
+@click.option(
+    "--metadata-backend",
+    default=MetadataBackend.exiftool,
+    type=click.Choice(tuple(MetadataBackend)),
+    help="The native backend reads file headers directly and falls back to exiftool where needed",
+)
+@click.option("--copy-jobs", default=DEFAULT_COPY_JOBS, type=click.IntRange(min=1), help=COPY_JOBS_HELP)
+@click.option("--device-jobs", default=None, type=click.IntRange(min=1), help=DEVICE_JOBS_HELP)
+@click.option("--resume", default=False, is_flag=True, help=RESUME_HELP)
+@click.option("--stream", default=False, is_flag=True, help=STREAM_HELP)
+@click.option("--stats", "print_stats", default=False, is_flag=True, help=STATS_HELP)
+@click.option("--stats-json", default=None, type=click.Path(path_type=Path), help=STATS_JSON_HELP)
+@click.option("--prometheus-textfile", default=None, type=click.Path(path_type=Path), help=PROMETHEUS_TEXTFILE_HELP)
 def sort_dcim(
-    src: Path,
+    src: tuple[Path, ...],
     dst: Path,
     time_offset: int,
     timelapse: bool,
+    split_timelapses: bool,
+    sample_interval: Optional[int],
+    proxy_height: int,
+    proxy_threads: int,
     skip_checksum: bool,
+    hash_algorithm: HashAlgorithm,
+    skip_verify: bool,
     dry_run: bool,
     delete: bool,
     debug: bool,
+    batch_size: int,
+    no_cache: bool,
+    jobs: Optional[int],
+    metadata_backend: MetadataBackend,
+    copy_jobs: int,
+    device_jobs: Optional[int],
+    resume: bool,
+    stream: bool,
+    print_stats: bool,
+    stats_json: Optional[Path],
+    prometheus_textfile: Optional[Path],
 ):
     logging.basicConfig(
         level=logging.DEBUG if debug else logging.INFO,
         format="%(levelname)s: %(message)s" if debug else "%(message)s",
     )
+    if print_stats or stats_json or prometheus_textfile:
+        stats.enable()
+        # Also reported if the sort fails, e.g. to see how far a slow ingest got
+        click.get_current_context().call_on_close(
+            partial(
+                report_stats,
+                print_stats=print_stats,
+                stats_json=stats_json,
+                prometheus_textfile=prometheus_textfile,
+            ),
+        )
+    if stream and (timelapse or split_timelapses):
+        raise click.UsageError("--stream can't be combined with --timelapse, which needs all files to be read first")
+    if stream and len(src) > 1:
+        raise click.UsageError("--stream can only be used with a single SRC")
+    if sample_interval and not (timelapse or split_timelapses):
+        raise click.UsageError("--sample-interval requires --timelapse or --split-timelapses")
+    scheduler.set_device_jobs(device_jobs)
+    proxy_settings = ProxySettings(
+        height=proxy_height,
+        encoder_threads=proxy_threads,
+        cache_dir=None if no_cache else ProxySettings.cache_dir,
+    )
 
     check_if_exiftool_installed()
-    dcim_transfers = get_dcim_transfers(source_path=src, destination_path=dst, time_offset=time_offset)
-
-    if timelapse:
-        dcim_transfers = patch_dcim_transfers_for_timelapse(dcim_transfers=dcim_transfers, dry_run=dry_run)
-
-    check_dcim_transfers(dcim_transfers=dcim_transfers, timelapse=timelapse)
-
-    for dcim_transfer in dcim_transfers:
-        if not dry_run:
-            source_checksum = get_checksum(file=dcim_transfer.source_path, skip=skip_checksum)
-            click.secho(f"Copying {dcim_transfer.source_path} to {dcim_transfer.target_path} ... ", nl=False)
-            copy_media_to_target(source_path=dcim_transfer.source_path, target_path=dcim_transfer.target_path)
-            click.secho("OK", fg="green", nl=False)
-            update_file_modify_date(
-                file_path=dcim_transfer.target_path,
-                rectified_modify_date=dcim_transfer.rectified_modify_date,
+    if stream and not dry_run:
+        stream_sort_dcim(
+            src=get_single_value(src),
+            dst=dst,
+            time_offset=time_offset,
+            skip_checksum=skip_checksum,
+            hash_algorithm=hash_algorithm,
+            skip_verify=skip_verify,
+            delete=delete,
+            batch_size=batch_size,
+            no_cache=no_cache,
+            jobs=jobs,
+            metadata_backend=metadata_backend,
+            copy_jobs=copy_jobs,
+            resume=resume,
+        )
+        return
+
+    if len(src) > 1:
+        sort_cards(
+            src=src,
+            dst=dst,
+            time_offset=time_offset,
+            timelapse=timelapse,
+            split_timelapses=split_timelapses,
+            sample_interval=sample_interval,
+            proxy_settings=proxy_settings,
+            skip_checksum=skip_checksum,
+            hash_algorithm=hash_algorithm,
+            skip_verify=skip_verify,
+            dry_run=dry_run,
+            delete=delete,
+            batch_size=batch_size,
+            no_cache=no_cache,
+            jobs=jobs,
+            metadata_backend=metadata_backend,
+            copy_jobs=copy_jobs,
+            resume=resume,
+        )
+        return
+
+    journal = TransferJournal(destination_path=dst)
+    with open_metadata_cache(metadata_backend=metadata_backend, no_cache=no_cache) as cache:
+        dcim_transfers = plan_dcim_transfers(
+            src=get_single_value(src),
+            dst=dst,
+            time_offset=time_offset,
+            timelapse=timelapse,
+            split_timelapses=split_timelapses,
+            sample_interval=sample_interval,
+            proxy_settings=proxy_settings,
+            dry_run=dry_run,
+            batch_size=batch_size,
+            cache=cache,
+            jobs=jobs,
+            metadata_backend=metadata_backend,
+            journal=journal if resume else None,
+        )
+
+    if not dry_run:
+        with open_library_index(dst) as library:
+            dcim_transfers, collisions = deduplicate_dcim_transfers(
+                dcim_transfers=dcim_transfers,
+                library=library,
+                algorithm=hash_algorithm,
+                resumed_target_paths={entry.target_path for entry in journal.load().values()} if resume else (),
+            )
+            journal.start(dcim_transfers=dcim_transfers, resume=resume)
+            copy_dcim_transfers(
+                dcim_transfers=dcim_transfers,
+                skip_checksum=skip_checksum,
+                skip_verify=skip_verify,
+                delete=delete,
+                algorithm=hash_algorithm,
+                jobs=copy_jobs,
+                journal=journal,
+                library=library,
             )
-            click.secho("  Checksum ... ", nl=False)
-            target_checksum = get_checksum(file=dcim_transfer.target_path, skip=skip_checksum)
-            click.secho("OK", fg="green")
-            if source_checksum != target_checksum:
-                raise CopyError("Target checksum does not match source checksum for {dcim_transfer.source_path.name}")
-            if delete:
-                remove_source_file(source_path=dcim_transfer.source_path)
-
-        else:
+            journal.remove()
+        check_collisions(collisions=collisions)
+    else:
+        for dcim_transfer in dcim_transfers:
             print(f"{dcim_transfer.source_path} --> {dcim_transfer.target_path}")
 
 
+def sort_cards(
+    src: Sequence[Path],
+    dst: Path,
+    time_offset: int,
+    timelapse: bool,
+    split_timelapses: bool,
+    sample_interval: Optional[int],
+    proxy_settings: ProxySettings,
+    skip_checksum: bool,
+    hash_algorithm: HashAlgorithm,
+    skip_verify: bool,
+    dry_run: bool,
+    delete: bool,
+    batch_size: int,
+    no_cache: bool,
+    jobs: Optional[int],
+    metadata_backend: MetadataBackend,
+    copy_jobs: int,
+    resume: bool,
+):
+    """Sort several cards into one library. Cards are planned and copied concurrently, and a card that fails does not
+    stop the others. Results are reported per card."""
+    journal = TransferJournal(destination_path=dst)
+    with open_metadata_cache(metadata_backend=metadata_backend, no_cache=no_cache) as cache:
+        card_results = plan_cards(
+            source_paths=src,
+            plan=lambda source_path, report_path: plan_dcim_transfers(
+                src=source_path,
+                dst=dst,
+                time_offset=time_offset,
+                timelapse=timelapse,
+                split_timelapses=split_timelapses,
+                sample_interval=sample_interval,
+                proxy_settings=proxy_settings,
+                dry_run=dry_run,
+                batch_size=batch_size,
+                cache=cache,
+                jobs=jobs,
+                metadata_backend=metadata_backend,
+                journal=journal if resume else None,
+                report_path=report_path,
+            ),
+        )
+    card_results = resolve_cross_card_targets(card_results=card_results, algorithm=hash_algorithm)
+
+    if not dry_run:
+        with open_library_index(dst) as library:
+            resumed_target_paths = {entry.target_path for entry in journal.load().values()} if resume else ()
+            journal.start(dcim_transfers=(), resume=resume)
+            card_results = copy_cards(
+                card_results=card_results,
+                skip_checksum=skip_checksum,
+                skip_verify=skip_verify,
+                delete=delete,
+                algorithm=hash_algorithm,
+                jobs=copy_jobs,
+                journal=journal,
+                library=library,
+                resumed_target_paths=resumed_target_paths,
+            )
+            # Kept for --resume if any card failed
+            if not any(card_result.error for card_result in card_results):
+                journal.remove()
+    else:
+        for card_result in card_results:
+            for dcim_transfer in card_result.dcim_transfers:
+                print(f"{dcim_transfer.source_path} --> {dcim_transfer.target_path}")
+
+    print_card_results(card_results=card_results, dry_run=dry_run)
+    check_card_results(card_results=card_results)
+
+
+def stream_sort_dcim(
+    src: Path,
+    dst: Path,
+    time_offset: int,
+    skip_checksum: bool,
+    hash_algorithm: HashAlgorithm,
+    skip_verify: bool,
+    delete: bool,
+    batch_size: int,
+    no_cache: bool,
+    jobs: Optional[int],
+    metadata_backend: MetadataBackend,
+    copy_jobs: int,
+    resume: bool,
+):
+    journal = TransferJournal(destination_path=dst)
+    with (
+        open_metadata_cache(metadata_backend=metadata_backend, no_cache=no_cache) as cache,
+        open_library_index(dst) as library,
+    ):
+        collisions = stream_dcim_transfers(
+            dcim_transfers=iter_dcim_transfers(
+                source_path=src,
+                destination_path=dst,
+                time_offset=time_offset,
+                batch_size=batch_size,
+                cache=cache,
+                jobs=jobs or get_default_jobs(src),
+                backend=metadata_backend,
+            ),
+            skip_checksum=skip_checksum,
+            skip_verify=skip_verify,
+            delete=delete,
+            algorithm=hash_algorithm,
+            jobs=copy_jobs,
+            journal=journal,
+            library=library,
+            resume=resume,
+        )
+        journal.remove()
+    check_collisions(collisions=collisions)
+
+
 if __name__ == "__main__":
     main()
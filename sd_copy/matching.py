@@ -0,0 +1,70 @@
+import re
+from collections import deque
+from typing import Collection, Iterable, Iterator, Optional
+
+TARGET_TIMESTAMP_PATTERN = re.compile(r"\d{8}-\d{4}(\d{2})?")
+
+
+def get_original_stem_token(target_stem: str) -> Optional[str]:
+    """Original stem part of a target file name `timestamp_camera_STEM_...`, as created by `get_target_path`"""
+    parts = target_stem.split("_")
+    if len(parts) >= 3 and TARGET_TIMESTAMP_PATTERN.fullmatch(parts[0]):
+        return parts[2]
+    return None
+
+
+class AhoCorasickMatcher:
+    """Multi-pattern substring matcher. Scanning a text takes time linear in its length, independent of the number of
+    patterns."""
+
+    def __init__(self, patterns: Iterable[str]):
+        self._transitions: list[dict[str, int]] = [{}]
+        self._outputs: list[set[str]] = [set()]
+        self._fail: list[int] = [0]
+        for pattern in patterns:
+            state = 0
+            for character in pattern:
+                if character not in self._transitions[state]:
+                    self._transitions.append({})
+                    self._outputs.append(set())
+                    self._fail.append(0)
+                    self._transitions[state][character] = len(self._transitions) - 1
+                state = self._transitions[state][character]
+            self._outputs[state].add(pattern)
+
+        queue = deque(self._transitions[0].values())
+        while queue:
+            state = queue.popleft()
+            for character, next_state in self._transitions[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and character not in self._transitions[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._transitions[fail].get(character, 0)
+                if self._fail[next_state] == next_state:
+                    self._fail[next_state] = 0
+                self._outputs[next_state] |= self._outputs[self._fail[next_state]]
+
+    def iter_matches(self, text: str) -> Iterator[str]:
+        state = 0
+        for character in text:
+            while state and character not in self._transitions[state]:
+                state = self._fail[state]
+            state = self._transitions[state].get(character, 0)
+            yield from self._outputs[state]
+
+
+def get_unmatched_stems(stems: Collection[str], sorted_stems: Collection[str]) -> set[str]:
+    """Stems that are not a substring of any sorted stem. Most stems are found by hashed lookup of the original stem
+    token of sorted file names. The remaining stems are matched against all sorted stems in a single pass, which
+    keeps the exact substring semantics for non-conforming names, such as timelapse frames."""
+    tokens = {token for sorted_stem in sorted_stems if (token := get_original_stem_token(sorted_stem))}
+    if not (unmatched_stems := {stem for stem in stems if stem not in tokens}):
+        return unmatched_stems
+
+    matcher = AhoCorasickMatcher(patterns=unmatched_stems)
+    for sorted_stem in sorted_stems:
+        unmatched_stems.difference_update(matcher.iter_matches(sorted_stem))
+        if not unmatched_stems:
+            break
+    return unmatched_stems
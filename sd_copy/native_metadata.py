@@ -0,0 +1,251 @@
+import mmap
+import struct
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Iterator, Optional
+
+from more_itertools import batched
+
+from sd_copy.utils import UnexpectedDataError
+
+NATIVE_READER_VERSION = "1"
+
+JPEG_SOI = b"\xff\xd8"
+JPEG_SOS = 0xDA
+JPEG_APP1 = 0xE1
+EXIF_HEADER = b"Exif\x00\x00"
+RAF_MAGIC = b"FUJIFILMCCD-RAW "
+RAF_JPEG_OFFSET = 84
+TIFF_HEADERS = {b"II*\x00": "<", b"MM\x00*": ">"}
+FUJIFILM_MVTG_IFD_OFFSET = 16  # Fujifilm MOV files hold a little-endian EXIF IFD 16 bytes into the udta/MVTG atom
+QUICKTIME_EPOCH = datetime(1904, 1, 1)
+QUICKTIME_CONTAINERS = {b"moov", b"trak", b"mdia", b"minf", b"stbl", b"udta"}
+
+TAG_IMAGE_WIDTH = 0x0100
+TAG_IMAGE_HEIGHT = 0x0101
+TAG_MODEL = 0x0110
+TAG_EXIF_IFD = 0x8769
+TAG_DATE_TIME_ORIGINAL = 0x9003
+TAG_SHUTTER_SPEED_VALUE = 0x9201
+TAG_EXIF_IMAGE_WIDTH = 0xA002
+TAG_EXIF_IMAGE_HEIGHT = 0xA003
+
+# TIFF field type: (struct format, size in bytes)
+TIFF_TYPES = {
+    1: ("B", 1),
+    2: ("s", 1),
+    3: ("H", 2),
+    4: ("I", 4),
+    5: ("II", 8),
+    7: ("B", 1),
+    9: ("i", 4),
+    10: ("ii", 8),
+}
+
+
+class NativeMetadataError(UnexpectedDataError):
+    pass
+
+
+def get_exiftool_number(value: float) -> int | float:
+    # Exiftool's JSON output writes integral numbers without decimals
+    return int(value) if value == int(value) else value
+
+
+def get_exiftool_exposure_time(apex_value: float) -> str | int | float:
+    # Mirrors exiftool's ShutterSpeedValue conversion (2^-APEX) and its PrintExposureTime formatting
+    seconds = 2 ** (-apex_value) if abs(apex_value) < 100 else 0
+    if 0 < seconds < 0.25001:
+        return f"1/{int(0.5 + 1 / seconds)}"
+    return get_exiftool_number(float(f"{seconds:.1f}"))
+
+
+def get_file_modify_date(path: Path) -> str:
+    modify_date = datetime.fromtimestamp(path.stat().st_mtime).astimezone()
+    offset = modify_date.strftime("%z")
+    return f"{modify_date:%Y:%m:%d %H:%M:%S}{offset[:3]}:{offset[3:]}"
+
+
+def read_tiff_value(buffer: bytes, base: int, endian: str, field_type: int, count: int, value_offset: int):
+    type_format, type_size = TIFF_TYPES[field_type]
+    if type_size * count > 4:
+        (value_offset,) = struct.unpack_from(f"{endian}I", buffer, value_offset)
+        value_offset += base
+    if field_type == 2:
+        return bytes(buffer[value_offset : value_offset + count]).split(b"\x00")[0].decode().strip()
+    values = struct.unpack_from(f"{endian}{type_format * count}", buffer, value_offset)
+    if field_type in (5, 10):
+        return tuple(numerator / denominator if denominator else 0 for numerator, denominator in batched(values, 2))
+    return values
+
+
+def read_ifd(buffer: bytes, base: int, offset: int, endian: str) -> dict[int, tuple]:
+    (n_entries,) = struct.unpack_from(f"{endian}H", buffer, base + offset)
+    entries = {}
+    for entry_offset in range(base + offset + 2, base + offset + 2 + 12 * n_entries, 12):
+        tag, field_type, count = struct.unpack_from(f"{endian}HHI", buffer, entry_offset)
+        if field_type in TIFF_TYPES:
+            entries[tag] = (field_type, count, entry_offset + 8)
+    return entries
+
+
+def get_ifd_value(buffer: bytes, base: int, endian: str, ifd: dict[int, tuple], tag: int):
+    field_type, count, value_offset = ifd[tag]
+    value = read_tiff_value(buffer, base, endian, field_type, count, value_offset)
+    return value if isinstance(value, str) else value[0]
+
+
+def read_exif_ifds(buffer: bytes, base: int, endian: str, ifd0_offset: int) -> dict[str, str | int | float]:
+    ifd0 = read_ifd(buffer, base, ifd0_offset, endian)
+    exif_ifd = read_ifd(buffer, base, get_ifd_value(buffer, base, endian, ifd0, TAG_EXIF_IFD), endian)
+
+    tags = {
+        "EXIF:Model": (ifd0, TAG_MODEL, str),
+        "EXIF:ImageWidth": (ifd0, TAG_IMAGE_WIDTH, int),
+        "EXIF:ImageHeight": (ifd0, TAG_IMAGE_HEIGHT, int),
+        "EXIF:DateTimeOriginal": (exif_ifd, TAG_DATE_TIME_ORIGINAL, str),
+        "EXIF:ExifImageWidth": (exif_ifd, TAG_EXIF_IMAGE_WIDTH, int),
+        "EXIF:ExifImageHeight": (exif_ifd, TAG_EXIF_IMAGE_HEIGHT, int),
+        "EXIF:ShutterSpeedValue": (exif_ifd, TAG_SHUTTER_SPEED_VALUE, get_exiftool_exposure_time),
+    }
+    return {
+        name: convert(get_ifd_value(buffer, base, endian, ifd, tag))
+        for name, (ifd, tag, convert) in tags.items()
+        if tag in ifd
+    }
+
+
+def read_tiff(buffer: bytes, base: int) -> dict[str, str | int | float]:
+    if (endian := TIFF_HEADERS.get(bytes(buffer[base : base + 4]))) is None:
+        raise NativeMetadataError("TIFF header not found")
+    (ifd0_offset,) = struct.unpack_from(f"{endian}I", buffer, base + 4)
+    return read_exif_ifds(buffer, base, endian, ifd0_offset)
+
+
+def read_jpeg(buffer: bytes, offset: int = 0) -> dict[str, str | int | float]:
+    if buffer[offset : offset + 2] != JPEG_SOI:
+        raise NativeMetadataError("JPEG start of image marker not found")
+    position = offset + 2
+    while position + 4 <= len(buffer) and buffer[position] == 0xFF and (marker := buffer[position + 1]) != JPEG_SOS:
+        (length,) = struct.unpack_from(">H", buffer, position + 2)
+        if marker == JPEG_APP1 and buffer[position + 4 : position + 10] == EXIF_HEADER:
+            return read_tiff(buffer, base=position + 10)
+        position += 2 + length
+    raise NativeMetadataError("No EXIF segment found")
+
+
+def read_raf(buffer: bytes) -> dict[str, str | int | float]:
+    (jpeg_offset,) = struct.unpack_from(">I", buffer, RAF_JPEG_OFFSET)
+    return read_jpeg(buffer, offset=jpeg_offset)
+
+
+def iter_boxes(buffer: bytes, start: int, end: int) -> Iterator[tuple[bytes, int, int]]:
+    """Yield (type, payload start, payload end) of the QuickTime boxes between `start` and `end`"""
+    position = start
+    while position + 8 <= end:
+        size, box_type = struct.unpack_from(">I4s", buffer, position)
+        header_size = 8
+        if size == 1:
+            (size,) = struct.unpack_from(">Q", buffer, position + 8)
+            header_size = 16
+        elif size == 0:
+            size = end - position
+        if size < header_size:
+            raise NativeMetadataError(f"Invalid size of QuickTime box '{box_type}'")
+        yield box_type, position + header_size, position + size
+        position += size
+
+
+def iter_box_tree(buffer: bytes, start: int, end: int, path: tuple = ()) -> Iterator[tuple[tuple, int, int]]:
+    for box_type, payload_start, payload_end in iter_boxes(buffer, start, end):
+        yield (*path, box_type), payload_start, payload_end
+        if box_type in QUICKTIME_CONTAINERS:
+            yield from iter_box_tree(buffer, payload_start, payload_end, path=(*path, box_type))
+
+
+def get_quicktime_date(seconds: int) -> str:
+    return f"{QUICKTIME_EPOCH + timedelta(seconds=seconds):%Y:%m:%d %H:%M:%S}"
+
+
+def read_mdhd(buffer: bytes, start: int) -> tuple[int, int]:
+    # Returns creation time and timescale, for both 32-bit (version 0) and 64-bit (version 1) boxes
+    if buffer[start] == 1:
+        creation_time, _, timescale = struct.unpack_from(">QQI", buffer, start + 4)
+    else:
+        creation_time, _, timescale = struct.unpack_from(">III", buffer, start + 4)
+    return creation_time, timescale
+
+
+def read_stts_frame_rate(buffer: bytes, start: int, timescale: int) -> Optional[float]:
+    (n_entries,) = struct.unpack_from(">I", buffer, start + 4)
+    entries = struct.unpack_from(f">{2 * n_entries}I", buffer, start + 8)
+    n_samples = sum(entries[0::2])
+    duration = sum(count * delta for count, delta in zip(entries[0::2], entries[1::2]))
+    if not duration:
+        return None
+    return get_exiftool_number(int(n_samples * timescale / duration * 1000 + 0.5) / 1000)
+
+
+def read_embedded_exif(buffer: bytes, start: int, end: int) -> dict[str, str | int | float]:
+    for header, endian in TIFF_HEADERS.items():
+        if (tiff_start := bytes(buffer[start:end]).find(header)) >= 0:
+            return read_tiff(buffer, base=start + tiff_start)
+    return read_exif_ifds(buffer, base=start, endian="<", ifd0_offset=FUJIFILM_MVTG_IFD_OFFSET)
+
+
+def read_quicktime(buffer: bytes) -> dict[str, str | int | float]:
+    metadata = {}
+    tracks = []
+    for path, start, end in iter_box_tree(buffer, 0, len(buffer)):
+        if path == (b"ftyp",):
+            metadata["File:MIMEType"] = "video/quicktime" if buffer[start : start + 4] == b"qt  " else "video/mp4"
+        elif path == (b"moov", b"trak"):
+            tracks.append({})
+        elif path == (b"moov", b"trak", b"tkhd"):
+            width, height = struct.unpack_from(">II", buffer, end - 8)
+            tracks[-1].update(width=width >> 16, height=height >> 16)
+        elif path == (b"moov", b"trak", b"mdia", b"mdhd"):
+            tracks[-1]["creation_time"], tracks[-1]["timescale"] = read_mdhd(buffer, start)
+        elif path == (b"moov", b"trak", b"mdia", b"hdlr"):
+            tracks[-1]["handler_type"] = bytes(buffer[start + 8 : start + 12])
+            if name := bytes(buffer[start + 24 : end]).split(b"\x00")[0].decode("latin-1"):
+                metadata["QuickTime:HandlerDescription"] = name
+        elif path == (b"moov", b"trak", b"mdia", b"minf", b"stbl", b"stts"):
+            tracks[-1]["frame_rate"] = read_stts_frame_rate(buffer, start, tracks[-1]["timescale"])
+        elif path[:2] == (b"moov", b"udta") and len(path) == 3:
+            try:
+                metadata |= read_embedded_exif(buffer, start, end)
+            except (NativeMetadataError, KeyError, struct.error):
+                pass
+
+    if not (video_track := next((track for track in tracks if track.get("handler_type") == b"vide"), None)):
+        raise NativeMetadataError("No video track found")
+    return metadata | {
+        "QuickTime:MediaCreateDate": get_quicktime_date(video_track["creation_time"]),
+        "QuickTime:ImageWidth": video_track["width"],
+        "QuickTime:ImageHeight": video_track["height"],
+        "QuickTime:VideoFrameRate": video_track["frame_rate"],
+    }
+
+
+def get_metadata_from_native_reader(media_file: Path) -> dict[str, str | int | float]:
+    """Read the metadata needed for sorting directly from file headers, returning it with the same keys and value
+    formatting as `exiftool -j -G`. The file is memory-mapped, so only pages holding headers are read from disk.
+    Raises NativeMetadataError for files that can't be handled, which should then be passed on to exiftool."""
+    suffix = media_file.suffix.lower()
+    try:
+        with media_file.open("rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            if suffix in (".jpg", ".jpeg"):
+                metadata = read_jpeg(buffer) | {"File:MIMEType": "image/jpeg"}
+            elif suffix == ".raf" and buffer[: len(RAF_MAGIC)] == RAF_MAGIC:
+                metadata = read_raf(buffer) | {"File:MIMEType": "image/x-fujifilm-raf"}
+            elif suffix == ".dng":
+                metadata = read_tiff(buffer, base=0) | {"File:MIMEType": "image/x-adobe-dng"}
+            elif suffix in (".mov", ".mp4"):
+                metadata = read_quicktime(buffer)
+            else:
+                raise NativeMetadataError(f"Unsupported file type '{media_file.suffix}'")
+    except (KeyError, IndexError, ValueError, struct.error, UnicodeDecodeError) as e:
+        raise NativeMetadataError(f"Could not read metadata of {media_file.name}: {e!r}") from e
+
+    return {"SourceFile": str(media_file), "File:FileModifyDate": get_file_modify_date(media_file), **metadata}
@@ -0,0 +1,164 @@
+import logging
+import statistics
+from dataclasses import replace
+from datetime import datetime
+from functools import partial
+from pathlib import Path
+from typing import Optional, Sequence
+
+from more_itertools import bucket, pairwise
+
+from sd_copy.cache import MetadataCache
+from sd_copy.check import IMAGE_EXTENSIONS
+from sd_copy.dcim_transfer import (
+    DCIMTransfer,
+    MetadataBackend,
+    get_dcim_transfers,
+    get_media_files,
+    get_rectified_modify_date,
+    get_sanitized_file_name,
+    get_target_path,
+)
+
+MAX_SAMPLE_DEVIATION = 2  # seconds, FAT filesystems store modification times at a resolution of 2 s
+
+
+def get_sample_files(media_files: Sequence[Path], sample_interval: int) -> Sequence[Path]:
+    """Files to extract metadata from: all files that are not images, and of the images of each extension the first,
+    the last and every `sample_interval`-th file, as well as both files around each outlier interval between the
+    modification times of consecutive files, such as where one timelapse ends and the next one starts."""
+    files_by_extension = bucket(media_files, key=lambda media_file: media_file.suffix.lower())
+    sample_files = []
+    for extension in files_by_extension:
+        files = tuple(sorted(files_by_extension[extension]))
+        if extension not in IMAGE_EXTENSIONS:
+            sample_files.extend(files)
+            continue
+        mtimes = tuple(file.stat().st_mtime for file in files)
+        intervals = tuple(mtime - previous_mtime for previous_mtime, mtime in pairwise(mtimes))
+        median_interval = statistics.median(intervals) if intervals else 0
+        indices = {0, len(files) - 1, *range(0, len(files), sample_interval)}
+        for index, interval in enumerate(intervals, start=1):
+            if abs(interval - median_interval) > MAX_SAMPLE_DEVIATION:
+                indices.update((index - 1, index))
+        sample_files.extend(files[index] for index in indices)
+    return tuple(sorted(sample_files))
+
+
+def have_consistent_samples(sampled_transfers: Sequence[DCIMTransfer]) -> bool:
+    """Whether the metadata of sampled images of each extension only differs in the recording time, and the recording
+    times follow the modification times of the files"""
+    transfers_by_extension = bucket(sampled_transfers, key=lambda dcim_transfer: dcim_transfer.metadata.extension)
+    for extension in filter(lambda extension: extension in IMAGE_EXTENSIONS, transfers_by_extension):
+        transfers = sorted(transfers_by_extension[extension], key=lambda dcim_transfer: dcim_transfer.source_path)
+        settings = {
+            (
+                transfer.metadata.camera.name,
+                transfer.metadata.mime_type,
+                transfer.metadata.resolution,
+                transfer.metadata.shutter_speed,
+            )
+            for transfer in transfers
+        }
+        if len(settings) > 1:
+            logging.info(f"Sampled {extension} files differ in camera, resolution or shutter speed: {settings}")
+            return False
+        for previous, transfer in pairwise(transfers):
+            exif_interval = transfer.metadata.exif_date - previous.metadata.exif_date
+            file_interval = transfer.metadata.file_modify_date - previous.metadata.file_modify_date
+            if abs((exif_interval - file_interval).total_seconds()) > MAX_SAMPLE_DEVIATION:
+                logging.info(f"Recording time of {transfer.source_path.name} does not match its modification time")
+                return False
+    return True
+
+
+def get_derived_dcim_transfer(
+    media_file: Path,
+    sampled_transfer: DCIMTransfer,
+    destination_path: Path,
+    time_offset: int,
+) -> DCIMTransfer:
+    """Transfer of `media_file` with the metadata of a sampled file of the same sequence, recorded as much earlier or
+    later as the file was modified"""
+    sampled_metadata = sampled_transfer.metadata
+    file_modify_date = datetime.fromtimestamp(
+        int(media_file.stat().st_mtime),
+        tz=sampled_metadata.file_modify_date.tzinfo,
+    )
+    metadata = replace(
+        sampled_metadata,
+        file_modify_date=file_modify_date,
+        file_name=get_sanitized_file_name(path=media_file),
+        exif_date=sampled_metadata.exif_date + (file_modify_date - sampled_metadata.file_modify_date),
+    )
+    rectified_modify_date = get_rectified_modify_date(metadata=metadata, time_offset=time_offset)
+    return DCIMTransfer(
+        source_path=media_file,
+        metadata=metadata,
+        rectified_modify_date=rectified_modify_date,
+        target_path=get_target_path(
+            destination=destination_path,
+            metadata=metadata,
+            rectified_date=rectified_modify_date,
+        ),
+    )
+
+
+def get_sampled_dcim_transfers(
+    source_path: Path,
+    destination_path: Path,
+    time_offset: int,
+    sample_interval: int,
+    batch_size: int,
+    cache: Optional[MetadataCache] = None,
+    jobs: int = 1,
+    backend: MetadataBackend = MetadataBackend.exiftool,
+) -> Sequence[DCIMTransfer]:
+    """Transfers of a timelapse card, extracting metadata of samples only. Timelapse images of the same extension
+    share all metadata but their recording time, which is derived from the file modification time relative to the
+    closest earlier sample. If the samples don't agree on this, metadata of all files is extracted."""
+    media_files = get_media_files(source_path=source_path)
+    extract = partial(
+        get_dcim_transfers,
+        source_path=source_path,
+        destination_path=destination_path,
+        time_offset=time_offset,
+        batch_size=batch_size,
+        cache=cache,
+        jobs=jobs,
+        backend=backend,
+    )
+    sample_files = get_sample_files(media_files=media_files, sample_interval=sample_interval)
+    sampled_transfers = {
+        dcim_transfer.source_path: dcim_transfer for dcim_transfer in extract(media_files=sample_files)
+    }
+    logging.info(f"Extracted metadata of {len(sample_files)} samples of {len(media_files)} files")
+
+    if not have_consistent_samples(tuple(sampled_transfers.values())):
+        logging.warning("Sampled metadata is not consistent, extracting metadata of all files")
+        extracted_transfers = extract(
+            media_files=tuple(media_file for media_file in media_files if media_file not in sampled_transfers),
+        )
+        return tuple(
+            sorted(
+                (*sampled_transfers.values(), *extracted_transfers),
+                key=lambda dcim_transfer: dcim_transfer.source_path,
+            ),
+        )
+
+    dcim_transfers = []
+    closest_samples = {}
+    for media_file in media_files:
+        if sampled_transfer := sampled_transfers.get(media_file):
+            closest_samples[media_file.suffix.lower()] = sampled_transfer
+            dcim_transfers.append(sampled_transfer)
+        else:
+            dcim_transfers.append(
+                get_derived_dcim_transfer(
+                    media_file=media_file,
+                    sampled_transfer=closest_samples[media_file.suffix.lower()],
+                    destination_path=destination_path,
+                    time_offset=time_offset,
+                ),
+            )
+    return tuple(dcim_transfers)
@@ -0,0 +1,217 @@
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from enum import StrEnum, auto
+from pathlib import Path
+from typing import Iterator, Optional, Sequence
+
+PROFILE_PATH = Path("sd_copy.prof")
+PERCENTILES = (50, 90, 99)
+
+
+class Stage(StrEnum):
+    scan = auto()
+    exiftool = auto()
+    image_or_video = auto()
+    check = auto()
+    copy = auto()
+    checksum = auto()
+    utime = auto()
+
+
+@dataclass
+class StageStats:
+    durations: list[float] = field(default_factory=list)
+    n_bytes: int = 0
+
+    @property
+    def total_time(self) -> float:
+        return sum(self.durations)
+
+    @property
+    def bytes_per_second(self) -> float:
+        return self.n_bytes / self.total_time if self.total_time else 0.0
+
+
+def get_percentile(sorted_values: Sequence[float], percentile: int) -> float:
+    """Nearest-rank percentile"""
+    return sorted_values[max(0, math.ceil(percentile / 100 * len(sorted_values)) - 1)] if sorted_values else 0.0
+
+
+class StatsCollector:
+    """Timings of the stages of a run. Stages can be timed from several threads; their total time is the sum over all
+    calls, so that for concurrent stages it can exceed the wall clock time. Stages can be nested, e.g. the source is
+    hashed within the copy stage for copies on the same device. Timing is a no-op unless enabled."""
+
+    def __init__(self):
+        self.enabled = False
+        self.start_time = time.perf_counter()
+        self._stages: dict[str, StageStats] = {}
+        self._lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+        self.start_time = time.perf_counter()
+        with self._lock:
+            self._stages.clear()
+
+    def add(self, name: str, duration: float, n_bytes: int = 0):
+        with self._lock:
+            stage_stats = self._stages.setdefault(name, StageStats())
+            stage_stats.durations.append(duration)
+            stage_stats.n_bytes += n_bytes
+
+    def get_report(self) -> dict:
+        with self._lock:
+            stages = {name: (sorted(stats.durations), stats) for name, stats in self._stages.items()}
+        return {
+            "wall_clock_seconds": time.perf_counter() - self.start_time,
+            "stages": {
+                name: {
+                    "calls": len(durations),
+                    "total_seconds": stats.total_time,
+                    "bytes": stats.n_bytes,
+                    "bytes_per_second": stats.bytes_per_second,
+                    **{f"p{percentile}_seconds": get_percentile(durations, percentile) for percentile in PERCENTILES},
+                }
+                for name, (durations, stats) in stages.items()
+            },
+        }
+
+    def get_summary(self) -> str:
+        report = self.get_report()
+        lines = [
+            f"{'Stage':<16}{'Calls':>8}{'Total [s]':>12}"
+            + "".join(f"{f'p{percentile} [ms]':>12}" for percentile in PERCENTILES)
+            + f"{'MB/s':>10}",
+        ]
+        for name, stage_report in report["stages"].items():
+            lines.append(
+                f"{name:<16}{stage_report['calls']:>8}{stage_report['total_seconds']:>12.2f}"
+                + "".join(f"{stage_report[f'p{percentile}_seconds'] * 1000:>12.1f}" for percentile in PERCENTILES)
+                + (f"{stage_report['bytes_per_second'] / 1e6:>10.1f}" if stage_report["bytes"] else f"{'-':>10}"),
+            )
+        lines.append(f"Wall clock: {report['wall_clock_seconds']:.2f} s")
+        return "\n".join(lines)
+
+    def write_json(self, path: Path):
+        path.write_text(json.dumps(self.get_report(), indent=2))
+
+    def write_prometheus_textfile(self, path: Path):
+        """Write metrics in the Prometheus text format, e.g. for the node exporter textfile collector. The file is
+        replaced atomically, so that the collector never reads a partial file."""
+        report = self.get_report()
+        lines = [
+            "# HELP sd_copy_wall_clock_seconds Wall clock time of the last run",
+            "# TYPE sd_copy_wall_clock_seconds gauge",
+            f"sd_copy_wall_clock_seconds {report['wall_clock_seconds']}",
+        ]
+        for metric, key, description in (
+            ("sd_copy_stage_calls", "calls", "Number of calls per stage"),
+            ("sd_copy_stage_seconds", "total_seconds", "Time spent per stage, summed over all calls"),
+            ("sd_copy_stage_bytes", "bytes", "Bytes processed per stage"),
+        ):
+            lines.extend((f"# HELP {metric} {description} in the last run", f"# TYPE {metric} gauge"))
+            lines.extend(
+                f'{metric}{{stage="{name}"}} {stage_report[key]}' for name, stage_report in report["stages"].items()
+            )
+        lines.extend(
+            (
+                "# HELP sd_copy_stage_latency_seconds Latency per call in the last run",
+                "# TYPE sd_copy_stage_latency_seconds gauge",
+            ),
+        )
+        lines.extend(
+            f'sd_copy_stage_latency_seconds{{stage="{name}",quantile="{percentile / 100}"}} '
+            f"{stage_report[f'p{percentile}_seconds']}"
+            for name, stage_report in report["stages"].items()
+            for percentile in PERCENTILES
+        )
+        temporary_path = path.with_name(f".{path.name}.tmp")
+        temporary_path.write_text("\n".join(lines) + "\n")
+        os.replace(temporary_path, path)
+
+
+class Tracer:
+    """Spans of a run in the Chrome trace event format, which can be opened in chrome://tracing or Perfetto. Each span
+    is recorded as a complete event on the thread it ran on, so that concurrent copies or exiftool requests show up
+    side by side. Tracing is a no-op unless enabled."""
+
+    def __init__(self):
+        self.enabled = False
+        self.start_time = time.perf_counter()
+        self._events: list[dict] = []
+        self._thread_names: dict[int, str] = {}
+        self._lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+        self.start_time = time.perf_counter()
+        with self._lock:
+            self._events.clear()
+            self._thread_names.clear()
+
+    def add(self, name: str, category: str, start: float, end: float, args: dict):
+        thread = threading.current_thread()
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": (start - self.start_time) * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": os.getpid(),
+            "tid": thread.ident,
+            "args": args,
+        }
+        with self._lock:
+            self._events.append(event)
+            self._thread_names[thread.ident] = thread.name
+
+    def get_events(self) -> Sequence[dict]:
+        with self._lock:
+            thread_names = tuple(
+                {"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}}
+                for tid, name in self._thread_names.items()
+            )
+            return (*thread_names, *self._events)
+
+    def write(self, path: Path):
+        path.write_text(json.dumps({"traceEvents": self.get_events(), "displayTimeUnit": "ms"}))
+
+
+stats = StatsCollector()
+tracer = Tracer()
+
+
+@contextmanager
+def span(name: str, category: str, **args) -> Iterator[None]:
+    """Trace a span, without adding it to the stage statistics, e.g. for requests to subprocesses"""
+    if not tracer.enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        tracer.add(name, category=category, start=start, end=time.perf_counter(), args=args)
+
+
+@contextmanager
+def stage(name: Stage, n_bytes: int = 0, file: Optional[Path] = None) -> Iterator[None]:
+    """Time a stage, and trace it as a span labelled with the `file` it processed"""
+    if not (stats.enabled or tracer.enabled):
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        if stats.enabled:
+            stats.add(name, duration=end - start, n_bytes=n_bytes)
+        if tracer.enabled:
+            tracer.add(name, category="stage", start=start, end=end, args={"file": str(file)} if file else {})
@@ -1,21 +1,44 @@
+import hashlib
+import math
+import os
 import subprocess
 from dataclasses import dataclass
 from datetime import datetime
 from enum import StrEnum, auto
 from operator import attrgetter
 from pathlib import Path
+from tempfile import TemporaryDirectory
 from typing import Optional, Sequence
 
 import click
-from more_itertools import bucket
+from more_itertools import bucket, divide
 
+from sd_copy.cache import CACHE_DIR
 from sd_copy.cameras import Camera
 from sd_copy.check import sort_dcim_transfers
 from sd_copy.dcim_transfer import DCIMTransfer, Extension, Image, Video, get_timestamp_str
-from sd_copy.utils import UnexpectedDataError, get_optional_single_value, get_single_value
+from sd_copy.stats import span
+from sd_copy.utils import UnexpectedDataError, get_optional_single_value, get_single_value, parallel_map
 
 TIMELAPSE_PROXY_SUFFIX = Extension.mp4
 TIMELAPSE_PROXY_FPS = 24
+TIMELAPSE_PROXY_HEIGHT = 1080
+TIMELAPSE_PROXY_CACHE_DIR = CACHE_DIR / "proxies"
+TIMELAPSE_PROXY_CACHE_MAX_SIZE = 20 * 2**30  # bytes
+TIMELAPSE_PROXY_ENCODER = ("-c:v", "libx264", "-pix_fmt", "yuv420p")
+DOWNSCALED_FRAME_PATTERN = "%06d.jpg"
+DEFAULT_DOWNSCALE_JOBS = min(os.cpu_count() or 1, 8)
+MIN_TIMELAPSE_SHOTS = 10  # regular sequences of fewer shots, such as bursts, are sorted as individual shots
+MAX_TIMELAPSE_INTERVAL_SPREAD = 2  # seconds, as accepted by compute_timedelta
+
+
+@dataclass(frozen=True)
+class ProxySettings:
+    height: int = TIMELAPSE_PROXY_HEIGHT
+    encoder_threads: int = 0  # let ffmpeg choose
+    downscale_jobs: int = DEFAULT_DOWNSCALE_JOBS
+    cache_dir: Optional[Path] = TIMELAPSE_PROXY_CACHE_DIR  # without a cache, proxies are written to the working dir
+    cache_max_size: int = TIMELAPSE_PROXY_CACHE_MAX_SIZE  # bytes, enforced by prune_proxy_cache
 
 
 @dataclass
@@ -195,22 +218,128 @@ def get_timelapse_filename(dcim_transfer: DCIMTransfer, timelapse_base_name: str
     return f"{timelapse_base_name}_{n:04d}{dcim_transfer.metadata.extension}"
 
 
-def generate_timelapse_proxy(timelapse_transfer: TimelapseTransfer, stem: str, dry_run: bool) -> Sequence[DCIMTransfer]:
+def get_proxy_cache_key(frames: Sequence[Path], proxy_settings: ProxySettings) -> str:
+    """Identity of the ordered frame set and of the proxy settings. Frames are identified by name, size and
+    modification time, which unlike device and inode numbers persist when a card is mounted again."""
+    key = hashlib.sha256(
+        f"{TIMELAPSE_PROXY_FPS} {proxy_settings.height} {' '.join(TIMELAPSE_PROXY_ENCODER)}\n".encode(),
+    )
+    for frame in frames:
+        stat = frame.stat()
+        key.update(f"{frame.name} {stat.st_size} {stat.st_mtime_ns}\n".encode())
+    return key.hexdigest()
+
+
+def get_proxy_output_path(frames: Sequence[Path], stem: str, proxy_settings: ProxySettings) -> Path:
+    if proxy_settings.cache_dir is None:
+        return Path("./") / f"{stem}{TIMELAPSE_PROXY_SUFFIX}"
+    return proxy_settings.cache_dir / f"{get_proxy_cache_key(frames, proxy_settings)}{TIMELAPSE_PROXY_SUFFIX}"
+
+
+def prune_proxy_cache(cache_dir: Path, max_size: int) -> int:
+    """Remove least recently used proxies until the cache holds at most `max_size` bytes. A proxy is marked as used
+    by its modification time, which is updated when it is reused. Returns the number of removed proxies."""
+    if not cache_dir.exists():
+        return 0
+    proxies = sorted(
+        ((proxy, proxy.stat()) for proxy in cache_dir.iterdir() if proxy.is_file()),
+        key=lambda proxy_and_stat: proxy_and_stat[1].st_mtime_ns,
+        reverse=True,
+    )
+    size = 0
+    removed = 0
+    for proxy, proxy_stat in proxies:
+        size += proxy_stat.st_size
+        if size > max_size:
+            proxy.unlink(missing_ok=True)
+            removed += 1
+    return removed
+
+
+def get_concat_list_entry(frame: Path) -> str:
+    escaped_path = str(frame.absolute()).replace("'", "'\\''")
+    return f"file '{escaped_path}'\n"
+
+
+def write_concat_list(frames: Sequence[Path], path: Path):
+    """Input list for the ffmpeg concat demuxer, which reads the frames in the given order"""
+    path.write_text("".join(get_concat_list_entry(frame) for frame in frames))
+
+
+def downscale_frames(frames: Sequence[Path], output_dir: Path, start_number: int, height: int):
+    concat_list_path = output_dir / f"frames_{start_number:06d}.txt"
+    write_concat_list(frames, concat_list_path)
+    with span("ffmpeg", category="subprocess", output=str(output_dir), frames=len(frames)):
+        subprocess.run(
+            (
+                *("ffmpeg", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", str(concat_list_path)),
+                *("-vf", f"scale=-2:{height}", "-vsync", "passthrough", "-q:v", "2"),
+                *("-start_number", str(start_number), str(output_dir / DOWNSCALED_FRAME_PATTERN)),
+            ),
+            check=True,
+        )
+
+
+def encode_timelapse_proxy(frames: Sequence[Path], output_path: Path, proxy_settings: ProxySettings):
+    """Downscale the frames to the proxy height in parallel, with one ffmpeg process per contiguous chunk of frames,
+    and encode the downscaled frames in order. Decoding full resolution frames takes most of the time, which a single
+    ffmpeg process does not spread over all cores. The proxy is written to a temporary file first, so that an
+    interrupted encode does not leave a partial proxy in the cache."""
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    partial_output_path = output_path.with_suffix(f".partial{TIMELAPSE_PROXY_SUFFIX}")
+    n_chunks = max(1, min(proxy_settings.downscale_jobs, math.ceil(len(frames) / 2)))
+    chunks = tuple(tuple(chunk) for chunk in divide(n_chunks, frames))
+    start_numbers = tuple(1 + sum(len(chunk) for chunk in chunks[:i]) for i in range(len(chunks)))
+    with TemporaryDirectory(prefix="sd-copy-proxy-") as downscaled_dir:
+        tuple(
+            parallel_map(
+                lambda numbered_chunk: downscale_frames(
+                    frames=numbered_chunk[1],
+                    output_dir=Path(downscaled_dir),
+                    start_number=numbered_chunk[0],
+                    height=proxy_settings.height,
+                ),
+                zip(start_numbers, chunks),
+                jobs=n_chunks,
+            ),
+        )
+        with span("ffmpeg", category="subprocess", output=str(output_path), frames=len(frames)):
+            subprocess.run(
+                (
+                    *("ffmpeg", "-loglevel", "error", "-y", "-framerate", str(TIMELAPSE_PROXY_FPS)),
+                    *("-i", str(Path(downscaled_dir) / DOWNSCALED_FRAME_PATTERN)),
+                    *(*TIMELAPSE_PROXY_ENCODER, "-threads", str(proxy_settings.encoder_threads)),
+                    *("-f", "mp4", str(partial_output_path)),
+                ),
+                check=True,
+            )
+    os.replace(partial_output_path, output_path)
+
+
+def generate_timelapse_proxy(
+    timelapse_transfer: TimelapseTransfer,
+    stem: str,
+    dry_run: bool,
+    proxy_settings: ProxySettings = ProxySettings(),
+) -> Sequence[DCIMTransfer]:
+    """Proxy video of the JPG frames, in the order of `TimelapseTransfer.jpg_files`. Proxies are cached by the
+    identity of their frames, so that a rerun, or a real run after a dry run, encodes them only once. A dry run
+    never encodes."""
     if not timelapse_transfer.jpg_files:
         click.secho("Generating timelapse proxy from RAW files not supported. Skipping proxy generation", fg="blue")
         return ()
 
     template_transfer = timelapse_transfer.jpg_files[0]
-    output_path = Path("./") / f"{stem}{TIMELAPSE_PROXY_SUFFIX}"
+    frames = tuple(dcim_transfer.source_path for dcim_transfer in timelapse_transfer.jpg_files)
+    output_path = get_proxy_output_path(frames, stem=stem, proxy_settings=proxy_settings)
 
-    if not dry_run:
-        subprocess.run(
-            f"ffmpeg -framerate {TIMELAPSE_PROXY_FPS} "
-            f"-pattern_type glob -i '{template_transfer.source_path.parent}/*{template_transfer.source_path.suffix}' "
-            f"-c:v libx264 -pix_fmt yuv420p {output_path}",
-            check=True,
-            shell=True,
-        )
+    if output_path.exists() and proxy_settings.cache_dir is not None:
+        click.secho("[Note] ", fg="blue", nl=False)
+        click.secho(f"Using cached timelapse proxy {output_path}")
+        if not dry_run:
+            os.utime(output_path)  # marks the proxy as recently used, see prune_proxy_cache
+    elif not dry_run:
+        encode_timelapse_proxy(frames=frames, output_path=output_path, proxy_settings=proxy_settings)
 
     return (
         DCIMTransfer(
@@ -222,6 +351,7 @@ def generate_timelapse_proxy(timelapse_transfer: TimelapseTransfer, stem: str, d
                 extension=TIMELAPSE_PROXY_SUFFIX,
                 mime_type="Timelapse-Proxy",
                 exif_date=template_transfer.metadata.exif_date,
+                # Labelled like the frames, as before proxies were downscaled, so that their names don't change
                 resolution=template_transfer.metadata.resolution,
                 fps=str(TIMELAPSE_PROXY_FPS),
             ),
@@ -231,11 +361,8 @@ def generate_timelapse_proxy(timelapse_transfer: TimelapseTransfer, stem: str, d
     )
 
 
-def patch_dcim_transfers_for_timelapse(dcim_transfers: Sequence[DCIMTransfer], dry_run: bool) -> Sequence[DCIMTransfer]:
-    timelapse_transfer = get_timelapse_transfer_from_dcim_transfers(dcim_transfers=dcim_transfers)
-    timelapse_spec = get_timelapse_spec_from_timelapse_transfer(timelapse_transfer=timelapse_transfer)
-
-    timelapse_stem = (
+def get_timelapse_stem(timelapse_spec: TimelapseSpec) -> str:
+    return (
         f"{get_timestamp_str(date=timelapse_spec.timestamp)}_{timelapse_spec.camera.name}_"
         f"{timelapse_spec.first_image_name}"
         f"{f'-{timelapse_spec.last_image_name}' if timelapse_spec.last_image_name else ''}"
@@ -243,6 +370,15 @@ def patch_dcim_transfers_for_timelapse(dcim_transfers: Sequence[DCIMTransfer], d
         f"{timelapse_spec.dt}s_SS{timelapse_spec.shutter_speed}"
     )
 
+
+def patch_timelapse_transfer(
+    timelapse_transfer: TimelapseTransfer,
+    dry_run: bool,
+    proxy_settings: ProxySettings = ProxySettings(),
+) -> Sequence[DCIMTransfer]:
+    timelapse_spec = get_timelapse_spec_from_timelapse_transfer(timelapse_transfer=timelapse_transfer)
+    timelapse_stem = get_timelapse_stem(timelapse_spec=timelapse_spec)
+
     patched_dcim_transfers = (
         *(
             (
@@ -256,6 +392,7 @@ def patch_dcim_transfers_for_timelapse(dcim_transfers: Sequence[DCIMTransfer], d
                 timelapse_transfer=timelapse_transfer,
                 stem=timelapse_stem,
                 dry_run=dry_run,
+                proxy_settings=proxy_settings,
             )
         ),
         *tuple(
@@ -275,3 +412,112 @@ def patch_dcim_transfers_for_timelapse(dcim_transfers: Sequence[DCIMTransfer], d
     )
 
     return patched_dcim_transfers
+
+
+def patch_dcim_transfers_for_timelapse(
+    dcim_transfers: Sequence[DCIMTransfer],
+    dry_run: bool,
+    proxy_settings: ProxySettings = ProxySettings(),
+) -> Sequence[DCIMTransfer]:
+    return patch_timelapse_transfer(
+        timelapse_transfer=get_timelapse_transfer_from_dcim_transfers(dcim_transfers=dcim_transfers),
+        dry_run=dry_run,
+        proxy_settings=proxy_settings,
+    )
+
+
+def get_shots(dcim_transfers: Sequence[DCIMTransfer]) -> Sequence[Sequence[DCIMTransfer]]:
+    """Transfers grouped by shot, i.e. the JPG and raw file the camera recorded at the same time under the same
+    name, in order of their rectified timestamp"""
+    shots: dict[tuple[Path, str], list[DCIMTransfer]] = {}
+    for dcim_transfer in dcim_transfers:
+        shots.setdefault((dcim_transfer.source_path.parent, dcim_transfer.source_path.stem), []).append(dcim_transfer)
+    return sorted(
+        shots.values(),
+        key=lambda shot: (min(dcim_transfer.rectified_modify_date for dcim_transfer in shot), shot[0].source_path),
+    )
+
+
+def get_shot_settings(shot: Sequence[DCIMTransfer]) -> Optional[tuple[str, str]]:
+    """Camera and shutter speed of a shot of images, which have to stay the same within a timelapse. None for shots
+    that can't be part of a timelapse, such as videos."""
+    if any(evaluate_timelapse_dcim_transfer_by_type(transfer) == TimelapseDCIMType.Video for transfer in shot):
+        return None
+    settings = {(transfer.metadata.camera.name, transfer.metadata.shutter_speed) for transfer in shot}
+    return get_single_value(tuple(settings)) if len(settings) == 1 else None
+
+
+def split_timelapse_sequences(
+    dcim_transfers: Sequence[DCIMTransfer],
+) -> tuple[Sequence[TimelapseTransfer], Sequence[DCIMTransfer]]:
+    """Detect timelapses in a single pass over the shots in order of their rectified timestamp. A timelapse ends where
+    the camera or shutter speed changes, or where the interval between shots leaves the range that
+    `compute_timedelta` accepts. Regular sequences of fewer than MIN_TIMELAPSE_SHOTS shots, as well as videos, are
+    returned as other transfers, to be sorted as usual."""
+    timelapse_transfers, other_transfers = [], []
+    sequence: list[Sequence[DCIMTransfer]] = []
+    intervals: tuple[float, float] = (math.inf, -math.inf)
+
+    def end_sequence(shots: Sequence[Sequence[DCIMTransfer]]):
+        transfers = tuple(transfer for shot in shots for transfer in shot)
+        if len(shots) >= MIN_TIMELAPSE_SHOTS:
+            timelapse_transfers.append(get_timelapse_transfer_from_dcim_transfers(dcim_transfers=transfers))
+        else:
+            other_transfers.extend(transfers)
+
+    def get_shot_time(shot: Sequence[DCIMTransfer]) -> datetime:
+        return min(transfer.rectified_modify_date for transfer in shot)
+
+    def get_intervals(shot: Sequence[DCIMTransfer]) -> Optional[tuple[float, float]]:
+        """Range of intervals of the current sequence if `shot` is added, or None if `shot` doesn't fit"""
+        if not sequence:
+            return math.inf, -math.inf
+        if get_shot_settings(shot) != get_shot_settings(sequence[-1]):
+            return None
+        interval = (get_shot_time(shot) - get_shot_time(sequence[-1])).total_seconds()
+        shortest, longest = min(intervals[0], interval), max(intervals[1], interval)
+        return (shortest, longest) if interval > 0 and longest - shortest <= MAX_TIMELAPSE_INTERVAL_SPREAD else None
+
+    for shot in get_shots(dcim_transfers):
+        if get_shot_settings(shot) is None:
+            other_transfers.extend(shot)
+            continue
+        if (shot_intervals := get_intervals(shot)) is None and len(sequence) == 2:
+            # A single interval doesn't establish a sequence, the second shot may start one with the current shot
+            end_sequence(sequence[:1])
+            sequence, intervals = sequence[1:], (math.inf, -math.inf)
+            shot_intervals = get_intervals(shot)
+        if shot_intervals is None:
+            end_sequence(sequence)
+            sequence, shot_intervals = [], (math.inf, -math.inf)
+        sequence.append(shot)
+        intervals = shot_intervals
+    end_sequence(sequence)
+    return tuple(timelapse_transfers), tuple(other_transfers)
+
+
+def patch_dcim_transfers_for_timelapses(
+    dcim_transfers: Sequence[DCIMTransfer],
+    dry_run: bool,
+    proxy_settings: ProxySettings = ProxySettings(),
+) -> Sequence[DCIMTransfer]:
+    """Patch each timelapse found on a card with several timelapses, next to files that are sorted as usual"""
+    timelapse_transfers, other_transfers = split_timelapse_sequences(dcim_transfers=dcim_transfers)
+    for timelapse_transfer in timelapse_transfers:
+        click.secho("[Note] ", fg="blue", nl=False)
+        click.secho(
+            f"Found timelapse of {len(timelapse_transfer.jpg_files) or len(timelapse_transfer.raw_files)} images "
+            f"starting at {get_timelapse_timestamp(timelapse_transfer=timelapse_transfer)}",
+        )
+    return (
+        *other_transfers,
+        *(
+            dcim_transfer
+            for timelapse_transfer in timelapse_transfers
+            for dcim_transfer in patch_timelapse_transfer(
+                timelapse_transfer=timelapse_transfer,
+                dry_run=dry_run,
+                proxy_settings=proxy_settings,
+            )
+        ),
+    )
@@ -1,10 +1,13 @@
 import shutil
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from datetime import datetime
 from hashlib import md5
 from pathlib import Path
-from typing import Collection, Optional, T
+from typing import Callable, Collection, Iterable, Iterator, Optional, T
 
-CHUNK_SIZE = 8192
+CHUNK_SIZE = 1024 * 1024
+MAX_PENDING_CALLS_PER_JOB = 2  # running calls and results not yet consumed, per job of parallel_map
 
 
 class UnexpectedDataError(Exception):
@@ -27,6 +30,10 @@ class CopyError(Exception):
     pass
 
 
+class ExiftoolError(Exception):
+    pass
+
+
 def check_if_exiftool_installed():
     if not shutil.which("exiftool"):
         raise MissingDependencyError("Exiftool not found, please install")
@@ -49,6 +56,41 @@ def get_optional_single_value(values: Collection[T]) -> Optional[T]:
         return get_single_value(values)
 
 
+def get_done_results(futures: deque[Future], max_running: int, max_pending: int) -> Iterator:
+    """Pop and yield results of `futures` in order, waiting until at most `max_running` of them are running and at most
+    `max_pending` are left. The error of a failed call is raised as soon as it is done, also if earlier calls are still
+    running."""
+    while True:
+        while futures and futures[0].done():
+            yield futures.popleft().result()
+        for future in futures:
+            if future.done():
+                future.result()
+        running = tuple(future for future in futures if not future.done())
+        if len(running) <= max_running and len(futures) <= max_pending:
+            return
+        wait(running, return_when=FIRST_COMPLETED)
+
+
+def parallel_map(function: Callable[..., T], iterable: Iterable, jobs: int) -> Iterator[T]:
+    """Ordered map over a thread pool. Items are only taken from `iterable` once a thread is free, so that a lazy
+    iterable, e.g. of streamed transfers, is not consumed ahead of the calls. If a call raises, or the consumer stops
+    early, no further items are taken, queued calls are cancelled and running calls are waited for, so that no work is
+    left running in the background."""
+    if jobs == 1:
+        yield from map(function, iterable)
+        return
+    executor = ThreadPoolExecutor(max_workers=jobs)
+    futures = deque()
+    try:
+        for item in iterable:
+            yield from get_done_results(futures, max_running=jobs - 1, max_pending=MAX_PENDING_CALLS_PER_JOB * jobs - 1)
+            futures.append(executor.submit(function, item))
+        yield from get_done_results(futures, max_running=0, max_pending=0)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
 def get_checksum(file: Path, skip: bool = False) -> Optional[str]:
     if skip:
         return None
@@ -8,6 +8,7 @@ from tempfile import TemporaryDirectory
 from unittest import TestCase
 
 from sd_copy.dcim_transfer import Image, Video, get_dcim_transfers, get_image_or_video
+from sd_copy.library import LIBRARY_INDEX_FILE_NAME
 from sd_copy.timelapse import patch_dcim_transfers_for_timelapse
 
 DATA = "dcim"
@@ -28,7 +29,10 @@ def _folder_empty(path: str) -> bool:
 
 
 def _number_of_files(dir_path: str) -> int:
-    return len(tuple(path for path in Path(dir_path).rglob("*") if path.is_file()))
+    # The library index kept by sd-copy in the output location is not a copied file
+    return len(
+        tuple(path for path in Path(dir_path).rglob("*") if path.is_file() and path.name != LIBRARY_INDEX_FILE_NAME),
+    )
 
 
 class TestSdCopySort(TestCase):
@@ -0,0 +1,70 @@
+import os
+import sqlite3
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from sd_copy.cache import MetadataCache
+
+
+class TestMetadataCache(TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.cache_path = Path(self.tmp_dir.name) / "metadata.sqlite"
+        self.media_file = Path(self.tmp_dir.name) / "DSCF0226.JPG"
+        self.media_file.write_bytes(b"jpg")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_cached_metadata_is_returned(self):
+        cache = MetadataCache(extractor="exiftool-12.76", path=self.cache_path)
+        cache.put(self.media_file, {"EXIF:Model": "X-T3"})
+        cache.close()
+        self.assertEqual(
+            MetadataCache(extractor="exiftool-12.76", path=self.cache_path).get(self.media_file),
+            {"EXIF:Model": "X-T3"},
+        )
+
+    def test_modified_file_is_not_returned(self):
+        cache = MetadataCache(extractor="exiftool-12.76", path=self.cache_path)
+        cache.put(self.media_file, {"EXIF:Model": "X-T3"})
+        os.utime(self.media_file, ns=(0, 0))
+        self.assertIsNone(cache.get(self.media_file))
+
+    def test_other_extractor_is_not_returned(self):
+        MetadataCache(extractor="exiftool-12.76", path=self.cache_path).put(self.media_file, {"EXIF:Model": "X-T3"})
+        self.assertIsNone(MetadataCache(extractor="exiftool-13.00", path=self.cache_path).get(self.media_file))
+
+    def test_prune_evicts_least_recently_used_entries(self):
+        other_media_file = Path(self.tmp_dir.name) / "DSCF0227.JPG"
+        other_media_file.write_bytes(b"jpg")
+        cache = MetadataCache(extractor="exiftool-12.76", path=self.cache_path)
+        cache.put(self.media_file, {"EXIF:Model": "X-T3"})
+        cache.put(other_media_file, {"EXIF:Model": "X-T3"})
+        cache.get(self.media_file)
+        self.assertEqual(cache.prune(max_entries=1), 1)
+        self.assertIsNotNone(cache.get(self.media_file))
+        self.assertIsNone(cache.get(other_media_file))
+
+    def test_get_many_returns_cached_files_only(self):
+        other_media_file = Path(self.tmp_dir.name) / "DSCF0227.JPG"
+        other_media_file.write_bytes(b"jpg")
+        cache = MetadataCache(extractor="exiftool-12.76", path=self.cache_path)
+        cache.put(self.media_file, {"EXIF:Model": "X-T3"})
+        self.assertEqual(
+            cache.get_many((self.media_file, other_media_file)),
+            {self.media_file: {"EXIF:Model": "X-T3"}},
+        )
+
+    def test_lookup_does_not_block_other_writers(self):
+        cache = MetadataCache(extractor="exiftool-12.76", path=self.cache_path)
+        cache.put(self.media_file, {"EXIF:Model": "X-T3"})
+        cache.get(self.media_file)
+        other_connection = sqlite3.connect(self.cache_path, timeout=0)
+        try:
+            other_connection.execute("DELETE FROM metadata")
+            other_connection.commit()
+        finally:
+            other_connection.close()
+        self.assertIsNone(cache.get(self.media_file))
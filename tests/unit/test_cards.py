@@ -0,0 +1,116 @@
+from datetime import datetime
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import Mock
+
+from sd_copy.cards import CardResult, plan_cards, resolve_cross_card_targets
+from sd_copy.dcim_transfer import DCIMTransfer, get_image_or_video
+from sd_copy.hashing import HashAlgorithm
+from sd_copy.utils import TimestampConsistencyError
+
+
+class TestResolveCrossCardTargets(TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.library_path = Path(self.tmp_dir.name) / "library"
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _card(self, name: str, files: dict[str, bytes]) -> CardResult:
+        (card_path := Path(self.tmp_dir.name) / name).mkdir()
+        dcim_transfers = []
+        for file_name, content in files.items():
+            (source_path := card_path / file_name).write_bytes(content)
+            dcim_transfers.append(
+                DCIMTransfer(
+                    source_path=source_path,
+                    metadata=Mock(),
+                    rectified_modify_date=datetime(2021, 7, 8, 17, 36),
+                    target_path=self.library_path / "2021-07-08" / f"20210708-1736_x-t3_{source_path.stem}.jpg",
+                ),
+            )
+        return CardResult(source_path=card_path, dcim_transfers=tuple(dcim_transfers))
+
+    def test_identical_files_on_several_cards_are_copied_once(self):
+        card_results = resolve_cross_card_targets(
+            (
+                self._card("card1", {"DSCF0001.JPG": b"a", "DSCF0002.JPG": b"b"}),
+                self._card("card2", {"DSCF0002.JPG": b"b", "DSCF0003.JPG": b"c"}),
+            ),
+            algorithm=HashAlgorithm.blake2b,
+        )
+        self.assertEqual(
+            tuple(
+                tuple(dcim_transfer.source_path.name for dcim_transfer in card_result.dcim_transfers)
+                for card_result in card_results
+            ),
+            (("DSCF0001.JPG", "DSCF0002.JPG"), ("DSCF0003.JPG",)),
+        )
+        self.assertFalse(any(card_result.collisions for card_result in card_results))
+
+    def test_different_files_with_same_target_are_collisions_of_all_their_cards(self):
+        card_results = resolve_cross_card_targets(
+            (
+                self._card("card1", {"DSCF0001.JPG": b"a", "DSCF0002.JPG": b"b"}),
+                self._card("card2", {"DSCF0002.JPG": b"other camera body"}),
+            ),
+            algorithm=HashAlgorithm.blake2b,
+        )
+        self.assertEqual(len(card_results[0].dcim_transfers), 1)
+        self.assertEqual(len(card_results[1].dcim_transfers), 0)
+        self.assertEqual(
+            tuple(len(card_result.collisions) for card_result in card_results),
+            (1, 1),
+        )
+
+
+class TestPlanCards(TestCase):
+    def test_failing_card_does_not_affect_other_cards(self):
+        def plan(source_path: Path, report_path: Path):
+            if source_path.name == "card2":
+                raise TimestampConsistencyError(f"Output written to '{report_path}'")
+            return (Mock(),)
+
+        card_results = plan_cards(source_paths=(Path("card1"), Path("card2")), plan=plan)
+        self.assertEqual(len(card_results[0].dcim_transfers), 1)
+        self.assertIsNone(card_results[0].error)
+        self.assertEqual(
+            card_results[1].error,
+            "TimestampConsistencyError: Output written to 'sorting_violations_card2.json'",
+        )
+
+    def test_card_with_unknown_file_does_not_affect_other_cards(self):
+        exif_data = {
+            "File:MIMEType": "image/jpeg",
+            "File:FileModifyDate": "2021:07:08 17:36:28+02:00",
+            "EXIF:Model": "X-T3",
+            "EXIF:DateTimeOriginal": "2021:07:08 17:36:28",
+            "EXIF:ExifImageWidth": 6240,
+            "EXIF:ExifImageHeight": 4160,
+            "EXIF:ShutterSpeedValue": "1/250",
+        }
+        cards = {
+            "card1": {"DSCF0001.JPG": exif_data},
+            "card2": {"DSCF0002.JPG": exif_data | {"EXIF:Model": "X-T4"}, "DJI_0001.LRV": exif_data},
+        }
+
+        def plan(source_path: Path, report_path: Path):
+            return tuple(
+                get_image_or_video(media_file=source_path / file_name, exif_data=file_exif_data)
+                for file_name, file_exif_data in cards[source_path.name].items()
+            )
+
+        card_results = plan_cards(source_paths=(Path("card1"), Path("card2")), plan=plan)
+        self.assertEqual(len(card_results[0].dcim_transfers), 1)
+        self.assertIsNone(card_results[0].error)
+        self.assertEqual(card_results[1].error, "UnexpectedDataError: Camera 'X-T4' not yet supported")
+
+        del cards["card2"]["DSCF0002.JPG"]
+        card_results = plan_cards(source_paths=(Path("card1"), Path("card2")), plan=plan)
+        self.assertIsNone(card_results[0].error)
+        self.assertEqual(
+            card_results[1].error,
+            "UnexpectedDataError: '.LRV' extension of DJI_0001.LRV not yet handled",
+        )
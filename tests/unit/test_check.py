@@ -0,0 +1,77 @@
+import json
+from datetime import datetime
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import Mock
+
+from sd_copy.check import SortingCheck
+from sd_copy.dcim_transfer import DCIMTransfer, Extension
+from sd_copy.utils import TimestampConsistencyError
+
+
+def _transfer(source_name: str, target_name: str, extension: Extension) -> DCIMTransfer:
+    return DCIMTransfer(
+        source_path=Path("/card") / source_name,
+        metadata=Mock(extension=extension),
+        rectified_modify_date=datetime(2021, 7, 8, 17, 40, 28),
+        target_path=Path("/library/2021-07-08") / target_name,
+    )
+
+
+class TestSortingCheck(TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.report_path = Path(self.tmp_dir.name) / "sorting_violations.json"
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _check(self, dcim_transfers, timelapse=False):
+        sorting_check = SortingCheck(timelapse=timelapse, report_path=self.report_path)
+        for dcim_transfer in dcim_transfers:
+            sorting_check.add(dcim_transfer)
+        sorting_check.close()
+
+    def test_raw_and_jpg_of_same_image_may_change_order(self):
+        self._check(
+            (
+                _transfer("DSCF0230.MOV", "20210708-1740_x-t3_DSCF0230_2160p-59.94fps.mov", Extension.mov),
+                _transfer("DSCF0231.JPG", "20210708-1740_x-t3_DSCF0231_6240x4160.jpg", Extension.jpg),
+                _transfer("DSCF0231.RAF", "20210708-1740_x-t3_DSCF0231_4416x2944.raf", Extension.raf),
+                _transfer("DSCF0232.MOV", "20210708-1746_x-t3_DSCF0232_1080p-24fps.mov", Extension.mov),
+            ),
+        )
+        self.assertFalse(self.report_path.exists())
+
+    def test_out_of_order_pairs_are_reported(self):
+        dcim_transfers = (
+            _transfer("DSCF0229.MOV", "20210708-1739_x-t3_DSCF0229_1080p-24fps.mov", Extension.mov),
+            _transfer("DSCF0230.JPG", "20210708-1738_x-t3_DSCF0230_6240x4160.jpg", Extension.jpg),
+            _transfer("DSCF0231.RAF", "20210708-1740_x-t3_DSCF0231_4416x2944.raf", Extension.raf),
+            _transfer("DSCF0232.MOV", "20210708-1737_x-t3_DSCF0232_1080p-24fps.mov", Extension.mov),
+        )
+        with self.assertRaises(TimestampConsistencyError):
+            self._check(dcim_transfers)
+        self.assertEqual(
+            tuple(
+                (entry["previous"]["file"], entry["current"]["file"])
+                for entry in json.loads(self.report_path.read_text())
+            ),
+            (
+                ("/card/DSCF0229.MOV", "/card/DSCF0230.JPG"),
+                ("/card/DSCF0230.JPG", "/card/DSCF0232.MOV"),
+                ("/card/DSCF0231.RAF", "/card/DSCF0232.MOV"),
+                ("/card/DSCF0229.MOV", "/card/DSCF0232.MOV"),  # adjacent among files without images
+            ),
+        )
+
+    def test_timelapse_video_is_excluded(self):
+        self._check(
+            (
+                _transfer("DSCF0226.JPG", "20210708-1736_x-t3_DSCF0226-0001_6240x4160.jpg", Extension.jpg),
+                _transfer("DSCF0227.MOV", "20210708-1736_x-t3_DSCF0226_timelapse.mov", Extension.mov),
+                _transfer("DSCF0228.JPG", "20210708-1736_x-t3_DSCF0226-0002_6240x4160.jpg", Extension.jpg),
+            ),
+            timelapse=True,
+        )
@@ -0,0 +1,100 @@
+from datetime import datetime
+from functools import partial
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Iterable, Iterator, Sequence
+from unittest import TestCase
+from unittest.mock import Mock, patch
+
+from utils import DCIMTransfersTestCase
+
+from sd_copy.check import SortingCheck
+from sd_copy.copy_engine import copy_dcim_transfers, stream_dcim_transfers
+from sd_copy.dcim_transfer import DCIMTransfer, Extension
+from sd_copy.hashing import HashAlgorithm, get_file_checksum
+from sd_copy.journal import TransferJournal
+from sd_copy.library import LibraryIndex
+from sd_copy.utils import CopyError, TimestampConsistencyError
+
+
+class TestCopyDcimTransfers(DCIMTransfersTestCase):
+    n_transfers = 20
+
+    def test_all_files_are_copied(self):
+        copy_dcim_transfers(
+            self.dcim_transfers,
+            skip_checksum=False,
+            skip_verify=False,
+            delete=False,
+            algorithm=HashAlgorithm.blake2b,
+            jobs=4,
+        )
+        for dcim_transfer in self.dcim_transfers:
+            self.assertEqual(dcim_transfer.target_path.read_bytes(), dcim_transfer.source_path.read_bytes())
+            self.assertEqual(dcim_transfer.target_path.stat().st_mtime, dcim_transfer.rectified_modify_date.timestamp())
+
+    @patch("sd_copy.copy_engine.get_file_checksum")
+    def test_copy_error_stops_outstanding_transfers(self, mock_get_file_checksum):
+        mock_get_file_checksum.side_effect = lambda file, algorithm: (
+            "corrupted" if "DSCF0000" in file.name else get_file_checksum(file, algorithm)
+        )
+        with self.assertRaises(CopyError):
+            copy_dcim_transfers(
+                self.dcim_transfers,
+                skip_checksum=False,
+                skip_verify=False,
+                delete=False,
+                algorithm=HashAlgorithm.blake2b,
+                jobs=2,
+            )
+        self.assertFalse(self.dcim_transfers[-1].target_path.exists())
+
+
+class TestStreamDcimTransfers(TestCase):
+    def setUp(self):
+        self.source_dir, self.target_dir = TemporaryDirectory(), TemporaryDirectory()
+        self.journal = TransferJournal(destination_path=Path(self.target_dir.name))
+        self.library = LibraryIndex(destination_path=Path(self.target_dir.name))
+
+    def tearDown(self):
+        self.library.close()
+        self.source_dir.cleanup()
+        self.target_dir.cleanup()
+
+    def _iter_dcim_transfers(self, minutes: Sequence[int]) -> Iterator[DCIMTransfer]:
+        for n, minute in enumerate(minutes):
+            source_path = Path(self.source_dir.name) / f"DSCF{n:04d}.JPG"
+            source_path.write_bytes(source_path.name.encode())
+            yield DCIMTransfer(
+                source_path=source_path,
+                metadata=Mock(extension=Extension.jpg),
+                rectified_modify_date=datetime(2021, 7, 8, 17, minute),
+                target_path=Path(self.target_dir.name) / "2021-07-08" / f"20210708-17{minute:02d}_x-t3_DSCF{n:04d}.jpg",
+            )
+
+    def _stream(self, dcim_transfers: Iterable[DCIMTransfer]):
+        return stream_dcim_transfers(
+            dcim_transfers,
+            skip_checksum=False,
+            skip_verify=False,
+            delete=True,
+            algorithm=HashAlgorithm.blake2b,
+            jobs=2,
+            journal=self.journal,
+            library=self.library,
+            resume=False,
+        )
+
+    @patch("sd_copy.copy_engine.remove_source_file")
+    def test_sources_are_deleted_after_all_transfers_are_copied(self, mock_remove_source_file):
+        self.assertEqual(self._stream(self._iter_dcim_transfers(minutes=range(10))), ())
+        self.assertEqual(len(tuple(Path(self.target_dir.name).rglob("*.jpg"))), 10)
+        self.assertEqual(mock_remove_source_file.call_count, 10)
+
+    @patch("sd_copy.copy_engine.remove_source_file")
+    def test_sources_are_not_deleted_if_sorting_check_fails(self, mock_remove_source_file):
+        report_path = Path(self.target_dir.name) / "sorting_violations.json"
+        with patch("sd_copy.copy_engine.SortingCheck", partial(SortingCheck, report_path=report_path)):
+            with self.assertRaises(TimestampConsistencyError):
+                self._stream(self._iter_dcim_transfers(minutes=(36, 37, 35, 38)))
+        mock_remove_source_file.assert_not_called()
@@ -0,0 +1,177 @@
+import contextlib
+import io
+import json
+import logging
+import os
+import socket
+import threading
+from functools import cache, partial
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+import click
+
+from sd_copy import daemon
+from sd_copy.client import run_on_daemon
+from sd_copy.daemon import CommandServer, close_databases, is_private_directory, open_database
+from sd_copy.main import main as sd_copy_main
+
+
+@click.group()
+def command():
+    pass
+
+
+@command.command("echo")
+@click.argument("message")
+def echo(message: str):
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    logging.info(f"Working directory {Path.cwd()}")
+    click.secho(message)
+
+
+@command.command("fail")
+def fail():
+    raise click.ClickException("Failed")
+
+
+class WarmExiftoolPool:
+    """Reads files relative to the working directory it was started in, as a running exiftool process does"""
+
+    def __init__(self):
+        self.working_directory = Path.cwd()
+
+    def execute_json(self, *files: str) -> list[dict]:
+        return [{"SourceFile": file, "Content": (self.working_directory / file).read_text()} for file in files]
+
+
+class Database:
+    def __init__(self, path: Path):
+        path.touch()
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class TestOpenDatabase(TestCase):
+    def setUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.path = Path(self.temp_dir.name) / "database.sqlite"
+        self.open_database = partial(open_database, partial(Database, self.path), self.path)
+
+    def tearDown(self):
+        close_databases()
+        self.temp_dir.cleanup()
+
+    def test_closed_if_not_serving(self):
+        with self.open_database() as database:
+            pass
+        self.assertTrue(database.closed)
+
+    def test_kept_open_while_serving(self):
+        daemon._open_databases = {}
+        with self.open_database("dst") as database:
+            pass
+        with self.open_database("dst") as same_database, self.open_database("other") as other_database:
+            pass
+        self.assertIs(same_database, database)
+        self.assertIsNot(other_database, database)
+        self.assertFalse(database.closed)
+        close_databases()
+        self.assertTrue(database.closed)
+        self.assertTrue(other_database.closed)
+
+    def test_reopened_if_file_was_replaced(self):
+        daemon._open_databases = {}
+        with self.open_database() as database:
+            pass
+        self.path.unlink()
+        with self.open_database() as new_database:
+            pass
+        self.assertTrue(database.closed)
+        self.assertIsNot(new_database, database)
+
+    def test_closed_if_command_failed(self):
+        daemon._open_databases = {}
+        with self.assertRaises(ValueError), self.open_database() as database:
+            raise ValueError
+        self.assertTrue(database.closed)
+        with self.open_database() as new_database:
+            pass
+        self.assertIsNot(new_database, database)
+
+
+class TestDaemon(TestCase):
+    def setUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.path = Path(self.temp_dir.name)
+        self.socket_path = self.path / "sd-copy.sock"
+        self.server = CommandServer(self.socket_path, command=command)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.temp_dir.cleanup()
+
+    def run_on_daemon(self, *args: str) -> tuple[int, str, str]:
+        stdout, stderr = io.StringIO(), io.StringIO()
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            exit_code = run_on_daemon(args, socket_path=self.socket_path)
+        return exit_code, stdout.getvalue(), stderr.getvalue()
+
+    def test_output_and_working_directory_of_client(self):
+        working_directory = Path.cwd()
+        os.chdir(self.path)
+        try:
+            for message in ("first", "second"):
+                self.assertEqual(
+                    self.run_on_daemon("echo", message),
+                    (0, f"{message}\n", f"Working directory {self.path}\n"),
+                )
+        finally:
+            os.chdir(working_directory)
+
+    def test_errors_are_exit_codes(self):
+        exit_code, _, stderr = self.run_on_daemon("fail")
+        self.assertEqual(exit_code, 1)
+        self.assertIn("Error: Failed", stderr)
+        self.assertEqual(self.run_on_daemon("unknown")[0], 2)
+        self.assertEqual(self.run_on_daemon("serve")[0], 2)
+
+    def test_no_daemon_running(self):
+        self.assertIsNone(run_on_daemon(("echo", "message"), socket_path=self.path / "missing.sock"))
+
+    def test_daemon_of_another_user_is_not_used(self):
+        with patch("sd_copy.client.get_peer_uid", return_value=os.getuid() + 1):
+            self.assertIsNone(self.run_on_daemon("echo", "message")[0])
+
+    def test_client_of_another_user_is_refused(self):
+        with patch("sd_copy.daemon.is_own_process", return_value=False):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+                connection.connect(str(self.socket_path))
+                self.assertEqual(connection.recv(1024), b"")
+
+    def test_socket_directory_must_be_private(self):
+        os.chmod(self.path, 0o700)
+        self.assertTrue(is_private_directory(self.path))
+        os.chmod(self.path, 0o777)
+        self.assertFalse(is_private_directory(self.path))
+
+    def test_commands_from_different_working_directories(self):
+        self.server.command = sd_copy_main
+        working_directory = Path.cwd()
+        try:
+            # The pool is started by the first command, in its working directory
+            with patch("sd_copy.dcim_transfer.get_exiftool_pool", side_effect=cache(WarmExiftoolPool)):
+                for card in ("a", "b"):
+                    (self.path / card).mkdir()
+                    (self.path / card / "DSCF0001.JPG").write_text(card)
+                    os.chdir(self.path / card)
+                    exit_code, stdout, _ = self.run_on_daemon("info", "DSCF0001.JPG")
+                    self.assertEqual((exit_code, json.loads(stdout)["Content"]), (0, card))
+        finally:
+            os.chdir(working_directory)
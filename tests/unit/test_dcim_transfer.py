@@ -1,9 +1,24 @@
+from dataclasses import replace
 from pathlib import Path
 from unittest import TestCase
 from unittest.mock import patch
 
 from sd_copy.cameras import dji_osmo_action_photo_camera, dji_osmo_action_video_camera, fujifilm_x_t3
-from sd_copy.dcim_transfer import get_camera, get_metadata, get_sanitized_file_name, is_media_file
+from sd_copy.dcim_transfer import (
+    DCIMTransfer,
+    Image,
+    Video,
+    check_exif_fields,
+    get_camera,
+    get_dcim_transfer_object,
+    get_metadata,
+    get_metadata_batch,
+    get_metadata_from_exiftool_batch,
+    get_metadata_from_native_reader_batch,
+    get_sanitized_file_name,
+    is_media_file,
+)
+from sd_copy.native_metadata import NativeMetadataError
 from sd_copy.utils import UnexpectedDataError
 
 
@@ -11,6 +26,9 @@ class TestGetCamera(TestCase):
     def test_get_camera_raises_error_when_no_identifier(self):
         self.assertRaises(UnexpectedDataError, get_camera, {})
 
+    def test_get_camera_raises_error_for_unknown_camera(self):
+        self.assertRaises(UnexpectedDataError, get_camera, {"EXIF:Model": "X-T4"})
+
     def test_get_camera_fujifilm_x_t3(self):
         self.assertEqual(get_camera({"EXIF:Model": "X-T3"}), fujifilm_x_t3)
 
@@ -58,3 +76,137 @@ class TestGetMetadata(TestCase):
         mock_get_metadata_from_exiftool.assert_called_with(media_file=test_path)
 
     pass
+
+
+class TestGetMetadataBatch(TestCase):
+    @patch("sd_copy.dcim_transfer.get_metadata_from_exiftool")
+    @patch("sd_copy.dcim_transfer.get_exiftool_pool")
+    def test_files_missing_from_batch_output_are_extracted_individually(
+        self,
+        mock_get_exiftool_pool,
+        mock_get_metadata_from_exiftool,
+    ):
+        source_file = str(Path("a.JPG").absolute())
+        mock_get_exiftool_pool.return_value.execute_json.return_value = [{"SourceFile": source_file}]
+        metadata = get_metadata_from_exiftool_batch((Path("a.JPG"), Path("b.JPG")))
+        mock_get_exiftool_pool.return_value.execute_json.assert_called_once_with(
+            source_file,
+            str(Path("b.JPG").absolute()),
+        )
+        mock_get_metadata_from_exiftool.assert_called_once_with(media_file=Path("b.JPG"))
+        self.assertEqual(metadata[Path("a.JPG")], {"SourceFile": source_file})
+        self.assertEqual(metadata[Path("b.JPG")], mock_get_metadata_from_exiftool.return_value)
+
+    @patch("sd_copy.dcim_transfer.get_matching_video_file_path")
+    @patch("sd_copy.dcim_transfer.get_exiftool_pool")
+    def test_aac_files_use_metadata_of_matching_video(self, mock_get_exiftool_pool, mock_get_matching_video_file_path):
+        mock_get_matching_video_file_path.return_value = Path("DJI_0375.MOV")
+        source_file = str(Path("DJI_0375.MOV").absolute())
+        mock_get_exiftool_pool.return_value.execute_json.return_value = [{"SourceFile": source_file}]
+        metadata = get_metadata_batch((Path("DJI_0375.MOV"), Path("DJI_0375.AAC")))
+        mock_get_exiftool_pool.return_value.execute_json.assert_called_once_with(source_file)
+        self.assertEqual(metadata[Path("DJI_0375.AAC")], metadata[Path("DJI_0375.MOV")])
+
+
+class TestGetMetadataFromNativeReaderBatch(TestCase):
+    @patch("sd_copy.dcim_transfer.get_metadata_from_exiftool_batch")
+    @patch("sd_copy.dcim_transfer.get_metadata_from_native_reader")
+    def test_unreadable_files_fall_back_to_exiftool(
+        self,
+        mock_get_metadata_from_native_reader,
+        mock_get_metadata_from_exiftool_batch,
+    ):
+        mock_get_metadata_from_native_reader.side_effect = NativeMetadataError
+        mock_get_metadata_from_exiftool_batch.return_value = {Path("DJI_0377.MP4"): {"SourceFile": "DJI_0377.MP4"}}
+        metadata = get_metadata_from_native_reader_batch((Path("DJI_0377.MP4"),))
+        mock_get_metadata_from_exiftool_batch.assert_called_once_with(media_files=(Path("DJI_0377.MP4"),))
+        self.assertEqual(metadata, {Path("DJI_0377.MP4"): {"SourceFile": "DJI_0377.MP4"}})
+
+    @patch("sd_copy.dcim_transfer.get_metadata_from_exiftool_batch")
+    @patch("sd_copy.dcim_transfer.get_metadata_from_native_reader")
+    def test_files_with_missing_fields_fall_back_to_exiftool(
+        self,
+        mock_get_metadata_from_native_reader,
+        mock_get_metadata_from_exiftool_batch,
+    ):
+        native_metadata = {
+            "File:MIMEType": "video/mp4",
+            "File:FileModifyDate": "2021:07:12 07:51:07+02:00",
+            "QuickTime:HandlerDescription": "\u0010DJI.Meta",
+            "QuickTime:MediaCreateDate": "2021:07:12 05:51:07",
+            "QuickTime:ImageHeight": 2160,
+        }
+        mock_get_metadata_from_native_reader.side_effect = lambda media_file: (
+            native_metadata | {"QuickTime:VideoFrameRate": 29.97}
+            if media_file.name == "DJI_0377.MP4"
+            else native_metadata
+        )
+        mock_get_metadata_from_exiftool_batch.return_value = {Path("DJI_0378.MP4"): {"SourceFile": "DJI_0378.MP4"}}
+        metadata = get_metadata_from_native_reader_batch((Path("DJI_0377.MP4"), Path("DJI_0378.MP4")))
+        mock_get_metadata_from_exiftool_batch.assert_called_once_with(media_files=(Path("DJI_0378.MP4"),))
+        self.assertEqual(metadata[Path("DJI_0377.MP4")]["QuickTime:VideoFrameRate"], 29.97)
+        self.assertEqual(metadata[Path("DJI_0378.MP4")], {"SourceFile": "DJI_0378.MP4"})
+
+
+class TestCheckExifFields(TestCase):
+    def test_missing_fields_are_listed(self):
+        with self.assertRaisesRegex(UnexpectedDataError, "EXIF:DateTimeOriginal, EXIF:ShutterSpeedValue"):
+            check_exif_fields(
+                {
+                    "File:MIMEType": "image/jpeg",
+                    "File:FileModifyDate": "2021:07:08 17:36:28+02:00",
+                    "EXIF:Model": "X-T3",
+                    "EXIF:ExifImageWidth": 6240,
+                    "EXIF:ExifImageHeight": 4160,
+                },
+            )
+
+
+class TestSlottedDataclasses(TestCase):
+    def get_dcim_transfer(self, media_file: str, exif_data: dict) -> DCIMTransfer:
+        return get_dcim_transfer_object(
+            media_file=Path(media_file),
+            destination=Path("out"),
+            time_offset=0,
+            exif_data=exif_data,
+        )
+
+    def test_compare_and_replace_as_unslotted_dataclasses(self):
+        image_exif_data = {
+            "File:MIMEType": "image/jpeg",
+            "File:FileModifyDate": "2021:07:08 17:36:28+02:00",
+            "EXIF:Model": "X-T3",
+            "EXIF:DateTimeOriginal": "2021:07:08 17:36:28",
+            "EXIF:ExifImageWidth": 6240,
+            "EXIF:ExifImageHeight": 4160,
+            "EXIF:ShutterSpeedValue": "1/250",
+        }
+        video_exif_data = {
+            "File:MIMEType": "video/mp4",
+            "File:FileModifyDate": "2021:07:12 07:51:07+02:00",
+            "QuickTime:HandlerDescription": "\u0010DJI.Meta",
+            "QuickTime:MediaCreateDate": "2021:07:12 05:51:07",
+            "QuickTime:ImageHeight": 2160,
+            "QuickTime:VideoFrameRate": 29.97,
+        }
+        for media_file, exif_data, medium_type in (
+            ("DSCF0226.JPG", image_exif_data, Image),
+            ("DJI_0377.MP4", video_exif_data, Video),
+        ):
+            with self.subTest(medium_type=medium_type.__name__):
+                dcim_transfer = self.get_dcim_transfer(media_file, exif_data)
+                self.assertIsInstance(dcim_transfer.metadata, medium_type)
+                self.assertFalse(hasattr(dcim_transfer, "__dict__") or hasattr(dcim_transfer.metadata, "__dict__"))
+
+                self.assertEqual(self.get_dcim_transfer(media_file, exif_data), dcim_transfer)
+                self.assertNotEqual(self.get_dcim_transfer(f"other/{media_file}", exif_data), dcim_transfer)
+                # Mutable dataclasses with eq=True, which were never hashable
+                self.assertRaises(TypeError, hash, dcim_transfer)
+                self.assertRaises(TypeError, hash, dcim_transfer.metadata)
+
+                replaced = replace(dcim_transfer, metadata=replace(dcim_transfer.metadata, file_name="renamed"))
+                self.assertIsInstance(replaced.metadata, medium_type)
+                self.assertEqual(replaced.metadata.file_name, "renamed")
+                self.assertEqual(replaced.metadata.resolution, dcim_transfer.metadata.resolution)
+                self.assertEqual(replaced.target_path, dcim_transfer.target_path)
+                self.assertNotEqual(replaced, dcim_transfer)
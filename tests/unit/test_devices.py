@@ -0,0 +1,52 @@
+import threading
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from sd_copy.devices import DeviceScheduler, get_device, order_by_device
+from sd_copy.utils import parallel_map
+
+
+class TestDeviceScheduler(TestCase):
+    def setUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.path = Path(self.temp_dir.name)
+        self.scheduler = DeviceScheduler()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_device_jobs_limit_concurrent_access(self):
+        self.scheduler.set_device_jobs(2)
+        lock, running, max_running = threading.Lock(), [0], [0]
+
+        def access(n: int):
+            with self.scheduler.acquire(self.path / f"file{n}", self.path):
+                with lock:
+                    running[0] += 1
+                    max_running[0] = max(max_running[0], running[0])
+                time.sleep(0.01)
+                with lock:
+                    running[0] -= 1
+
+        tuple(parallel_map(access, range(16), jobs=8))
+        self.assertEqual(max_running[0], 2)
+
+    def test_held_device_can_be_acquired_again(self):
+        self.scheduler.set_device_jobs(1)
+        with self.scheduler.acquire(self.path), self.scheduler.acquire(self.path / "target.jpg"):
+            self.assertEqual(self.scheduler.get_held_devices(), {get_device(self.path)})
+        self.assertEqual(self.scheduler.get_held_devices(), set())
+
+
+class TestOrderByDevice(TestCase):
+    @patch("sd_copy.devices.get_block_device_attribute", return_value=None)
+    @patch("sd_copy.devices.get_device", side_effect=lambda path: int(path.parts[1] == "card2"))
+    def test_devices_are_interleaved(self, mock_get_device, mock_get_block_device_attribute):
+        paths = (*(Path("/card1") / f"DSCF{n:04d}.JPG" for n in range(3)), Path("/card2/DJI_0001.MP4"))
+        self.assertEqual(
+            order_by_device(paths, get_path=lambda path: path),
+            (paths[0], paths[3], paths[1], paths[2]),
+        )
@@ -0,0 +1,84 @@
+import os
+import stat
+import sys
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from sd_copy.exiftool import ExiftoolPool, ExiftoolProcess
+from sd_copy.utils import ExiftoolError
+
+# Minimal stand-in for `exiftool -stay_open True -@ -`, answering every request with one JSON object per file argument
+FAKE_EXIFTOOL = f"""#!{sys.executable}
+import json, sys, time
+
+args = []
+for line in sys.stdin:
+    arg = line.rstrip("\\n")
+    if arg == "False" and args[-1:] == ["-stay_open"]:
+        break
+    if not arg.startswith("-execute"):
+        args.append(arg)
+        continue
+    files = [a for i, a in enumerate(args) if not a.startswith("-") and args[i - 1] not in ("-echo4", "-stay_open")]
+    if "crash" in files:
+        sys.exit(1)
+    if "hang" in files:
+        time.sleep(10)
+    found = [f for f in files if f != "missing"]
+    if found:
+        print(json.dumps([{{"SourceFile": f, "File:FileName": f}} for f in found]))
+    if "missing" in files:
+        print("Error: File not found - missing", file=sys.stderr)
+    print(args[args.index("-echo4") + 1], file=sys.stderr, flush=True)
+    print("{{ready" + arg[len("-execute"):] + "}}", flush=True)
+    args = []
+"""
+
+
+class FakeExiftoolTestCase(TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.executable = Path(self.tmp_dir.name) / "exiftool"
+        self.executable.write_text(FAKE_EXIFTOOL)
+        os.chmod(self.executable, self.executable.stat().st_mode | stat.S_IEXEC)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+
+class TestExiftoolProcess(FakeExiftoolTestCase):
+    def test_process_is_reused_across_requests(self):
+        process = ExiftoolProcess(executable=str(self.executable))
+        process.execute("-j", "a.jpg")
+        pid = process._process.pid
+        stdout, _ = process.execute("-j", "b.jpg")
+        self.assertEqual(process._process.pid, pid)
+        self.assertIn("b.jpg", stdout)
+        process.terminate()
+        self.assertFalse(process.running)
+
+    def test_timeout_kills_process(self):
+        process = ExiftoolProcess(executable=str(self.executable), timeout=0.5)
+        self.assertRaises(ExiftoolError, process.execute, "hang")
+        self.assertFalse(process.running)
+
+
+class TestExiftoolPool(FakeExiftoolTestCase):
+    def test_execute_json_returns_metadata(self):
+        pool = ExiftoolPool(executable=str(self.executable))
+        self.assertEqual(pool.execute_json("a.jpg"), [{"SourceFile": "a.jpg", "File:FileName": "a.jpg"}])
+        pool.close()
+
+    def test_error_is_attributed_to_request(self):
+        pool = ExiftoolPool(executable=str(self.executable))
+        with self.assertRaisesRegex(ExiftoolError, "File not found - missing"):
+            pool.execute_json("missing")
+        self.assertEqual(pool.execute_json("a.jpg")[0]["SourceFile"], "a.jpg")
+        pool.close()
+
+    def test_crashed_worker_is_restarted(self):
+        pool = ExiftoolPool(executable=str(self.executable))
+        self.assertRaises(ExiftoolError, pool.execute_json, "crash")
+        self.assertEqual(pool.execute_json("a.jpg")[0]["SourceFile"], "a.jpg")
+        pool.close()
@@ -1,7 +1,19 @@
+import errno
+import os
 from pathlib import Path
+from tempfile import TemporaryDirectory
 from unittest import TestCase
+from unittest.mock import patch
 
-from sd_copy.files import get_files_not_sorted, get_renamed_folder_path
+from sd_copy.files import (
+    CopyMethod,
+    copy_media_to_target,
+    copy_media_to_target_with_checksum,
+    get_files_not_sorted,
+    get_files_parallel,
+    get_renamed_folder_path,
+)
+from sd_copy.hashing import get_file_checksum
 
 
 class TestGetRenamedFolderPath(TestCase):
@@ -51,3 +63,75 @@ class TestGetFilesNotSorted(TestCase):
             ),
             ("DSCF0226.JPG",),
         )
+
+
+class TestGetFilesParallel(TestCase):
+    def test_files_in_nested_folders_are_returned(self):
+        with TemporaryDirectory() as library:
+            for file in ("2021-07-08/a.jpg", "2021-07-08/b.jpg", "2021-07-12/timelapse/jpg/c.jpg", "d.jpg"):
+                (Path(library) / file).parent.mkdir(parents=True, exist_ok=True)
+                (Path(library) / file).touch()
+            self.assertEqual(
+                tuple(str(file.relative_to(library)) for file in get_files_parallel(Path(library), jobs=2)),
+                ("2021-07-08/a.jpg", "2021-07-08/b.jpg", "2021-07-12/timelapse/jpg/c.jpg", "d.jpg"),
+            )
+
+    def test_nested_folders_are_walked_in_order(self):
+        with TemporaryDirectory() as library:
+            files = tuple(f"2021-07-12/timelapse_{n:02d}/jpg/DSCF{n:04d}.JPG" for n in range(20))
+            for file in reversed(files):
+                (Path(library) / file).parent.mkdir(parents=True, exist_ok=True)
+                (Path(library) / file).touch()
+            self.assertEqual(
+                tuple(str(file.relative_to(library)) for file in get_files_parallel(Path(library), jobs=2)),
+                files,
+            )
+
+
+class TestCopyMediaToTargetWithChecksum(TestCase):
+    def test_checksum_of_source_is_returned(self):
+        with TemporaryDirectory() as tmp_dir:
+            source_path, target_path = Path(tmp_dir) / "DSCF0226.JPG", Path(tmp_dir) / "out" / "DSCF0226.jpg"
+            source_path.write_bytes(bytes(range(256)) * 10_000)
+            checksum, _ = copy_media_to_target_with_checksum(source_path=source_path, target_path=target_path)
+            self.assertEqual(target_path.read_bytes(), source_path.read_bytes())
+            self.assertEqual(checksum, get_file_checksum(source_path))
+
+
+class TestCopyMediaToTarget(TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.source_path = Path(self.tmp_dir.name) / "DSCF0226.JPG"
+        self.target_path = Path(self.tmp_dir.name) / "2021-07-08" / "20210708-1736_x-t3_DSCF0226.jpg"
+        self.source_path.write_bytes(os.urandom(3 * 1024 * 1024 + 17))
+        os.utime(self.source_path, times=(1625758588, 1625758588))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_content_and_modify_date_are_copied(self):
+        self.assertIn(copy_media_to_target(source_path=self.source_path, target_path=self.target_path), CopyMethod)
+        self.assertEqual(self.target_path.read_bytes(), self.source_path.read_bytes())
+        self.assertEqual(self.target_path.stat().st_mtime, 1625758588)
+
+    @patch("sd_copy.files.fcntl.ioctl", side_effect=OSError(errno.EOPNOTSUPP, "Operation not supported"))
+    @patch("sd_copy.files.os.copy_file_range", side_effect=OSError(errno.EXDEV, "Invalid cross-device link"))
+    @patch("sd_copy.files.os.sendfile", side_effect=OSError(errno.EINVAL, "Invalid argument"))
+    def test_unsupported_copy_methods_fall_back_to_buffered_copy(self, *_):
+        copy_method = copy_media_to_target(source_path=self.source_path, target_path=self.target_path)
+        self.assertEqual(copy_method, CopyMethod.buffered)
+        self.assertEqual(self.target_path.read_bytes(), self.source_path.read_bytes())
+
+    @patch("sd_copy.files.fcntl.ioctl", side_effect=OSError(errno.EOPNOTSUPP, "Operation not supported"))
+    @patch("sd_copy.files.os.copy_file_range", side_effect=OSError(errno.EXDEV, "Invalid cross-device link"))
+    @patch("sd_copy.files.os.sendfile", side_effect=OSError(errno.EINVAL, "Invalid argument"))
+    def test_short_writes_of_buffered_copy_are_continued(self, *_):
+        write = os.write
+        with patch("sd_copy.files.os.write", side_effect=lambda fd, data: write(fd, data[:1000])):
+            copy_media_to_target(source_path=self.source_path, target_path=self.target_path)
+        self.assertEqual(self.target_path.read_bytes(), self.source_path.read_bytes())
+
+    @patch("sd_copy.files.os.copy_file_range", side_effect=OSError(errno.EIO, "Input/output error"))
+    @patch("sd_copy.files.fcntl.ioctl", side_effect=OSError(errno.EOPNOTSUPP, "Operation not supported"))
+    def test_copy_errors_are_raised(self, *_):
+        self.assertRaises(OSError, copy_media_to_target, source_path=self.source_path, target_path=self.target_path)
@@ -0,0 +1,45 @@
+import hashlib
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from sd_copy.hashing import HashAlgorithm, TreeChecksum, get_file_checksum
+
+
+class TestGetFileChecksum(TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.file = Path(self.tmp_dir.name) / "DSCF0229.MOV"
+        self.data = os.urandom(10_000)
+        self.file.write_bytes(self.data)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_single_segment_checksum_equals_plain_hash(self):
+        for algorithm in (HashAlgorithm.md5, HashAlgorithm.sha256, HashAlgorithm.blake2b):
+            self.assertEqual(
+                get_file_checksum(self.file, algorithm=algorithm),
+                hashlib.new(algorithm, self.data).hexdigest(),
+            )
+
+    def test_parallel_tree_hash_matches_incremental_checksum(self):
+        for segment_size in (1000, 3333, 10_000, 20_000):
+            checksum = TreeChecksum(algorithm=HashAlgorithm.blake2b, segment_size=segment_size)
+            for offset in range(0, len(self.data), 777):
+                checksum.update(self.data[offset : offset + 777])
+            self.assertEqual(
+                get_file_checksum(self.file, segment_size=segment_size, buffer_size=512, jobs=3),
+                checksum.hexdigest(),
+            )
+
+    def test_tree_hash_differs_from_plain_hash(self):
+        self.assertNotEqual(
+            get_file_checksum(self.file, algorithm=HashAlgorithm.md5, segment_size=1000),
+            hashlib.md5(self.data).hexdigest(),
+        )
+
+    def test_empty_file(self):
+        self.file.write_bytes(b"")
+        self.assertEqual(get_file_checksum(self.file, algorithm=HashAlgorithm.md5), hashlib.md5().hexdigest())
@@ -0,0 +1,61 @@
+from datetime import datetime
+from pathlib import Path
+from unittest.mock import Mock
+
+from utils import DCIMTransfersTestCase
+
+from sd_copy.copy_engine import copy_dcim_transfers
+from sd_copy.dcim_transfer import DCIMTransfer
+from sd_copy.hashing import HashAlgorithm
+from sd_copy.journal import TransferJournal, TransferState, get_pending_dcim_transfers
+
+
+class TestGetPendingDcimTransfers(DCIMTransfersTestCase):
+    source_repeats = 100
+
+    def setUp(self):
+        super().setUp()
+        self.journal = TransferJournal(destination_path=Path(self.target_dir.name))
+
+    def _copy(self, dcim_transfers, skip_verify=False):
+        self.journal.start(dcim_transfers=dcim_transfers, resume=True)
+        copy_dcim_transfers(
+            dcim_transfers,
+            skip_checksum=False,
+            skip_verify=skip_verify,
+            delete=False,
+            algorithm=HashAlgorithm.md5,
+            jobs=1,
+            journal=self.journal,
+        )
+
+    def test_verified_transfers_are_skipped(self):
+        self._copy(self.dcim_transfers[:2])
+        self.assertEqual(self.journal.load()[str(self.dcim_transfers[0].source_path)].state, TransferState.verified)
+        self.assertEqual(get_pending_dcim_transfers(self.dcim_transfers, self.journal), self.dcim_transfers[2:])
+
+    def test_partial_and_corrupted_targets_are_copied_again(self):
+        self._copy(self.dcim_transfers, skip_verify=True)
+        self.dcim_transfers[1].target_path.write_bytes(b"DSCF")
+        self.dcim_transfers[2].target_path.write_bytes(b"X" * self.dcim_transfers[2].source_path.stat().st_size)
+        self.assertEqual(
+            get_pending_dcim_transfers(self.dcim_transfers, self.journal),
+            self.dcim_transfers[1:3],
+        )
+
+    def test_planned_transfers_and_torn_records_are_copied_again(self):
+        self._copy(self.dcim_transfers[:1])
+        self.journal.start(dcim_transfers=self.dcim_transfers[1:], resume=True)
+        with self.journal.path.open(mode="a") as journal:
+            journal.write('{"state": "verified", "source_path": "')
+        self.assertEqual(get_pending_dcim_transfers(self.dcim_transfers, self.journal), self.dcim_transfers[1:])
+
+    def test_transfers_with_changed_target_are_copied_again(self):
+        self._copy(self.dcim_transfers)
+        moved_transfer = DCIMTransfer(
+            source_path=self.dcim_transfers[0].source_path,
+            metadata=Mock(),
+            rectified_modify_date=datetime(2021, 7, 8, 18, 36, 0),
+            target_path=Path(self.target_dir.name) / "2021-07-08" / "20210708-1836_x-t3_DSCF0000.jpg",
+        )
+        self.assertEqual(get_pending_dcim_transfers((moved_transfer,), self.journal), (moved_transfer,))
@@ -0,0 +1,111 @@
+import os
+import shutil
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from utils import DCIMTransfersTestCase
+
+from sd_copy.hashing import HashAlgorithm, get_file_checksum
+from sd_copy.library import LibraryIndex, deduplicate_dcim_transfers, get_directory_listing
+
+
+class TestDeduplicateDcimTransfers(DCIMTransfersTestCase):
+    def setUp(self):
+        super().setUp()
+        for dcim_transfer in self.dcim_transfers:
+            dcim_transfer.target_path.parent.mkdir(exist_ok=True)
+        self.library = LibraryIndex(destination_path=Path(self.target_dir.name))
+
+    def tearDown(self):
+        self.library.close()
+        super().tearDown()
+
+    def test_duplicates_are_skipped_and_collisions_are_returned(self):
+        self.dcim_transfers[0].target_path.write_bytes(b"DSCF0000.JPG")
+        self.dcim_transfers[1].target_path.write_bytes(b"DSCF0000.JPG")  # same size, different content
+        self.dcim_transfers[2].target_path.write_bytes(b"DSCF")
+        self.assertEqual(
+            deduplicate_dcim_transfers(self.dcim_transfers, library=self.library, algorithm=HashAlgorithm.md5),
+            (self.dcim_transfers[3:], self.dcim_transfers[1:3]),
+        )
+
+    def test_resumed_targets_are_overwritten(self):
+        self.dcim_transfers[2].target_path.write_bytes(b"DSCF")
+        new_dcim_transfers, collisions = deduplicate_dcim_transfers(
+            self.dcim_transfers,
+            library=self.library,
+            algorithm=HashAlgorithm.md5,
+            resumed_target_paths={str(self.dcim_transfers[2].target_path)},
+        )
+        self.assertEqual((new_dcim_transfers, collisions), (self.dcim_transfers, ()))
+
+    def test_indexed_checksums_are_reused_for_unchanged_files(self):
+        target_path = self.dcim_transfers[0].target_path
+        target_path.write_bytes(b"DSCF0000.JPG")
+        self.library.add(target_path, checksum="indexed", algorithm=HashAlgorithm.md5)
+        self.assertEqual(self.library.get_checksum(target_path, algorithm=HashAlgorithm.md5), "indexed")
+        with patch("sd_copy.library.get_file_checksum", wraps=get_file_checksum) as mock_get_file_checksum:
+            self.library.get_checksum(target_path, algorithm=HashAlgorithm.sha256)
+            self.library.get_checksum(target_path, algorithm=HashAlgorithm.sha256)
+        mock_get_file_checksum.assert_called_once()
+
+
+class TestLibraryIndexUpdate(TestCase):
+    def setUp(self):
+        self.library_dir = TemporaryDirectory()
+        self.library_path = Path(self.library_dir.name)
+        for file in ("2021-07-08/a.jpg", "2021-07-08/b.jpg", "2021-07-12/timelapse/jpg/c.jpg", "d.jpg"):
+            (self.library_path / file).parent.mkdir(parents=True, exist_ok=True)
+            (self.library_path / file).write_bytes(file.encode())
+
+    def tearDown(self):
+        self.library_dir.cleanup()
+
+    def _get_indexed_files(self, jobs: int = 1):
+        library = LibraryIndex(destination_path=self.library_path)
+        library.update(jobs=jobs)
+        indexed_files = tuple(str(file.relative_to(self.library_path)) for file in library.get_files())
+        library.close()
+        return indexed_files
+
+    def test_all_files_are_indexed(self):
+        self.assertEqual(
+            self._get_indexed_files(jobs=2),
+            ("2021-07-08/a.jpg", "2021-07-08/b.jpg", "2021-07-12/timelapse/jpg/c.jpg", "d.jpg"),
+        )
+
+    def test_changes_are_picked_up(self):
+        self._get_indexed_files()
+        (self.library_path / "2021-07-08" / "a.jpg").unlink()
+        (self.library_path / "2021-07-12" / "timelapse" / "jpg" / "e.jpg").touch()
+        (self.library_path / "2021-07-14").mkdir()
+        (self.library_path / "2021-07-14" / "f.jpg").touch()
+        (self.library_path / "2021-07-12" / "timelapse" / "jpg").rename(self.library_path / "2021-07-12" / "jpg")
+        self.assertEqual(
+            self._get_indexed_files(),
+            ("2021-07-08/b.jpg", "2021-07-12/jpg/c.jpg", "2021-07-12/jpg/e.jpg", "2021-07-14/f.jpg", "d.jpg"),
+        )
+
+    def test_unchanged_directories_are_not_listed(self):
+        self._get_indexed_files()
+        os.utime(self.library_path / "2021-07-08", ns=(0, 0))
+        with patch("sd_copy.library.get_directory_listing", wraps=get_directory_listing) as mock_listing:
+            self._get_indexed_files()
+        # The library root is listed again, as the index itself is written there
+        self.assertEqual([call.args[1] for call in mock_listing.call_args_list], [".", "2021-07-08"])
+
+    def test_files_added_to_removed_directories_are_dropped(self):
+        self._get_indexed_files()
+        library = LibraryIndex(destination_path=self.library_path)
+        (self.library_path / "2021-07-14").mkdir()
+        (self.library_path / "2021-07-14" / "f.jpg").touch()
+        library.add(self.library_path / "2021-07-14" / "f.jpg", checksum="sorted", algorithm=HashAlgorithm.md5)
+        library.close()
+        shutil.rmtree(self.library_path / "2021-07-14")
+        for _ in range(2):
+            self.assertEqual(
+                self._get_indexed_files(),
+                ("2021-07-08/a.jpg", "2021-07-08/b.jpg", "2021-07-12/timelapse/jpg/c.jpg", "d.jpg"),
+            )
@@ -0,0 +1,66 @@
+import json
+import os
+import sqlite3
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from click.testing import CliRunner
+
+from sd_copy.library import LIBRARY_INDEX_FILE_NAME
+from sd_copy.main import main, report_stats
+from sd_copy.stats import Stage, StatsCollector
+
+
+class TestCheckSorted(TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.src = Path(self.tmp_dir.name) / "src"
+        self.dst = Path(self.tmp_dir.name) / "dst"
+        (self.dst / "2021-07-08").mkdir(parents=True)
+        self.src.mkdir()
+        (self.src / "DSCF0226.JPG").write_bytes(b"jpg")
+        (self.src / "DSCF0227.JPG").write_bytes(b"jpg")
+        (self.dst / "2021-07-08" / "20210708-1736_x-t3_DSCF0226_6240x4160.jpg").write_bytes(b"jpg")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def check_sorted(self) -> str:
+        result = CliRunner().invoke(main, ["check-sorted", str(self.src), str(self.dst)])
+        self.assertIsNone(result.exception)
+        return result.output
+
+    def test_unsorted_files_are_listed(self):
+        self.assertIn("DSCF0227.JPG", self.check_sorted())
+        self.assertNotIn("DSCF0226.JPG", self.check_sorted())
+        self.assertTrue((self.dst / LIBRARY_INDEX_FILE_NAME).exists())
+
+    def assert_dst_is_walked(self):
+        with self.assertLogs(level="WARNING"):
+            output = self.check_sorted()
+        self.assertIn("DSCF0227.JPG", output)
+        self.assertNotIn("DSCF0226.JPG", output)
+        self.assertFalse((self.dst / LIBRARY_INDEX_FILE_NAME).exists())
+
+    def test_read_only_dst_is_walked(self):
+        with patch("sd_copy.main.os.access", side_effect=lambda path, mode, **_: mode != os.W_OK):
+            self.assert_dst_is_walked()
+
+    def test_dst_is_walked_if_index_can_not_be_written(self):
+        with patch("sd_copy.main.LibraryIndex", side_effect=sqlite3.OperationalError("unable to open database file")):
+            self.assert_dst_is_walked()
+
+
+class TestReportStats(TestCase):
+    def test_json_is_only_written_to_given_path(self):
+        collector = StatsCollector()
+        collector.enable()
+        collector.add(Stage.copy, duration=1.0, n_bytes=100)
+        with TemporaryDirectory() as tmp_dir, patch("sd_copy.main.stats", collector):
+            stats_json = Path(tmp_dir) / "stats" / "sd_copy_stats.json"
+            stats_json.parent.mkdir()
+            report_stats(print_stats=False, stats_json=stats_json, prometheus_textfile=None)
+            self.assertEqual(json.loads(stats_json.read_text())["stages"]["copy"]["bytes"], 100)
+            self.assertEqual(tuple(path.name for path in Path(tmp_dir).rglob("*")), ("stats", "sd_copy_stats.json"))
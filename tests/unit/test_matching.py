@@ -0,0 +1,38 @@
+import itertools
+from unittest import TestCase
+
+from sd_copy.matching import AhoCorasickMatcher, get_original_stem_token, get_unmatched_stems
+
+
+class TestGetOriginalStemToken(TestCase):
+    def test_token_of_target_name(self):
+        self.assertEqual(get_original_stem_token("20210708-1736_x-t3_DSCF0226_6240x4160"), "DSCF0226")
+        self.assertEqual(get_original_stem_token("20210712-075107_dji-oa_DJI0163_2160p-29.97fps"), "DJI0163")
+
+    def test_no_token_for_non_conforming_name(self):
+        self.assertIsNone(get_original_stem_token("DSCF0226"))
+        self.assertIsNone(get_original_stem_token("holiday_x-t3_DSCF0226"))
+
+
+class TestAhoCorasickMatcher(TestCase):
+    def test_matches_equal_substring_search(self):
+        patterns = ("he", "she", "his", "hers", "DSCF", "CF02", "F0226", "x")
+        matcher = AhoCorasickMatcher(patterns)
+        for text in ("ushers", "20210708-1736_x-t3_DSCF0226", "ahishers", "", "DSDSCF02"):
+            self.assertEqual(set(matcher.iter_matches(text)), {pattern for pattern in patterns if pattern in text})
+
+
+class TestGetUnmatchedStems(TestCase):
+    def test_equals_substring_scan(self):
+        sorted_stems = {
+            "20210708-1736_x-t3_DSCF0226_6240x4160",
+            "20210712-0751_dji-oa_DJI0163_2160p-29.97fps",
+            "20210708-1740_x-t3_DSCF0300-0001_6240x4160",  # timelapse frame
+            "DSCF0400_edited",
+        }
+        stems = {"DSCF0226", "DJI_0163", "DJI0163", "DSCF0300", "DSCF0400", "DSCF0500", "x-t3", "DSCF02"}
+        for subset in itertools.combinations(stems, 4):
+            self.assertEqual(
+                get_unmatched_stems(stems=subset, sorted_stems=sorted_stems),
+                {stem for stem in subset if not any(stem in sorted_stem for sorted_stem in sorted_stems)},
+            )
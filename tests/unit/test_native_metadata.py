@@ -0,0 +1,93 @@
+import struct
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from sd_copy.native_metadata import NativeMetadataError, get_exiftool_exposure_time, get_metadata_from_native_reader
+
+
+def _tiff(model: str, date_time_original: str, width: int, height: int, shutter_speed_apex: float) -> bytes:
+    # IFD0 at offset 8 with 2 entries, EXIF IFD at offset 38 with 4 entries, followed by the out-of-line values
+    model_bytes, date_bytes = model.encode() + b"\x00", date_time_original.encode() + b"\x00"
+    data_offset = 38 + 2 + 4 * 12 + 4
+    ifd0 = struct.pack("<H", 2) + struct.pack("<HHII", 0x0110, 2, len(model_bytes), data_offset)
+    ifd0 += struct.pack("<HHII", 0x8769, 4, 1, 38) + struct.pack("<I", 0)
+    exif_ifd = struct.pack("<H", 4)
+    exif_ifd += struct.pack("<HHII", 0x9003, 2, len(date_bytes), data_offset + len(model_bytes))
+    exif_ifd += struct.pack("<HHII", 0x9201, 10, 1, data_offset + len(model_bytes) + len(date_bytes))
+    exif_ifd += struct.pack("<HHII", 0xA002, 4, 1, width) + struct.pack("<HHII", 0xA003, 4, 1, height)
+    exif_ifd += struct.pack("<I", 0)
+    shutter_speed = struct.pack("<ii", round(shutter_speed_apex * 1_000_000), 1_000_000)
+    return b"II*\x00" + struct.pack("<I", 8) + ifd0 + exif_ifd + model_bytes + date_bytes + shutter_speed
+
+
+def _jpeg(tiff: bytes) -> bytes:
+    app1 = b"Exif\x00\x00" + tiff
+    return b"\xff\xd8" + b"\xff\xe1" + struct.pack(">H", len(app1) + 2) + app1 + b"\xff\xda\x00\x02\xff\xd9"
+
+
+def _box(box_type: bytes, payload: bytes) -> bytes:
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+
+def _mov(creation_time: int, height: int, timescale: int, n_frames: int, frame_duration: int) -> bytes:
+    tkhd = bytes(76) + struct.pack(">II", 1920 << 16, height << 16)
+    mdhd = struct.pack(">IIIIII", 0, creation_time, creation_time, timescale, n_frames * frame_duration, 0)
+    hdlr = struct.pack(">II4s", 0, 0, b"vide") + bytes(12) + b"\x10DJI.Meta\x00"
+    stts = struct.pack(">IIII", 0, 1, n_frames, frame_duration)
+    minf = _box(b"minf", _box(b"stbl", _box(b"stts", stts)))
+    trak = _box(b"trak", _box(b"tkhd", tkhd) + _box(b"mdia", _box(b"mdhd", mdhd) + _box(b"hdlr", hdlr) + minf))
+    return _box(b"ftyp", b"qt  " + bytes(4)) + _box(b"mdat", bytes(64)) + _box(b"moov", trak)
+
+
+class TestGetExiftoolExposureTime(TestCase):
+    def test_exposure_times_match_exiftool_formatting(self):
+        self.assertEqual(get_exiftool_exposure_time(7.965784), "1/250")
+        self.assertEqual(get_exiftool_exposure_time(1.0), 0.5)
+        self.assertEqual(get_exiftool_exposure_time(-1.0), 2)
+
+
+class TestGetMetadataFromNativeReader(TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _write(self, name: str, content: bytes) -> Path:
+        (path := Path(self.tmp_dir.name) / name).write_bytes(content)
+        return path
+
+    def test_jpeg_metadata(self):
+        media_file = self._write("DSCF0226.JPG", _jpeg(_tiff("X-T3", "2021:07:08 17:36:28", 6240, 4160, 7.965784)))
+        metadata = get_metadata_from_native_reader(media_file)
+        self.assertEqual(metadata["File:MIMEType"], "image/jpeg")
+        self.assertEqual(metadata["EXIF:Model"], "X-T3")
+        self.assertEqual(metadata["EXIF:DateTimeOriginal"], "2021:07:08 17:36:28")
+        self.assertEqual((metadata["EXIF:ExifImageWidth"], metadata["EXIF:ExifImageHeight"]), (6240, 4160))
+        self.assertEqual(metadata["EXIF:ShutterSpeedValue"], "1/250")
+
+    def test_raf_metadata_is_read_from_embedded_jpeg(self):
+        jpeg = _jpeg(_tiff("X-T3", "2021:07:08 17:40:28", 6240, 4160, 7.965784))
+        raf = b"FUJIFILMCCD-RAW " + bytes(68) + struct.pack(">II", 100, len(jpeg)) + bytes(8) + jpeg
+        metadata = get_metadata_from_native_reader(self._write("DSCF0231.RAF", raf))
+        self.assertEqual(metadata["File:MIMEType"], "image/x-fujifilm-raf")
+        self.assertEqual(metadata["EXIF:DateTimeOriginal"], "2021:07:08 17:40:28")
+
+    def test_quicktime_metadata(self):
+        # 2021-07-12 07:51:07 in seconds since 1904-01-01
+        media_file = self._write("DJI_0163.MOV", _mov(3708921067, 2160, 30000, 300, 1001))
+        metadata = get_metadata_from_native_reader(media_file)
+        self.assertEqual(metadata["File:MIMEType"], "video/quicktime")
+        self.assertEqual(metadata["QuickTime:MediaCreateDate"], "2021:07:12 07:51:07")
+        self.assertEqual(metadata["QuickTime:ImageHeight"], 2160)
+        self.assertEqual(metadata["QuickTime:VideoFrameRate"], 29.97)
+        self.assertEqual(metadata["QuickTime:HandlerDescription"], "\u0010DJI.Meta")
+
+    def test_integral_frame_rate_has_no_decimals(self):
+        metadata = get_metadata_from_native_reader(self._write("DSCF0229.MOV", _mov(3708921067, 1080, 24000, 48, 1000)))
+        self.assertEqual(str(metadata["QuickTime:VideoFrameRate"]), "24")
+
+    def test_unreadable_file_raises_error(self):
+        self.assertRaises(NativeMetadataError, get_metadata_from_native_reader, self._write("DSCF0226.JPG", b""))
+        self.assertRaises(NativeMetadataError, get_metadata_from_native_reader, self._write("DJI_0375.AAC", b"aac"))
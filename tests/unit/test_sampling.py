@@ -0,0 +1,69 @@
+import os
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from sd_copy.cameras import fujifilm_x_t3
+from sd_copy.dcim_transfer import DCIMTransfer, Extension, Image
+from sd_copy.sampling import get_derived_dcim_transfer, get_sample_files, have_consistent_samples
+
+START = datetime(2021, 7, 8, 17, 0, 0)
+
+
+class TestSampling(TestCase):
+    def setUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.frames = tuple(Path(self.temp_dir.name) / f"DSCF{n:04d}.JPG" for n in range(1, 31))
+        for n, frame in enumerate(self.frames):
+            frame.touch()
+            # The camera clock is an hour ahead of the modification times
+            mtime = (START + timedelta(seconds=5 * n + (600 if n >= 20 else 0))).timestamp() - 3600
+            os.utime(frame, (mtime, mtime))
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def get_sampled_transfer(self, frame: Path, exif_date: datetime) -> DCIMTransfer:
+        metadata = Image(
+            file_modify_date=datetime.fromtimestamp(int(frame.stat().st_mtime), tz=timezone.utc),
+            camera=fujifilm_x_t3,
+            file_name=frame.stem,
+            extension=Extension.jpg,
+            mime_type="image/jpeg",
+            exif_date=exif_date,
+            resolution="6240x4160",
+            shutter_speed="1-250",
+        )
+        return DCIMTransfer(source_path=frame, metadata=metadata, rectified_modify_date=exif_date, target_path=Path())
+
+    def test_samples_include_outlier_intervals(self):
+        sample_files = get_sample_files(media_files=self.frames, sample_interval=10)
+        self.assertEqual(
+            tuple(self.frames.index(sample_file) for sample_file in sample_files),
+            (0, 10, 19, 20, 29),
+        )
+
+    def test_recording_time_is_derived_from_modification_time(self):
+        sampled_transfer = self.get_sampled_transfer(self.frames[0], exif_date=START)
+        dcim_transfer = get_derived_dcim_transfer(
+            media_file=self.frames[25],
+            sampled_transfer=sampled_transfer,
+            destination_path=Path("out"),
+            time_offset=0,
+        )
+        self.assertEqual(dcim_transfer.metadata.exif_date, START + timedelta(seconds=725))
+        self.assertEqual(dcim_transfer.metadata.file_name, "DSCF0026")
+        self.assertEqual(dcim_transfer.target_path.name, "20210708-1712_x-t3_DSCF0026_6240x4160.jpg")
+
+    def test_inconsistent_samples(self):
+        consistent_transfers = (
+            self.get_sampled_transfer(self.frames[0], exif_date=START),
+            self.get_sampled_transfer(self.frames[10], exif_date=START + timedelta(seconds=50)),
+        )
+        self.assertTrue(have_consistent_samples(consistent_transfers))
+        self.assertFalse(
+            have_consistent_samples(
+                (*consistent_transfers, self.get_sampled_transfer(self.frames[20], exif_date=START)),
+            ),
+        )
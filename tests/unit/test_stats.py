@@ -0,0 +1,79 @@
+import json
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from sd_copy.stats import Stage, StatsCollector, Tracer, get_percentile, span, stage
+
+
+class TestGetPercentile(TestCase):
+    def test_nearest_rank_percentile(self):
+        values = tuple(range(1, 101))
+        self.assertEqual(
+            tuple(get_percentile(values, percentile) for percentile in (50, 90, 99)),
+            (50, 90, 99),
+        )
+        self.assertEqual(get_percentile((0.5,), 99), 0.5)
+        self.assertEqual(get_percentile((), 50), 0.0)
+
+
+class TestStatsCollector(TestCase):
+    def setUp(self):
+        self.stats = StatsCollector()
+        self.stats.enable()
+        for duration in (0.1, 0.2, 0.3, 0.4):
+            self.stats.add(Stage.copy, duration=duration, n_bytes=25_000_000)
+
+    def test_report(self):
+        copy_report = self.stats.get_report()["stages"]["copy"]
+        self.assertEqual(copy_report["calls"], 4)
+        self.assertAlmostEqual(copy_report["total_seconds"], 1.0)
+        self.assertAlmostEqual(copy_report["bytes_per_second"], 100_000_000)
+        self.assertEqual((copy_report["p50_seconds"], copy_report["p99_seconds"]), (0.2, 0.4))
+
+    def test_prometheus_textfile(self):
+        with TemporaryDirectory() as tmp_dir:
+            path = Path(tmp_dir) / "sd_copy.prom"
+            self.stats.write_prometheus_textfile(path)
+            lines = path.read_text().splitlines()
+        self.assertIn('sd_copy_stage_bytes{stage="copy"} 100000000', lines)
+        self.assertIn('sd_copy_stage_latency_seconds{stage="copy",quantile="0.9"} 0.4', lines)
+
+    def test_stage_is_only_timed_if_enabled(self):
+        with patch("sd_copy.stats.stats", self.stats):
+            with stage(Stage.checksum, n_bytes=10):
+                pass
+            self.stats.enabled = False
+            with stage(Stage.checksum, n_bytes=10):
+                pass
+        self.assertEqual(self.stats.get_report()["stages"]["checksum"]["calls"], 1)
+
+
+class TestTracer(TestCase):
+    def setUp(self):
+        self.tracer = Tracer()
+        self.tracer.enable()
+
+    def test_stages_and_spans_are_traced_as_complete_events(self):
+        with patch("sd_copy.stats.tracer", self.tracer):
+            with stage(Stage.copy, n_bytes=10, file=Path("DSCF0226.JPG")):
+                with span("exiftool", category="subprocess", pid=123):
+                    pass
+        events = tuple(event for event in self.tracer.get_events() if event["ph"] == "X")
+        self.assertEqual(
+            tuple((event["name"], event["cat"], event["args"]) for event in events),
+            (("exiftool", "subprocess", {"pid": 123}), ("copy", "stage", {"file": "DSCF0226.JPG"})),
+        )
+        self.assertGreaterEqual(events[1]["dur"], events[0]["dur"])
+
+    def test_write_chrome_trace(self):
+        self.tracer.add("utime", category="stage", start=self.tracer.start_time, end=self.tracer.start_time, args={})
+        with TemporaryDirectory() as tmp_dir:
+            path = Path(tmp_dir) / "trace.json"
+            self.tracer.write(path)
+            trace = json.loads(path.read_text())
+        self.assertEqual(
+            tuple(event["ph"] for event in trace["traceEvents"]),
+            ("M", "X"),
+        )
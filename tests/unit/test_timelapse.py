@@ -1,8 +1,24 @@
+import os
+from datetime import datetime, timedelta
 from functools import partial
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Sequence
 from unittest import TestCase
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 
-from sd_copy.timelapse import TimelapseSpec, get_timelapse_duration_from_spec
+from sd_copy.cameras import fujifilm_x_t3
+from sd_copy.dcim_transfer import DCIMTransfer, Extension, Image, Video
+from sd_copy.timelapse import (
+    ProxySettings,
+    TimelapseSpec,
+    TimelapseTransfer,
+    generate_timelapse_proxy,
+    get_proxy_cache_key,
+    get_timelapse_duration_from_spec,
+    prune_proxy_cache,
+    split_timelapse_sequences,
+)
 
 
 class TestTimelapseDuration(TestCase):
@@ -25,3 +41,137 @@ class TestTimelapseDuration(TestCase):
         self.assertEqual(get_timelapse_duration_from_spec(make_spec(n_images=368, dt=10)), "1h01m")
         self.assertEqual(get_timelapse_duration_from_spec(make_spec(n_images=360, dt=10)), "59m")
         self.assertEqual(get_timelapse_duration_from_spec(make_spec(n_images=200, dt=600)), "33h10m")
+
+
+class TestGenerateTimelapseProxy(TestCase):
+    def setUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.frames = tuple(Path(self.temp_dir.name) / f"DSCF{n:04d}.JPG" for n in range(6))
+        for frame in self.frames:
+            frame.write_bytes(frame.name.encode())
+        self.timelapse_transfer = TimelapseTransfer(
+            jpg_files=tuple(
+                Mock(source_path=frame, target_path=Path("out") / frame.name, metadata=Mock(resolution="6240x4160"))
+                for frame in self.frames
+            ),
+            raw_files=(),
+            video_file=None,
+        )
+        self.proxy_settings = ProxySettings(cache_dir=Path(self.temp_dir.name) / "proxies", downscale_jobs=2)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_cache_key_depends_on_frames_and_settings(self):
+        cache_key = get_proxy_cache_key(self.frames, self.proxy_settings)
+        self.assertEqual(get_proxy_cache_key(self.frames, self.proxy_settings), cache_key)
+        self.assertNotEqual(get_proxy_cache_key(self.frames[::-1], self.proxy_settings), cache_key)
+        self.assertNotEqual(get_proxy_cache_key(self.frames, ProxySettings(height=720)), cache_key)
+        os.utime(self.frames[0], ns=(0, 0))
+        self.assertNotEqual(get_proxy_cache_key(self.frames, self.proxy_settings), cache_key)
+
+    @patch("sd_copy.timelapse.subprocess.run")
+    def test_dry_run_does_not_encode(self, mock_run):
+        generate_timelapse_proxy(
+            self.timelapse_transfer,
+            stem="timelapse",
+            dry_run=True,
+            proxy_settings=self.proxy_settings,
+        )
+        mock_run.assert_not_called()
+
+    @patch("sd_copy.timelapse.encode_timelapse_proxy")
+    def test_cached_proxy_is_encoded_once(self, mock_encode_timelapse_proxy):
+        mock_encode_timelapse_proxy.side_effect = lambda frames, output_path, proxy_settings: output_path.touch()
+        self.proxy_settings.cache_dir.mkdir()
+        for _ in range(2):
+            (proxy_transfer,) = generate_timelapse_proxy(
+                self.timelapse_transfer,
+                stem="timelapse",
+                dry_run=False,
+                proxy_settings=self.proxy_settings,
+            )
+        mock_encode_timelapse_proxy.assert_called_once()
+        self.assertEqual(proxy_transfer.source_path.parent, self.proxy_settings.cache_dir)
+        self.assertEqual(proxy_transfer.target_path, Path("out") / "timelapse.mp4")
+        self.assertEqual(proxy_transfer.metadata.resolution, "6240x4160")
+
+    def test_prune_removes_least_recently_used_proxies(self):
+        self.proxy_settings.cache_dir.mkdir()
+        proxies = tuple(self.proxy_settings.cache_dir / f"{n}.mp4" for n in range(3))
+        for n, proxy in enumerate(proxies):
+            proxy.write_bytes(b"proxy")
+            os.utime(proxy, ns=(n, n))
+        with (
+            patch("sd_copy.timelapse.encode_timelapse_proxy"),
+            patch(
+                "sd_copy.timelapse.get_proxy_output_path",
+                return_value=proxies[0],
+            ),
+        ):
+            generate_timelapse_proxy(
+                self.timelapse_transfer,
+                stem="timelapse",
+                dry_run=False,
+                proxy_settings=self.proxy_settings,
+            )
+        self.assertEqual(prune_proxy_cache(cache_dir=self.proxy_settings.cache_dir, max_size=10), 1)
+        self.assertEqual(tuple(proxy.exists() for proxy in proxies), (True, False, True))
+
+
+class TestSplitTimelapseSequences(TestCase):
+    def setUp(self):
+        self.n_shots = 0
+
+    def make_shot(self, date: datetime, shutter_speed: str = "1-250", video: bool = False) -> Sequence[DCIMTransfer]:
+        self.n_shots += 1
+        return tuple(
+            DCIMTransfer(
+                source_path=Path("card") / f"DSCF{self.n_shots:04d}{extension}",
+                metadata=(Video if video else Image)(
+                    file_modify_date=date,
+                    camera=fujifilm_x_t3,
+                    file_name=f"DSCF{self.n_shots:04d}",
+                    extension=extension,
+                    mime_type="",
+                    exif_date=date,
+                    resolution="",
+                    **({"fps": ""} if video else {"shutter_speed": shutter_speed}),
+                ),
+                rectified_modify_date=date,
+                target_path=Path("out") / f"DSCF{self.n_shots:04d}{extension}",
+            )
+            for extension in ((Extension.mov,) if video else (Extension.jpg, Extension.raf))
+        )
+
+    def make_sequence(self, start: datetime, n_shots: int, dt: int, shutter_speed: str = "1-250"):
+        return tuple(
+            transfer
+            for n in range(n_shots)
+            for transfer in self.make_shot(start + timedelta(seconds=n * dt), shutter_speed=shutter_speed)
+        )
+
+    def test_sequences_are_split_by_interval_and_shutter_speed(self):
+        start = datetime(2021, 7, 8, 17, 0, 0)
+        first_sequence = self.make_sequence(start, n_shots=12, dt=5)
+        other_transfers = (
+            *self.make_shot(start + timedelta(minutes=5)),
+            *self.make_shot(start + timedelta(minutes=6), video=True),
+        )
+        second_sequence = self.make_sequence(start + timedelta(minutes=10), n_shots=10, dt=60)
+        third_sequence = self.make_sequence(start + timedelta(minutes=20), n_shots=10, dt=60, shutter_speed="1-30")
+        timelapse_transfers, sorted_transfers = split_timelapse_sequences(
+            (*first_sequence, *other_transfers, *second_sequence, *third_sequence),
+        )
+        self.assertEqual(
+            tuple(len(timelapse_transfer.jpg_files) for timelapse_transfer in timelapse_transfers),
+            (12, 10, 10),
+        )
+        self.assertEqual(timelapse_transfers[1].jpg_files[0].source_path, second_sequence[0].source_path)
+        self.assertCountEqual(sorted_transfers, other_transfers)
+
+    def test_short_sequences_are_sorted_as_usual(self):
+        dcim_transfers = self.make_sequence(datetime(2021, 7, 8, 17, 0, 0), n_shots=3, dt=1)
+        timelapse_transfers, sorted_transfers = split_timelapse_sequences(dcim_transfers)
+        self.assertEqual(timelapse_transfers, ())
+        self.assertCountEqual(sorted_transfers, dcim_transfers)
@@ -1,8 +1,9 @@
+import time
 from datetime import datetime
 from pathlib import Path
 from unittest import TestCase
 
-from sd_copy.utils import get_checksum, get_datetime_from_str
+from sd_copy.utils import get_checksum, get_datetime_from_str, parallel_map
 
 
 class TestGetDatetimeFromString(TestCase):
@@ -22,3 +23,41 @@ class TestGetDatetimeFromString(TestCase):
 class TestGetChecksum(TestCase):
     def test_get_checksum_for_file(self):
         self.assertEqual("e4026615df7cc162b7e53eefdab78328", get_checksum(file=Path("dcim/100MEDIA/DJI_0373.MOV")))
+
+
+class TestParallelMap(TestCase):
+    def test_results_keep_input_order(self):
+        self.assertEqual(
+            tuple(parallel_map(lambda n: time.sleep(0.01 * (5 - n)) or n, range(5), jobs=3)),
+            (0, 1, 2, 3, 4),
+        )
+
+    def test_failure_cancels_queued_calls(self):
+        calls = []
+
+        def fail_on_first(n):
+            calls.append(n)
+            if n == 0:
+                raise ValueError
+            time.sleep(0.05)
+
+        self.assertRaises(ValueError, tuple, parallel_map(fail_on_first, range(100), jobs=2))
+        self.assertLess(len(calls), 100)
+
+    def test_failure_stops_consuming_lazy_iterable(self):
+        pulled, calls = [], []
+
+        def slow_items():
+            for n in range(20):
+                time.sleep(0.01)
+                pulled.append(n)
+                yield n
+
+        def fail_on_first(n):
+            calls.append(n)
+            if n == 0:
+                raise ValueError
+
+        self.assertRaises(ValueError, tuple, parallel_map(fail_on_first, slow_items(), jobs=2))
+        self.assertLessEqual(len(pulled), 2)
+        self.assertLessEqual(len(calls), 2)
@@ -0,0 +1,33 @@
+from datetime import datetime
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import Mock
+
+from sd_copy.dcim_transfer import DCIMTransfer
+
+
+class DCIMTransfersTestCase(TestCase):
+    """Transfers of `n_transfers` X-T3 JPGs from a temporary source directory to a date folder in a temporary target
+    directory. Each source file holds its name, repeated `source_repeats` times."""
+
+    n_transfers = 4
+    source_repeats = 1
+
+    def setUp(self):
+        self.source_dir, self.target_dir = TemporaryDirectory(), TemporaryDirectory()
+        self.dcim_transfers = tuple(
+            DCIMTransfer(
+                source_path=Path(self.source_dir.name) / f"DSCF{n:04d}.JPG",
+                metadata=Mock(),
+                rectified_modify_date=datetime(2021, 7, 8, 17, 36, n),
+                target_path=Path(self.target_dir.name) / "2021-07-08" / f"20210708-1736_x-t3_DSCF{n:04d}.jpg",
+            )
+            for n in range(self.n_transfers)
+        )
+        for dcim_transfer in self.dcim_transfers:
+            dcim_transfer.source_path.write_bytes(dcim_transfer.source_path.name.encode() * self.source_repeats)
+
+    def tearDown(self):
+        self.source_dir.cleanup()
+        self.target_dir.cleanup()